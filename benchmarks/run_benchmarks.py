@@ -0,0 +1,538 @@
+"""Benchmarks of the analysis and populate hot paths on synthetic data
+
+Compute kernels run without a database. With `--db`, `ActivityAlignment.populate` and
+the inserts and fetches of its two storage layouts are timed against the MySQL server
+configured by `dj_local_conf.json` or the `DJ_HOST`, `DJ_USER` and `DJ_PASS`
+environment variables (e.g. the `docker-compose.yaml` container), in workflow schemas
+created with `--db-prefix` and dropped afterwards.
+
+Each result reports the median time and the time per unit of work (e.g. per aligned
+sample), which `thresholds.json` bounds independently of the chosen scale:
+
+    python benchmarks/run_benchmarks.py --rois 300 --trials 400 --frames 111770 \\
+        --output bench_output.json [--db] [--baseline previous.json]
+
+The exit code is 1 if any benchmark exceeds its threshold or regresses past
+`--tolerance` relative to the baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from synthetic import (  # noqa: E402
+    make_frame_times,
+    make_masks,
+    make_traces,
+    make_trials,
+)
+
+from workflow_miniscope import alignment  # noqa: E402
+
+THRESHOLDS_FILE = Path(__file__).with_name("thresholds.json")
+
+
+def timed(func, repeats: int, setup=None) -> list:
+    """Wall time of `repeats` calls of `func`, running `setup` before each call"""
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def result(name: str, times: list, units: int, unit: str) -> dict:
+    median = statistics.median(times)
+    return {
+        "name": name,
+        "median_s": median,
+        "min_s": min(times),
+        "repeats": len(times),
+        "units": int(units),
+        "unit": unit,
+        "ns_per_unit": 1e9 * median / max(units, 1),
+    }
+
+
+def compute_benchmarks(args) -> list:
+    """Alignment, PSTH and plotting kernels on in-memory synthetic data"""
+    from workflow_miniscope import plotting
+
+    results = []
+    for session_idx in range(args.sessions):
+        traces = make_traces(args.rois, args.frames, seed=session_idx)
+        frame_times = make_frame_times(args.frames, args.frame_rate, seed=session_idx)
+        start_times, event_times, end_times = make_trials(
+            args.trials, args.frames, args.frame_rate, seed=session_idx
+        )
+        valid, min_limit, max_limit = alignment.get_alignment_windows(
+            event_times, start_times, end_times
+        )
+        event_times = event_times[valid]
+        aligned_timestamps = np.arange(-min_limit, max_limit, 1 / args.frame_rate)
+        samples = len(event_times) * args.rois * len(aligned_timestamps)
+
+        def frame_rate_alignment():
+            start_indices = alignment.get_window_start_indices(
+                event_times, min_limit, args.frame_rate
+            )
+            return alignment.WindowSampler.from_start_indices(
+                start_indices, len(aligned_timestamps), args.frames
+            ).sample(traces)
+
+        def timestamp_alignment():
+            return alignment.WindowSampler.from_timestamps(
+                frame_times, event_times, aligned_timestamps
+            ).sample(traces)
+
+        def streaming_alignment():
+            start_indices = alignment.get_window_start_indices(
+                event_times, min_limit, args.frame_rate
+            )
+            sampler = alignment.WindowSampler.from_start_indices(
+                start_indices, len(aligned_timestamps), args.frames
+            )
+            frames, reduced_sampler = sampler.reduce()
+            chunk_size = alignment.get_roi_chunk_size(
+                args.memory_budget, args.frames, len(frames)
+            )
+            out = np.empty((len(event_times), args.rois, len(aligned_timestamps)))
+            for start in range(0, args.rois, chunk_size):
+                roi_slice = slice(start, start + chunk_size)
+                reduced_sampler.sample(
+                    traces[roi_slice][:, frames], out=out[:, roi_slice]
+                )
+            return out
+
+        for name, func in [
+            ("alignment.frame_rate", frame_rate_alignment),
+            ("alignment.timestamps", timestamp_alignment),
+            ("alignment.streaming", streaming_alignment),
+        ]:
+            results.append(
+                result(name, timed(func, args.repeats), samples, "aligned sample")
+            )
+
+        aligned = frame_rate_alignment()
+        results.append(
+            result(
+                "psth.binned",
+                timed(
+                    lambda: alignment.compute_binned_psth(
+                        aligned, aligned_timestamps, args.bin_size
+                    ),
+                    args.repeats,
+                ),
+                samples,
+                "aligned sample",
+            )
+        )
+
+        nplot = min(args.plot_rois, args.rois)
+        with tempfile.TemporaryDirectory() as plot_dir:
+            paths = [Path(plot_dir) / f"mask_{roi}.png" for roi in range(nplot)]
+            results.append(
+                result(
+                    "plot.gallery",
+                    timed(
+                        lambda: plotting.render_gallery(
+                            aligned_timestamps,
+                            list(range(nplot)),
+                            aligned[:, :nplot],
+                            paths,
+                            processes=args.processes,
+                        ),
+                        args.repeats,
+                    ),
+                    nplot,
+                    "ROI image",
+                )
+            )
+    return results
+
+
+def db_benchmarks(args) -> list:
+    """Populate, insert and fetch of both ActivityAlignment storage layouts
+
+    The workflow schemas are activated with `--db-prefix` and filled with synthetic
+    sessions, then dropped.
+    """
+    import datajoint as dj
+
+    import workflow_miniscope
+
+    if Path("./dj_local_conf.json").exists():
+        dj.config.load("./dj_local_conf.json")
+    for config_key, env_var in [
+        ("database.host", "DJ_HOST"),
+        ("database.user", "DJ_USER"),
+        ("database.password", "DJ_PASS"),
+    ]:
+        dj.config[config_key] = os.environ.get(env_var) or dj.config[config_key]
+
+    if not args.db_prefix or any(
+        name.startswith(args.db_prefix) for name in dj.list_schemas()
+    ):
+        raise ValueError(
+            f"--db-prefix {args.db_prefix!r} must be non-empty and not used by any"
+            " schema, as the benchmark schemas are dropped afterwards"
+        )
+    # the prefix is read on the first import of the schemas below
+    dj.config["custom"]["database.prefix"] = args.db_prefix
+    workflow_miniscope.db_prefix = args.db_prefix
+
+    from workflow_miniscope import analysis, reference
+    from workflow_miniscope.pipeline import (
+        event,
+        lab,
+        miniscope,
+        session,
+        subject,
+        trial,
+    )
+
+    ActivityAlignment = analysis.ActivityAlignment
+    results = []
+    try:
+        condition_keys = [
+            insert_synthetic_session(args, session_idx)
+            for session_idx in range(args.sessions)
+        ]
+        rows = args.rois * args.trials * args.sessions
+
+        def clear():
+            with dj.config(safemode=False):
+                (ActivityAlignment & condition_keys).delete()
+
+        def populate():
+            ActivityAlignment.populate(condition_keys)
+
+        results.append(
+            result(
+                "populate.activity_alignment",
+                timed(populate, args.repeats, setup=clear),
+                rows,
+                "mask x trial",
+            )
+        )
+
+        aligned = []
+        for key in condition_keys:
+            trial_keys = (
+                trial.Trial & (analysis.ActivityAlignmentCondition.Trial & key)
+            ).fetch("KEY", order_by="trial_id")
+            trace_keys = (miniscope.Activity.Trace & key).fetch("KEY", order_by="mask")
+            (
+                aligned_timestamps,
+                trial_ids,
+                _,
+                aligned_activities,
+            ) = ActivityAlignment().fetch_aligned_activities(key)
+            # trials without an alignment event are not aligned
+            aligned_trial_keys = [k for k in trial_keys if k["trial_id"] in trial_ids]
+            aligned.append(
+                (
+                    key,
+                    aligned_timestamps,
+                    aligned_trial_keys,
+                    trace_keys,
+                    aligned_activities,
+                )
+            )
+
+        def insert(storage):
+            for key, aligned_timestamps, trial_keys, trace_keys, activities in aligned:
+                ActivityAlignment.insert1(
+                    {**key, "aligned_timestamps": aligned_timestamps},
+                    allow_direct_insert=True,
+                )
+                ActivityAlignment()._insert_aligned_activities(
+                    key, trial_keys, trace_keys, activities, storage
+                )
+
+        roi = trace_keys[args.rois // 2]["mask"]
+        aligned_rows = args.rois * sum(
+            len(trial_keys) for _, _, trial_keys, *_ in aligned
+        )
+        for storage, layout in [("trial", "trial_rows"), ("tensor", "tensor_chunks")]:
+            results.append(
+                result(
+                    f"insert.{layout}",
+                    timed(lambda: insert(storage), args.repeats, setup=clear),
+                    aligned_rows,
+                    "mask x trial",
+                )
+            )
+            for name, func, units in [
+                (
+                    f"fetch.{layout}.roi",
+                    lambda: ActivityAlignment().fetch_aligned_activities(
+                        condition_keys[0], rois=[roi]
+                    ),
+                    len(aligned[0][2]),
+                ),
+                (
+                    f"fetch.{layout}.condition",
+                    lambda: ActivityAlignment().fetch_aligned_activities(
+                        condition_keys[0]
+                    ),
+                    args.rois * len(aligned[0][2]),
+                ),
+            ]:
+                results.append(
+                    result(name, timed(func, args.repeats), units, "mask x trial")
+                )
+    finally:
+        for module in (analysis, miniscope, trial, event, session, subject, lab):
+            module.schema.drop(force=True)
+        reference.schema.drop(force=True)
+
+    return results
+
+
+def insert_synthetic_session(args, session_idx: int) -> dict:
+    """Insert a synthetic session, from the recording to the Activity traces, and
+    an alignment condition of all its trials
+
+    Returns:
+        condition_key (dict): ActivityAlignmentCondition key
+    """
+    import datetime
+
+    from workflow_miniscope.analysis import ActivityAlignmentCondition
+    from workflow_miniscope.pipeline import event, miniscope, session, subject, trial
+
+    subject.Subject.insert1(
+        {"subject": "bench", "sex": "U", "subject_birth_date": "2020-01-01"},
+        skip_duplicates=True,
+    )
+    session_key = {
+        "subject": "bench",
+        "session_datetime": datetime.datetime(2022, 1, 1)
+        + datetime.timedelta(hours=session_idx),
+    }
+    session.Session.insert1(session_key)
+
+    recording_key = {**session_key, "recording_id": 0}
+    miniscope.Recording.insert1(
+        {
+            **recording_key,
+            "device": "Miniscope_V4_BNO",
+            "acq_software": "Miniscope-DAQ-V4",
+        }
+    )
+    miniscope.RecordingInfo.insert1(
+        {
+            **recording_key,
+            "nchannels": 1,
+            "nframes": args.frames,
+            "px_height": 600,
+            "px_width": 600,
+            "fps": args.frame_rate,
+            "led_power": 0,
+            "time_stamps": make_frame_times(
+                args.frames, args.frame_rate, seed=session_idx
+            ),
+        },
+        allow_direct_insert=True,
+    )
+    if not miniscope.ProcessingParamSet & {"paramset_id": 0}:
+        miniscope.ProcessingParamSet.insert_new_params(
+            processing_method="caiman",
+            paramset_id=0,
+            paramset_desc="benchmark",
+            params={},
+        )
+    key = {**recording_key, "paramset_id": 0}
+    miniscope.ProcessingTask.insert1({**key, "processing_output_dir": ""})
+    miniscope.Processing.insert1(
+        {**key, "processing_time": datetime.datetime.now()},
+        allow_direct_insert=True,
+    )
+    key["curation_id"] = 0
+    miniscope.Curation.insert1(
+        {
+            **key,
+            "curation_time": datetime.datetime.now(),
+            "curation_output_dir": "",
+            "manual_curation": False,
+        }
+    )
+
+    masks = make_masks(args.rois, seed=session_idx)
+    traces = make_traces(args.rois, args.frames, seed=session_idx)
+    miniscope.Segmentation.insert1(key, allow_direct_insert=True)
+    miniscope.Segmentation.Mask.insert(
+        {**key, **mask, "segmentation_channel": 0} for mask in masks
+    )
+    miniscope.Fluorescence.insert1(key, allow_direct_insert=True)
+    miniscope.Fluorescence.Trace.insert(
+        {
+            **key,
+            "mask": mask["mask"],
+            "fluorescence_channel": 0,
+            "fluorescence": trace,
+        }
+        for mask, trace in zip(masks, traces)
+    )
+    key["extraction_method"] = "caiman_dff"
+    miniscope.Activity.insert1(key, allow_direct_insert=True)
+    miniscope.Activity.Trace.insert(
+        {
+            **key,
+            "mask": mask["mask"],
+            "fluorescence_channel": 0,
+            "activity_trace": trace,
+        }
+        for mask, trace in zip(masks, traces)
+    )
+
+    start_times, event_times, end_times = make_trials(
+        args.trials, args.frames, args.frame_rate, seed=session_idx
+    )
+    event.BehaviorRecording.insert1(session_key)
+    event.EventType.insert(
+        [{"event_type": name} for name in ("trial_start", "stimulus", "trial_end")],
+        skip_duplicates=True,
+    )
+    trial.Trial.insert(
+        (
+            {
+                **session_key,
+                "trial_id": trial_id,
+                "trial_start_time": start,
+                "trial_stop_time": end,
+            }
+            for trial_id, (start, end) in enumerate(zip(start_times, end_times), 1)
+        ),
+        allow_direct_insert=True,
+    )
+    event.Event.insert(
+        (
+            {
+                **session_key,
+                "event_type": event_type,
+                "event_start_time": round(event_time, 4),
+            }
+            for event_type, times in (
+                ("trial_start", start_times),
+                ("stimulus", event_times),
+                ("trial_end", end_times),
+            )
+            for event_time in times[~np.isnan(times)]
+        ),
+        allow_direct_insert=True,
+    )
+    event.AlignmentEvent.insert1(
+        {
+            "alignment_name": "stimulus",
+            "alignment_event_type": "stimulus",
+            "alignment_time_shift": 0,
+            "start_event_type": "trial_start",
+            "start_time_shift": 0,
+            "end_event_type": "trial_end",
+            "end_time_shift": 0,
+        },
+        skip_duplicates=True,
+    )
+    condition_key = {
+        **key,
+        "alignment_name": "stimulus",
+        "trial_condition": "all",
+    }
+    ActivityAlignmentCondition.insert1(condition_key)
+    ActivityAlignmentCondition.Trial.insert(
+        {**condition_key, "trial_id": trial_id}
+        for trial_id in range(1, args.trials + 1)
+    )
+    return condition_key
+
+
+def check(results: list, thresholds: dict, baseline: dict, tolerance: float) -> list:
+    """Benchmarks over their threshold or slower than the baseline by `tolerance`"""
+    failures = []
+    baseline = {r["name"]: r for r in (baseline or {}).get("results", [])}
+    for r in results:
+        limit = thresholds.get(r["name"])
+        if limit is not None and r["ns_per_unit"] > limit:
+            failures.append(
+                f"{r['name']}: {r['ns_per_unit']:.1f} ns/{r['unit']}"
+                f" exceeds threshold {limit} ns"
+            )
+        previous = baseline.get(r["name"])
+        if previous and r["ns_per_unit"] > tolerance * previous["ns_per_unit"]:
+            failures.append(
+                f"{r['name']}: {r['ns_per_unit']:.1f} ns/{r['unit']} is slower than"
+                f" baseline {previous['ns_per_unit']:.1f} x {tolerance}"
+            )
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rois", type=int, default=300)
+    parser.add_argument("--trials", type=int, default=400)
+    parser.add_argument("--frames", type=int, default=111770)
+    parser.add_argument("--sessions", type=int, default=1)
+    parser.add_argument("--frame-rate", type=float, default=30.0)
+    parser.add_argument("--bin-size", type=float, default=0.04)
+    parser.add_argument("--memory-budget", type=int, default=256 * 1024**2)
+    parser.add_argument("--plot-rois", type=int, default=32)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--db", action="store_true", help="run database benchmarks")
+    parser.add_argument("--db-prefix", default="bench_")
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--thresholds", default=str(THRESHOLDS_FILE))
+    parser.add_argument("--baseline", help="earlier --output file to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.25)
+    args = parser.parse_args(argv)
+
+    results = compute_benchmarks(args)
+    if args.db:
+        results += db_benchmarks(args)
+
+    thresholds = json.loads(Path(args.thresholds).read_text())
+    baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+    failures = check(results, thresholds, baseline, args.tolerance)
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "scale": {
+            key: getattr(args, key)
+            for key in ("rois", "trials", "frames", "sessions", "frame_rate")
+        },
+        "results": results,
+        "failures": failures,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2))
+
+    for r in results:
+        print(
+            f"{r['name']:32s} {r['median_s']:9.4f} s"
+            f" {r['ns_per_unit']:10.1f} ns/{r['unit']}"
+        )
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""Synthetic miniscope data at configurable scale for the benchmarks"""
+import numpy as np
+
+
+def make_traces(nrois: int, nframes: int, seed: int = 0) -> np.ndarray:
+    """Calcium-like activity traces: sparse events with exponential decay
+
+    Args:
+        nrois (int): number of ROIs
+        nframes (int): number of frames
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        traces (np.ndarray): (rois, frames) float64 traces
+    """
+    rng = np.random.default_rng(seed)
+    events = rng.random((nrois, nframes)) < 0.01
+    kernel = np.exp(-np.arange(60) / 12)
+    traces = np.empty((nrois, nframes))
+    for roi, roi_events in enumerate(events):
+        traces[roi] = np.convolve(roi_events, kernel)[:nframes]
+    traces += rng.normal(scale=0.05, size=traces.shape)
+    return traces
+
+
+def make_frame_times(
+    nframes: int, frame_rate: float, drop_fraction: float = 0.001, seed: int = 0
+) -> np.ndarray:
+    """Frame times with randomly dropped frames, as recorded by Miniscope-DAQ
+
+    Args:
+        nframes (int): number of recorded frames
+        frame_rate (float): (Hz) nominal frame rate
+        drop_fraction (float, optional): fraction of dropped frames. Defaults to
+            0.001.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        frame_times (np.ndarray): (frames,) time of each recorded frame in seconds
+    """
+    rng = np.random.default_rng(seed)
+    nacquired = int(np.ceil(nframes / (1 - drop_fraction)))
+    kept = np.sort(rng.choice(nacquired, size=nframes, replace=False))
+    return kept / frame_rate
+
+
+def make_trials(ntrials: int, nframes: int, frame_rate: float, seed: int = 0) -> tuple:
+    """Trial start, alignment event and end times spread over a recording
+
+    Args:
+        ntrials (int): number of trials
+        nframes (int): number of frames of the recording
+        frame_rate (float): (Hz) frame rate of the recording
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        start_times, event_times, end_times (np.ndarray): (trials,) times in
+            seconds; a few trials have no event (NaN)
+    """
+    rng = np.random.default_rng(seed)
+    duration = nframes / frame_rate
+    trial_length = duration / ntrials
+    start_times = np.arange(ntrials) * trial_length
+    event_times = start_times + rng.uniform(0.3, 0.6, ntrials) * trial_length
+    end_times = start_times + trial_length
+    event_times[rng.random(ntrials) < 0.02] = np.nan
+    return start_times, event_times, end_times
+
+
+def make_masks(
+    nrois: int, height: int = 600, width: int = 600, radius: int = 6, seed: int = 0
+) -> list:
+    """Round segmentation masks at random positions of the field of view
+
+    Args:
+        nrois (int): number of masks
+        height (int, optional): field of view height in pixels. Defaults to 600.
+        width (int, optional): field of view width in pixels. Defaults to 600.
+        radius (int, optional): mask radius in pixels. Defaults to 6.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        masks (list): dicts with the attributes of `miniscope.Segmentation.Mask`
+    """
+    rng = np.random.default_rng(seed)
+    offsets = np.arange(-radius, radius + 1)
+    dy, dx = np.meshgrid(offsets, offsets, indexing="ij")
+    inside = dy**2 + dx**2 <= radius**2
+    dy, dx = dy[inside], dx[inside]
+
+    masks = []
+    for mask_id in range(nrois):
+        center_y = int(rng.integers(radius, height - radius))
+        center_x = int(rng.integers(radius, width - radius))
+        masks.append(
+            {
+                "mask": mask_id,
+                "mask_npix": len(dy),
+                "mask_center_x": center_x,
+                "mask_center_y": center_y,
+                "mask_xpix": center_x + dx,
+                "mask_ypix": center_y + dy,
+                "mask_weights": rng.random(len(dy)),
+            }
+        )
+    return masks
@@ -35,4 +35,10 @@ setup(
     keywords="neuroscience datajoint calcium-imaging miniscope",
     packages=find_packages(exclude=["contrib", "docs", "tests*"]),
     install_requires=requirements,
+    entry_points={
+        "console_scripts": [
+            "workflow-miniscope-process=workflow_miniscope.process:main",
+            "workflow-miniscope-profile=workflow_miniscope.profiling:main",
+        ],
+    },
 )
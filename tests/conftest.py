@@ -104,6 +104,57 @@ def test_data(setup, dj_config):
     return
 
 
+def write_csv(path, content):
+    """General function for writing strings to lines in CSV
+
+    Args:
+        path: pathlib PosixPath
+        content: list of strings, each as row of CSV
+    """
+    with open(path, "w") as f:
+        for line in content:
+            f.write(line + "\n")
+
+
+@pytest.fixture(scope="session")
+def ingest_data(setup, pipeline, test_data):
+    """For each input, generates csv in test_user_data_dir and ingests in schema"""
+    from workflow_miniscope.ingest import ingest_sessions, ingest_subjects
+
+    all_csvs = {
+        "subjects.csv": {
+            "func": ingest_subjects,
+            "args": {"subject_csv_path": f"{test_user_data_dir}/subjects.csv"},
+            "content": [
+                "subject,sex,subject_birth_date,subject_description",
+                "subject1,F,2023-01-01,Subject of the miniscope demo data",
+            ],
+        },
+        "sessions.csv": {
+            "func": ingest_sessions,
+            "args": {"session_csv_path": f"{test_user_data_dir}/sessions.csv"},
+            "content": [
+                "subject,session_dir,session_datetime,device,acq_software",
+                f"subject1,{session_dirs[0]},2023-05-11 12:00:00,"
+                + "Miniscope_V4_BNO,Miniscope-DAQ-V4",
+            ],
+        },
+    }
+
+    for csv_filename, csv_dict in all_csvs.items():
+        write_csv(test_user_data_dir / csv_filename, csv_dict["content"])
+
+    with verbose_context:
+        for csv_dict in all_csvs.values():
+            csv_dict["func"](verbose=verbose, **csv_dict["args"])
+
+    yield all_csvs
+
+    if _tear_down:
+        for csv_filename in all_csvs:
+            (test_user_data_dir / csv_filename).unlink(missing_ok=True)
+
+
 @pytest.fixture(scope="function")
 def element_helper_functions():
     from element_miniscope.miniscope import (
@@ -253,14 +304,20 @@ def processing_tasks(pipeline, caiman_paramset, recording_info):
     session = pipeline["session"]
     get_miniscope_root_data_dir = pipeline["get_miniscope_root_data_dir"]
 
-    for scan_key in (
+    from workflow_miniscope.paths import find_full_paths
+
+    scan_keys = (
         session.Session * miniscope.Recording - miniscope.ProcessingTask
-    ).fetch("KEY"):
-        scan_file = find_full_path(
-            get_miniscope_root_data_dir(),
-            (miniscope.RecordingInfo.File & scan_key).fetch("file_path")[0],
-        )
+    ).fetch("KEY")
+    scan_files = find_full_paths(
+        get_miniscope_root_data_dir(),
+        [
+            (miniscope.RecordingInfo.File & scan_key).fetch("file_path")[0]
+            for scan_key in scan_keys
+        ],
+    )
 
+    for scan_key, scan_file in zip(scan_keys, scan_files):
         recording_dir = scan_file.parent
         caiman_dir = Path(recording_dir / "caiman")
         if caiman_dir.exists():
@@ -306,3 +363,74 @@ def post_curation(pipeline, curations):
     populate_tables(tables)
     yield
     populate_clear(tables)
+
+
+@pytest.fixture
+def alignment_condition(pipeline, post_curation):
+    """A condition of two trials with narrow windows, and a third, wider trial"""
+    from workflow_miniscope.analysis import ActivityAlignmentCondition
+    from workflow_miniscope.pipeline import event, trial
+
+    miniscope = pipeline["miniscope"]
+    activity_key = miniscope.Activity.fetch("KEY", limit=1)[0]
+    session_key = (pipeline["session"].Session & activity_key).fetch1("KEY")
+    nframes, fps = (miniscope.RecordingInfo & activity_key).fetch1("nframes", "fps")
+    trial_frames = nframes // 3
+
+    event.BehaviorRecording.insert1(session_key, skip_duplicates=True)
+    event.EventType.insert(
+        [{"event_type": name} for name in ("trial_start", "stimulus", "trial_end")],
+        skip_duplicates=True,
+    )
+    trial_rows, event_rows = [], []
+    # windows of whole frames around stimuli half-way between frames, wider for the
+    # third trial
+    for trial_id, pre_frames in zip((1, 2, 3), (4, 4, 8)):
+        start = (trial_id - 1) * trial_frames
+        stimulus = start + trial_frames // 2 + 0.5
+        trial_rows.append(
+            {
+                **session_key,
+                "trial_id": trial_id,
+                "trial_start_time": start / fps,
+                "trial_stop_time": (start + trial_frames - 1) / fps,
+            }
+        )
+        for event_type, frame in (
+            ("trial_start", stimulus - pre_frames),
+            ("stimulus", stimulus),
+            ("trial_end", stimulus + 4),
+        ):
+            event_rows.append(
+                {
+                    **session_key,
+                    "event_type": event_type,
+                    "event_start_time": round(frame / fps, 4),
+                }
+            )
+    trial.Trial.insert(trial_rows, allow_direct_insert=True)
+    event.Event.insert(event_rows, allow_direct_insert=True)
+    event.AlignmentEvent.insert1(
+        {
+            "alignment_name": "stimulus",
+            "alignment_event_type": "stimulus",
+            "alignment_time_shift": 0,
+            "start_event_type": "trial_start",
+            "start_time_shift": 0,
+            "end_event_type": "trial_end",
+            "end_time_shift": 0,
+        },
+        skip_duplicates=True,
+    )
+    key = {**activity_key, "alignment_name": "stimulus", "trial_condition": "test"}
+    ActivityAlignmentCondition.insert1(key)
+    ActivityAlignmentCondition.Trial.insert(
+        {**key, "trial_id": trial_id} for trial_id in (1, 2)
+    )
+
+    yield key
+
+    (ActivityAlignmentCondition & key).delete()
+    (trial.Trial & session_key).delete()
+    (event.BehaviorRecording & session_key).delete()
+    (event.AlignmentEvent & {"alignment_name": "stimulus"}).delete()
@@ -0,0 +1,226 @@
+"""Tests the vectorized event-alignment kernels against a per-trial reference
+"""
+import numpy as np
+
+from workflow_miniscope import alignment
+
+
+def _loop_alignment(traces, start_indices, nsamples):
+    """Per-trial slicing with NaN masking outside of the recording"""
+    aligned = np.full((len(start_indices), traces.shape[0], nsamples), np.nan)
+    for i, start in enumerate(start_indices):
+        for j in range(nsamples):
+            if 0 <= start + j < traces.shape[1]:
+                aligned[i, :, j] = traces[:, start + j]
+    return aligned
+
+
+def test_window_sampler():
+    rng = np.random.default_rng(0)
+    traces = rng.normal(size=(5, 200))
+    start_indices = np.array([-3, 0, 50, 190, 199, 250])
+
+    aligned = alignment.WindowSampler.from_start_indices(
+        start_indices, 12, traces.shape[1]
+    ).sample(traces)
+    expected = _loop_alignment(traces, start_indices, 12)
+
+    assert aligned.shape == (6, 5, 12)
+    np.testing.assert_array_equal(aligned, expected)
+
+
+def test_alignment_windows():
+    event_times = np.array([2.0, np.nan, 11.5])
+    start_times = np.array([1.0, 5.0, 10.0])
+    end_times = np.array([4.0, 9.0, 12.0])
+
+    valid, min_limit, max_limit = alignment.get_alignment_windows(
+        event_times, start_times, end_times
+    )
+
+    assert valid.tolist() == [True, False, True]
+    assert min_limit == 1.5
+    assert max_limit == 2.0
+
+    start_indices = alignment.get_window_start_indices(
+        event_times[valid], min_limit, frame_rate=10
+    )
+    assert start_indices.tolist() == [5, 100]
+
+
+def test_extend_aligned_timestamps():
+    frame_rate = 10
+    aligned_timestamps = np.arange(-1.0, 2.0, 1 / frame_rate)
+
+    same, prepended = alignment.extend_aligned_timestamps(
+        aligned_timestamps, 0.5, 1.5, frame_rate
+    )
+    assert prepended == 0
+    np.testing.assert_array_equal(same, aligned_timestamps)
+
+    extended, prepended = alignment.extend_aligned_timestamps(
+        aligned_timestamps, 1.25, 2.3, frame_rate
+    )
+    assert prepended == 3
+    assert len(extended) == len(np.arange(-1.25, 2.3, 1 / frame_rate))
+    np.testing.assert_array_equal(
+        extended[prepended : prepended + len(aligned_timestamps)], aligned_timestamps
+    )
+    np.testing.assert_allclose(np.diff(extended), 1 / frame_rate)
+    assert extended[0] <= -1.25 and extended[-1] + 1 / frame_rate >= 2.3
+
+    # existing windows keep their frames when realigned on the extended grid
+    event_times = np.array([3.0, 7.45])
+    np.testing.assert_array_equal(
+        alignment.get_window_start_indices(event_times, -extended[0], frame_rate)
+        + prepended,
+        alignment.get_window_start_indices(
+            event_times, -aligned_timestamps[0], frame_rate
+        ),
+    )
+
+
+def test_chunked_window_gather():
+    rng = np.random.default_rng(1)
+    traces = rng.normal(size=(7, 500))
+    start_indices = np.array([-10, 40, 45, 300, 490])
+    nsamples = 30
+
+    expected = _loop_alignment(traces, start_indices, nsamples)
+
+    sampler = alignment.WindowSampler.from_start_indices(
+        start_indices, nsamples, traces.shape[1]
+    )
+    frames, reduced_sampler = sampler.reduce()
+    chunk_size = alignment.get_roi_chunk_size(
+        memory_budget=3 * (traces.shape[1] + len(frames)) * 8,
+        nframes=traces.shape[1],
+        nwindow_frames=len(frames),
+    )
+    assert chunk_size == 3
+    assert len(frames) < traces.shape[1]
+
+    aligned = np.empty((len(start_indices), traces.shape[0], nsamples))
+    for start in range(0, traces.shape[0], chunk_size):
+        roi_slice = slice(start, start + chunk_size)
+        reduced_sampler.sample(traces[roi_slice][:, frames], out=aligned[:, roi_slice])
+
+    np.testing.assert_array_equal(aligned, expected)
+
+
+def test_binned_psth():
+    rng = np.random.default_rng(2)
+    aligned_timestamps = np.arange(-1, 1, 0.1)
+    aligned = rng.normal(size=(8, 4, len(aligned_timestamps)))
+    aligned[0, 1] = np.nan  # ROI without data in one trial
+    aligned[1, :, :3] = np.nan
+
+    bin_centers, psth, psth_sem, trial_counts = alignment.compute_binned_psth(
+        aligned, aligned_timestamps, bin_size=0.5
+    )
+
+    np.testing.assert_allclose(bin_centers, [-0.75, -0.25, 0.25, 0.75])
+    assert psth.shape == psth_sem.shape == (4, 4)
+    assert trial_counts.tolist() == [8, 7, 8, 8]
+
+    in_bin = (aligned_timestamps >= -0.5 - 1e-9) & (aligned_timestamps < -1e-9)
+    trial_means = np.nanmean(aligned[:, 2, in_bin], axis=-1)
+    np.testing.assert_allclose(psth[2, 1], np.mean(trial_means))
+    np.testing.assert_allclose(psth_sem[2, 1], np.std(trial_means, ddof=1) / np.sqrt(8))
+
+
+def test_timestamp_interpolation():
+    rng = np.random.default_rng(3)
+    # 30 Hz acquisition with dropped frames
+    frame_times = np.delete(np.arange(600) / 30, [50, 51, 52, 300])
+    traces = rng.normal(size=(4, len(frame_times)))
+    event_times = np.array([0.05, 5.0, 19.9])
+    aligned_timestamps = np.arange(-0.5, 1.0, 1 / 30)
+
+    sampler = alignment.WindowSampler.from_timestamps(
+        frame_times, event_times, aligned_timestamps
+    )
+    aligned = sampler.sample(traces)
+
+    sample_times = event_times[:, None] + aligned_timestamps
+    expected = np.stack(
+        [
+            np.stack(
+                [
+                    np.interp(times, frame_times, trace, left=np.nan, right=np.nan)
+                    for trace in traces
+                ]
+            )
+            for times in sample_times
+        ]
+    )
+    np.testing.assert_allclose(aligned, expected)
+
+    frames, reduced_sampler = sampler.reduce()
+    np.testing.assert_array_equal(reduced_sampler.sample(traces[:, frames]), aligned)
+
+
+def _loop_trialized_event_times(trials, alignment_times, start_times, end_times):
+    """Per-trial event selection of trial.get_trialized_alignment_event_times"""
+    windows = []
+    for trial_start, trial_stop in trials:
+        events = [t for t in alignment_times if trial_start <= t <= trial_stop]
+        if not events:
+            windows.append((np.nan, np.nan, np.nan))
+            continue
+        event_time = max(events)
+        prior = [t for t in start_times if t < event_time]
+        following = [t for t in end_times if t > event_time]
+        windows.append(
+            (
+                max(max(prior), trial_start) if prior else trial_start,
+                event_time,
+                min(min(following), trial_stop) if following else trial_stop,
+            )
+        )
+    return np.array(windows).T
+
+
+def test_trialized_event_times():
+    rng = np.random.default_rng(4)
+    trials = np.stack([np.arange(0, 100, 10), np.arange(0, 100, 10) + 8], axis=1)
+    alignment_times = rng.uniform(0, 100, 15).round(1)
+    start_times = rng.uniform(0, 100, 10).round(1)
+    end_times = rng.uniform(0, 100, 10).round(1)
+
+    windows = alignment.get_trialized_event_times(
+        trials[:, 0], trials[:, 1], alignment_times, start_times, end_times
+    )
+    expected = _loop_trialized_event_times(
+        trials, alignment_times, start_times, end_times
+    )
+    np.testing.assert_array_equal(np.stack(windows), expected)
+
+    shifted = alignment.get_trialized_event_times(
+        trials[:, 0],
+        trials[:, 1],
+        alignment_times,
+        start_times,
+        end_times,
+        time_shifts=(-1.0, 0.5, 2.0),
+    )
+    np.testing.assert_allclose(
+        np.stack(shifted), expected + np.array([[-1.0], [0.5], [2.0]])
+    )
+
+
+def test_merged_samplers():
+    rng = np.random.default_rng(5)
+    traces = rng.normal(size=(3, 300))
+    samplers = [
+        alignment.WindowSampler.from_start_indices([-5, 100, 290], 20, 300),
+        alignment.WindowSampler.from_start_indices([50, 60], 8, 300),
+        alignment.WindowSampler.from_start_indices([400], 5, 300),
+    ]
+
+    frames, merged = alignment.WindowSampler.merge(samplers)
+
+    for sampler, merged_sampler in zip(samplers, merged):
+        np.testing.assert_array_equal(
+            merged_sampler.sample(traces[:, frames]), sampler.sample(traces)
+        )
@@ -0,0 +1,118 @@
+import numpy as np
+
+
+def test_extend_activity_alignment(alignment_condition):
+    from workflow_miniscope.analysis import (
+        ActivityAlignment,
+        ActivityAlignmentCondition,
+    )
+
+    key = alignment_condition
+    ActivityAlignment.populate(key)
+    (
+        previous_timestamps,
+        trial_ids,
+        mask_ids,
+        previous_activities,
+    ) = ActivityAlignment().fetch_aligned_activities(key)
+    assert trial_ids.tolist() == [1, 2]
+    assert not (ActivityAlignment & key).extend()
+
+    # the third trial widens the window: all trials are realigned on a longer grid
+    ActivityAlignmentCondition.Trial.insert1({**key, "trial_id": 3})
+    assert len((ActivityAlignment & key).extend()) == 1
+
+    (
+        aligned_timestamps,
+        trial_ids,
+        _,
+        aligned_activities,
+    ) = ActivityAlignment().fetch_aligned_activities(key)
+    assert trial_ids.tolist() == [1, 2, 3]
+    # 4 frames earlier, give or take the rounding of the event times
+    prepended = int(np.argmin(np.abs(aligned_timestamps - previous_timestamps[0])))
+    assert prepended in (4, 5)
+    previous = slice(prepended, prepended + len(previous_timestamps))
+    np.testing.assert_allclose(aligned_timestamps[previous], previous_timestamps)
+    np.testing.assert_array_equal(
+        aligned_activities[:2, :, previous], previous_activities
+    )
+    assert not np.isnan(aligned_activities[2]).all()
+
+
+def test_populate_activity_alignments(alignment_condition):
+    from workflow_miniscope.analysis import (
+        ActivityAlignment,
+        ActivityAlignmentCondition,
+        populate_activity_alignments,
+    )
+
+    key = alignment_condition
+    # a condition without trials has no window and is skipped
+    empty_key = {**key, "trial_condition": "empty"}
+    ActivityAlignmentCondition.insert1(empty_key)
+
+    result = populate_activity_alignments([key, empty_key], suppress_errors=True)
+
+    assert result == {"success_count": 1, "error_list": []}
+    assert ActivityAlignment & key
+    assert not ActivityAlignment & empty_key
+    (ActivityAlignmentCondition & empty_key).delete()
+
+
+def test_fetch_aligned_activities_layouts(alignment_condition, monkeypatch):
+    import datajoint as dj
+
+    from workflow_miniscope.analysis import ActivityAlignment
+    from workflow_miniscope.pipeline import miniscope
+
+    key = alignment_condition
+    mask = (miniscope.Activity.Trace & key).fetch("mask", limit=1)[0]
+    fetched = {}
+    for storage in ("trial", "tensor"):
+        monkeypatch.setitem(
+            dj.config,
+            "custom",
+            {**dj.config.get("custom", {}), "activity_alignment.storage": storage},
+        )
+        ActivityAlignment.populate(key)
+        fetched[storage] = ActivityAlignment().fetch_aligned_activities(
+            key, rois=[-1, mask], trials=[2, 99]
+        )
+        (ActivityAlignment & key).delete()
+
+    for trial_layout, tensor_layout in zip(fetched["trial"], fetched["tensor"]):
+        np.testing.assert_array_equal(trial_layout, tensor_layout)
+    _, trial_ids, mask_ids, aligned_activities = fetched["tensor"]
+    assert trial_ids.tolist() == [2, 99]
+    assert mask_ids[0] == -1
+    assert np.isnan(aligned_activities[:, 0]).all()
+    assert np.isnan(aligned_activities[1]).all()
+    assert not np.isnan(aligned_activities[0, 1]).all()
+
+
+def test_gallery_cache_after_extend(alignment_condition, tmp_path):
+    from workflow_miniscope.analysis import (
+        ActivityAlignment,
+        ActivityAlignmentCondition,
+    )
+
+    key = alignment_condition
+    ActivityAlignment.populate(key)
+    mask_ids = ActivityAlignment().fetch_aligned_activities(key)[2][:1].tolist()
+
+    paths = ActivityAlignment().plot_aligned_activities_batch(
+        key, rois=mask_ids, processes=1, cache_dir=tmp_path
+    )
+    assert paths == ActivityAlignment().plot_aligned_activities_batch(
+        key, rois=mask_ids, processes=1, cache_dir=tmp_path
+    )
+
+    # images of the extended condition are rendered again
+    ActivityAlignmentCondition.Trial.insert1({**key, "trial_id": 3})
+    (ActivityAlignment & key).extend()
+    extended_paths = ActivityAlignment().plot_aligned_activities_batch(
+        key, rois=mask_ids, processes=1, cache_dir=tmp_path
+    )
+    assert extended_paths != paths
+    assert all(path.exists() for path in extended_paths)
@@ -0,0 +1,22 @@
+"""Tests the local trace cache against direct fetches
+"""
+import numpy as np
+
+
+def test_trace_cache(pipeline, post_curation, tmp_path):
+    from workflow_miniscope.cache import TraceCache
+
+    miniscope = pipeline["miniscope"]
+    query = miniscope.Activity.Trace & miniscope.Activity.fetch("KEY", limit=1)[0]
+    keys, traces = query.fetch("KEY", "activity_trace", order_by="mask")
+
+    cache = TraceCache(tmp_path, max_bytes=10 * 1024**2)
+    cached_keys, cached_traces = cache.fetch(query, "activity_trace", order_by="mask")
+    assert cache.stats["misses"] == len(keys) and cache.stats["hits"] == 0
+
+    cached_keys, cached_traces = cache.fetch(query, "activity_trace", order_by="mask")
+    assert cache.stats["hits"] == len(keys), "Second fetch did not hit the cache"
+
+    assert cached_keys == list(keys)
+    for trace, cached_trace in zip(traces, cached_traces):
+        np.testing.assert_array_equal(trace, cached_trace)
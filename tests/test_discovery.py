@@ -0,0 +1,85 @@
+import json
+import os
+
+import datajoint as dj
+import pytest
+
+
+def test_discover_sessions(tmp_path, monkeypatch):
+    from workflow_miniscope import discovery
+
+    monkeypatch.setattr(discovery, "MTIME_GRACE", 0)
+    root = tmp_path / "root"
+    index_path = tmp_path / "index.json"
+
+    def add_session(session_dir):
+        session_path = root / session_dir
+        session_path.mkdir(parents=True)
+        for name in ("0.avi", "1.avi", "timeStamps.csv", "notes.txt"):
+            (session_path / name).touch()
+        (session_path / "metaData.json").write_text(
+            json.dumps(
+                {
+                    "recordingStartTime": dict(
+                        year=2023, month=5, day=11, hour=12, minute=0, second=0
+                    )
+                }
+            )
+        )
+
+    add_session("subject1/session1")
+    (root / "subject1" / "behavior").mkdir()
+
+    candidates = discovery.discover_sessions(
+        [root], index_path=index_path, known_session_dirs=set()
+    )
+    assert len(candidates) == 1
+    assert candidates[0]["subject"] == "subject1"
+    assert candidates[0]["session_dir"] == "subject1/session1"
+    assert candidates[0]["acq_software"] == "Miniscope-DAQ-V4"
+    assert candidates[0]["files"] == ["0.avi", "1.avi"]
+    assert str(candidates[0]["session_datetime"]) == "2023-05-11 12:00:00"
+
+    # an unchanged tree is only stat-ed
+    index = discovery.DirectoryIndex(index_path)
+    assert index.scan([root]) == []
+    assert index.checked == 4
+
+    # a new session is found by listing only the changed directories
+    add_session("subject1/session2")
+    past = os.stat(root / "subject1").st_mtime_ns + 10**9
+    os.utime(root / "subject1", ns=(past, past))
+    index = discovery.DirectoryIndex(index_path)
+    assert sorted(index.scan([root])) == [
+        (root / "subject1").as_posix(),
+        (root / "subject1" / "session2").as_posix(),
+    ]
+    candidates = discovery.discover_sessions(
+        [root], index_path=index_path, known_session_dirs={"subject1/session1"}
+    )
+    assert [c["session_dir"] for c in candidates] == ["subject1/session2"]
+
+
+def test_discover_sessions_default_roots(tmp_path, monkeypatch):
+    from workflow_miniscope import discovery
+
+    root = tmp_path / "root"
+    session_path = root / "subject2" / "session1"
+    session_path.mkdir(parents=True)
+    for name in ("0.avi", "timestamp.dat"):
+        (session_path / name).touch()
+
+    # the configured root is a single string, as set from the environment
+    monkeypatch.setitem(dj.config, "custom", {"miniscope_root_data_dir": str(root)})
+    candidates = discovery.discover_sessions(
+        index_path=tmp_path / "index.json", known_session_dirs=set()
+    )
+    assert [c["session_dir"] for c in candidates] == ["subject2/session1"]
+    assert candidates[0]["root_dir"] == root.as_posix()
+    assert candidates[0]["acq_software"] == "Miniscope-DAQ-V3"
+
+    monkeypatch.setitem(dj.config, "custom", {})
+    with pytest.raises(ValueError):
+        discovery.discover_sessions(
+            index_path=tmp_path / "index.json", known_session_dirs=set()
+        )
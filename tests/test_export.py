@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+
+def test_memmap_dataset(tmp_path):
+    import h5py
+
+    from workflow_miniscope.export import memmap_dataset
+
+    traces = np.random.default_rng(0).random((5, 100))
+    with h5py.File(tmp_path / "export.h5", "w") as f:
+        f.create_dataset("0/0/0/fluorescence/traces", data=traces)
+        f.create_dataset("chunked", data=traces, chunks=(1, 100), compression="gzip")
+
+    data = memmap_dataset(tmp_path / "export.h5", "0/0/0/fluorescence/traces")
+    np.testing.assert_array_equal(data[3], traces[3])
+    with pytest.raises(ValueError):
+        memmap_dataset(tmp_path / "export.h5", "chunked")
+
+
+def test_export_session(pipeline, post_curation, tmp_path):
+    import h5py
+
+    from workflow_miniscope.export import export_session
+
+    miniscope = pipeline["miniscope"]
+    session = pipeline["session"]
+
+    session_key = (session.Session & miniscope.Curation).fetch("KEY", limit=1)[0]
+    path = tmp_path / "session.h5"
+    assert export_session(session_key, path, batch_bytes=2**16)
+    assert not export_session(session_key, path)
+
+    curation_key = (miniscope.Curation & session_key).fetch("KEY", limit=1)[0]
+    mask_ids, fluorescence = (miniscope.Fluorescence.Trace & curation_key).fetch(
+        "mask", "fluorescence", order_by="mask"
+    )
+    group = "/".join(
+        str(curation_key[attr])
+        for attr in ("recording_id", "paramset_id", "curation_id")
+    )
+    with h5py.File(path, "r") as f:
+        np.testing.assert_array_equal(f[f"{group}/fluorescence/mask_ids"], mask_ids)
+        np.testing.assert_array_equal(
+            f[f"{group}/fluorescence/traces"][2], fluorescence[2]
+        )
+        offsets = f[f"{group}/masks/offsets"][:]
+        xpix = (
+            miniscope.Segmentation.Mask & curation_key & {"mask": mask_ids[1]}
+        ).fetch1("mask_xpix")
+        np.testing.assert_array_equal(
+            f[f"{group}/masks/xpix"][offsets[1] : offsets[2]], xpix
+        )
+
+
+def test_export_session_repopulated(
+    pipeline, alignment_condition, tmp_path, monkeypatch
+):
+    import datajoint as dj
+
+    from workflow_miniscope.analysis import ActivityAlignment
+    from workflow_miniscope.export import export_session
+
+    miniscope = pipeline["miniscope"]
+    session = pipeline["session"]
+
+    monkeypatch.setitem(
+        dj.config,
+        "custom",
+        {**dj.config.get("custom", {}), "activity_alignment.storage": "tensor"},
+    )
+    ActivityAlignment.populate(alignment_condition)
+    session_key = (session.Session & alignment_condition).fetch1("KEY")
+    path = tmp_path / "session.h5"
+    assert export_session(session_key, path)
+
+    # repopulate rows under the same keys with different blob contents
+    for table, attribute in (
+        (miniscope.MotionCorrection.Summary, "average_image"),
+        (ActivityAlignment.AlignedActivityChunk, "aligned_activities"),
+    ):
+        query = table & session_key
+        row = query.fetch(limit=1, as_dict=True)[0]
+        row_key = {attr: row[attr] for attr in query.primary_key}
+        try:
+            (query & row_key).delete_quick()
+            query.insert1({**row, attribute: row[attribute] + 1})
+            assert export_session(session_key, path)
+            assert not export_session(session_key, path)
+        finally:
+            (query & row_key).delete_quick()
+            query.insert1(row)
+    (ActivityAlignment & alignment_condition).delete()
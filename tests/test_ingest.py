@@ -2,8 +2,11 @@
     1. Assert length of populating data conftest
     2. Assert exact matches of inserted data fore key tables
 """
+import pytest
 from element_interface.utils import dict_to_uuid
 
+from workflow_miniscope.ingest import read_manifest
+
 
 def test_ingest_subjects(pipeline, ingest_data):
     session = pipeline["session"]
@@ -31,3 +34,25 @@ def test_paramset_insert(pipeline, caiman_paramset):
     assert processing_method == params_dict["processing_method"]
     assert paramset_desc == params_dict["paramset_desc"]
     assert dict_to_uuid(params_caiman) == paramset_hash
+
+
+def test_read_manifest(tmp_path):
+    manifest = tmp_path / "sessions.csv"
+    manifest.write_text(
+        "subject, session_dir, session_datetime, session_note\n"
+        "subject1, subject1/session1, 2023-05-11 12:00:00,\n"
+        "subject1, , 2023-05-12 12:00:00, missing directory\n"
+    )
+    required = ["subject", "session_dir", "session_datetime"]
+
+    with pytest.raises(ValueError, match="line 3: empty \\['session_dir'\\]"):
+        read_manifest(manifest, required=required, optional=["session_note"])
+
+    manifest.write_text("\n".join(manifest.read_text().splitlines()[:2]))
+    ((line, row),) = read_manifest(manifest, required=required)
+    assert line == 2
+    assert row == {
+        "subject": "subject1",
+        "session_dir": "subject1/session1",
+        "session_datetime": "2023-05-11 12:00:00",
+    }
@@ -0,0 +1,45 @@
+import numpy as np
+
+
+def write_movie(path, frames):
+    import cv2
+
+    writer = cv2.VideoWriter(
+        str(path), cv2.VideoWriter_fourcc(*"FFV1"), 30, frames.shape[:0:-1], False
+    )
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+
+
+def test_miniscope_movie(tmp_path):
+    from workflow_miniscope.movie import MiniscopeMovie
+
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 255, size=(42, 12, 16), dtype=np.uint8)
+    # files are ordered numerically, not by name
+    file_paths = [tmp_path / "10.avi", tmp_path / "2.avi"]
+    write_movie(file_paths[1], frames[:25])
+    write_movie(file_paths[0], frames[25:])
+
+    movie = MiniscopeMovie(
+        file_paths, chunk_size=4, max_workers=3, cache_dir=tmp_path / "cache"
+    )
+    assert movie.shape == frames.shape
+    np.testing.assert_array_equal(np.asarray(movie), frames)
+    np.testing.assert_array_equal(movie[-1], frames[-1])
+    np.testing.assert_array_equal(movie[20:30], frames[20:30])
+    np.testing.assert_array_equal(movie[3:40:7, 2:5], frames[3:40:7, 2:5])
+    np.testing.assert_array_equal(
+        movie[[30, 2, 3, -1, 3], :, 0], frames[[30, 2, 3, -1, 3], :, 0]
+    )
+    assert not movie.is_cached
+
+    chunks = list(movie.iter_chunks(chunk_size=10))
+    assert [chunk_start for chunk_start, _ in chunks] == [0, 10, 20, 30, 40]
+    np.testing.assert_array_equal(np.concatenate([c for _, c in chunks]), frames)
+    assert movie.is_cached
+
+    cached_movie = MiniscopeMovie(file_paths, cache_dir=tmp_path / "cache")
+    assert cached_movie.is_cached
+    np.testing.assert_array_equal(cached_movie[[5, 41]], frames[[5, 41]])
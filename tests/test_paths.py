@@ -0,0 +1,47 @@
+from pathlib import Path
+
+import pytest
+
+
+def test_path_resolver(tmp_path, monkeypatch):
+    from workflow_miniscope.paths import PathResolver
+
+    roots = [tmp_path / "root0", tmp_path / "root1"]
+    for root in roots:
+        (root / "subject1").mkdir(parents=True)
+    (roots[1] / "subject1" / "0.avi").touch()
+    cache_path = tmp_path / "path_cache.json"
+
+    resolver = PathResolver(roots, cache_path=cache_path, negative_ttl=3600)
+    assert resolver.resolve("subject1/0.avi") == roots[1] / "subject1" / "0.avi"
+    assert resolver.resolve_many(["subject1/1.avi"], missing_ok=True) == [None]
+
+    # unresolved paths are remembered until the negative cache expires
+    (roots[0] / "subject1" / "1.avi").touch()
+    with pytest.raises(FileNotFoundError):
+        resolver.resolve("subject1/1.avi")
+    resolver.invalidate("subject1/1.avi")
+    assert resolver.resolve_many(["subject1/0.avi", "subject1/1.avi"]) == [
+        roots[1] / "subject1" / "0.avi",
+        roots[0] / "subject1" / "1.avi",
+    ]
+    resolver.save()
+
+    # saved roots are reused by a new resolver, and re-probed if a file moved
+    (roots[1] / "subject1" / "0.avi").rename(roots[0] / "subject1" / "0.avi")
+    resolver = PathResolver(roots, cache_path=cache_path)
+    assert resolver._roots == {"subject1/0.avi": roots[1], "subject1/1.avi": roots[0]}
+    assert resolver.resolve("subject1/0.avi") == roots[0] / "subject1" / "0.avi"
+    assert resolver.resolve("subject1/1.avi") == roots[0] / "subject1" / "1.avi"
+
+    # cached roots are checked on every call
+    (roots[0] / "subject1" / "0.avi").rename(roots[1] / "subject1" / "0.avi")
+    assert resolver.resolve("subject1/0.avi") == roots[1] / "subject1" / "0.avi"
+
+    # paths that exist as given are returned as is, like the element
+    absolute_path = roots[1] / "subject1" / "0.avi"
+    assert resolver.resolve(absolute_path) == absolute_path
+    (tmp_path / "local").mkdir()
+    (tmp_path / "local" / "2.avi").touch()
+    monkeypatch.chdir(tmp_path)
+    assert resolver.resolve("local/2.avi") == Path("local/2.avi")
@@ -75,6 +75,36 @@ def test_miniscope_quality_metrics_populate(pipeline):
     assert round(trace_metrics["variance"], 2) == 56.58
 
 
+def test_trace_quality_metrics_batch(pipeline):
+    import datetime
+
+    import numpy as np
+
+    from workflow_miniscope.quality import populate_trace_quality_metrics
+
+    miniscope = pipeline["miniscope"]
+
+    key = dict(
+        subject="subject1",
+        session_datetime=datetime.datetime(2023, 5, 11, 12, 00, 00),
+        recording_id=0,
+        paramset_id=0,
+        curation_id=0,
+    )
+
+    miniscope.ProcessingQualityMetrics.populate(key)
+    expected = (miniscope.ProcessingQualityMetrics.Trace & key).fetch(
+        "skewness", "variance", order_by="mask"
+    )
+    (miniscope.ProcessingQualityMetrics & key).delete()
+
+    assert populate_trace_quality_metrics(key, chunk_bytes=2**20) == 1
+    metrics = (miniscope.ProcessingQualityMetrics.Trace & key).fetch(
+        "skewness", "variance", order_by="mask"
+    )
+    np.testing.assert_allclose(metrics, expected, rtol=1e-4)
+
+
 def test_plots(pipeline, plots, post_curation):
     metrics = pipeline["miniscope_report"].QualityMetrics
     qc = plots["qc"]
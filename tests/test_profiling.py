@@ -0,0 +1,45 @@
+import time
+
+import numpy as np
+
+
+def test_profiled_make(tmp_path):
+    from datajoint import blob
+
+    from workflow_miniscope import profiling
+
+    class Table:
+        full_table_name = "`test`.`table`"
+
+        def make(self, key):
+            packed = blob.pack(np.random.default_rng(0).random(1000))
+            blob.unpack(packed)
+            deadline = time.perf_counter() + 0.2
+            while time.perf_counter() < deadline:
+                pass
+            if key["id"]:
+                raise ValueError("failed make")
+
+    path = tmp_path / "profile.jsonl"
+    profiling.instrument([Table], path=path, sampling_interval=0.01)
+    profiling.instrument([Table], path=path)  # instrumented once
+    Table().make({"id": 0})
+    try:
+        Table().make({"id": 1})
+    except ValueError:
+        pass
+
+    stats = profiling.load_stats(path)
+    assert [call["status"] for call in stats] == ["ok", "ValueError"]
+    assert stats[0]["key"] == {"id": 0}
+    assert stats[0]["wall_time"] >= 0.2 and stats[0]["cpu_time"] > 0.1
+    assert stats[0]["bytes_inserted"] == stats[0]["bytes_fetched"] > 5000
+    assert stats[0]["peak_rss"] > 0
+    assert any("test_profiling.py:make" in stack for stack in stats[0]["profile"])
+
+    (summary,) = profiling.summarize_stats(stats)
+    assert summary["calls"] == 2 and summary["errors"] == 1
+    assert len(profiling.summarize_stats(stats, by="key")) == 2
+    report = profiling.report(path, table="Table")
+    assert report.splitlines()[1].startswith("Table")
+    assert "Most sampled stacks of Table" in report
@@ -0,0 +1,63 @@
+import numpy as np
+
+from workflow_miniscope import pyramid
+
+
+def test_trace_pyramid():
+    rng = np.random.default_rng(0)
+    traces = rng.normal(size=(3, 1001))
+    traces[1, 10] = np.nan
+
+    levels = list(pyramid.iter_pyramid(traces, min_bins=10))
+
+    assert len(levels) == pyramid.get_pyramid_nlevels(traces.shape[1], min_bins=10)
+    assert levels[-1][1].shape[1] <= 10 < levels[-2][1].shape[1]
+    for level, trace_min, trace_max, trace_mean in levels:
+        size = 2**level
+        bins = [traces[:, start : start + size] for start in range(0, 1001, size)]
+        np.testing.assert_array_equal(
+            trace_min, np.stack([np.nanmin(b, axis=1) for b in bins], axis=1)
+        )
+        np.testing.assert_array_equal(
+            trace_max, np.stack([np.nanmax(b, axis=1) for b in bins], axis=1)
+        )
+        np.testing.assert_allclose(
+            trace_mean, np.stack([b.mean(axis=1) for b in bins], axis=1)
+        )
+
+
+def test_pyramid_level():
+    nlevels = pyramid.get_pyramid_nlevels(111000)
+
+    assert pyramid.get_pyramid_level(500, 1000, nlevels) == 0
+    for nframes in (1500, 111000, 20000):
+        level = pyramid.get_pyramid_level(nframes, 1000, nlevels)
+        nbins = -(-nframes // 2**level)
+        assert 1000 <= nbins <= 2000
+
+    start_bin, stop_bin = pyramid.get_bin_range(3, 17, 41)
+    assert (start_bin, stop_bin) == (2, 6)
+
+    blocks = pyramid.split_blocks(np.arange(10)[None], block_size=4)
+    assert [block.tolist() for block in blocks] == [
+        [[0, 1, 2, 3]],
+        [[4, 5, 6, 7]],
+        [[8, 9]],
+    ]
+
+
+def test_pyramid_blocks():
+    traces = np.arange(20, dtype=float).reshape(2, 10)
+
+    blocks = list(pyramid.iter_blocks(traces, block_size=4, min_bins=3))
+
+    levels = [level for level, *_ in blocks]
+    assert levels == [0, 0, 0, 1, 1, 2]
+    for level, block, trace_min, trace_max, trace_mean in blocks:
+        assert (trace_min is None) == (trace_max is None) == (level == 0)
+        assert trace_mean.shape[0] == 2
+    np.testing.assert_array_equal(
+        np.concatenate([mean for level, _, _, _, mean in blocks if level == 0], 1),
+        traces,
+    )
+    np.testing.assert_array_equal(blocks[3][2], [[0, 2, 4, 6], [10, 12, 14, 16]])
@@ -0,0 +1,43 @@
+def test_memory_scheduling():
+    from workflow_miniscope.scheduler import (
+        BASE_MEMORY,
+        estimate_processing_memory,
+        get_correction_factor,
+        pack_jobs,
+    )
+
+    params = {"pw_rigid": False, "rf": None}
+    small = estimate_processing_memory(1000, 600, 600, params)
+    assert small == BASE_MEMORY + 2 * 1000 * 600 * 600 * 4
+    assert estimate_processing_memory(1000, 600, 600, params, "load") == BASE_MEMORY
+    assert estimate_processing_memory(1000, 600, 600, {"pw_rigid": True}) > small
+    assert estimate_processing_memory(1000, 600, 600, {"rf": 40, "stride": 20}) > small
+
+    assert get_correction_factor([], []) == 1.0
+    assert get_correction_factor([10, 10, 10], [15, 15, 15]) == 1.5
+
+    # largest first, smaller jobs filling the remaining memory
+    assert pack_jobs([3, 8, 5, 2], available=10, slots=4) == [1, 3]
+    assert pack_jobs([3, 8, 5, 2], available=10, slots=1) == [1]
+    assert pack_jobs([12, 5], available=10, slots=2) == [1]
+    # a job above the whole budget runs alone once nothing else is running
+    assert pack_jobs([12, 5], available=10, slots=2, idle=True) == [0]
+    assert pack_jobs([3], available=10, slots=0) == []
+
+
+def test_fresh_process_executor():
+    import os
+
+    import pytest
+
+    from workflow_miniscope.process import FreshProcessExecutor
+
+    executor = FreshProcessExecutor()
+    pids = [executor.submit(os.getpid) for _ in range(2)]
+    failing = executor.submit(int, "not a number")
+    executor.shutdown(wait=True)
+
+    pids = [future.result(timeout=60) for future in pids]
+    assert len(set(pids)) == 2 and os.getpid() not in pids
+    with pytest.raises(RuntimeError, match="ValueError"):
+        failing.result(timeout=60)
@@ -0,0 +1,61 @@
+import numpy as np
+
+from workflow_miniscope import spatial
+
+
+def _disk(cx, cy, radius=3):
+    y, x = np.mgrid[-radius : radius + 1, -radius : radius + 1]
+    inside = x**2 + y**2 <= radius**2
+    return x[inside] + cx, y[inside] + cy
+
+
+def test_mask_index_query():
+    rng = np.random.default_rng(0)
+    pixels = [_disk(*center) for center in rng.integers(5, 95, size=(200, 2))]
+    centroids, bboxes = spatial.get_mask_geometry(
+        [x for x, _ in pixels],
+        [y for _, y in pixels],
+        [np.ones(len(x)) for x, _ in pixels],
+    )
+    index = spatial.MaskIndex(centroids, bboxes)
+
+    for x, y, radius in [(50, 50, 0), (10.5, 90, 4), (0, 0, 20)]:
+        dx = np.maximum(np.maximum(bboxes[:, 0] - x, x - bboxes[:, 2]), 0)
+        dy = np.maximum(np.maximum(bboxes[:, 1] - y, y - bboxes[:, 3]), 0)
+        expected = np.flatnonzero(np.hypot(dx, dy) <= radius)
+        np.testing.assert_array_equal(index.query(x, y, radius), expected)
+
+
+def test_match_masks():
+    rng = np.random.default_rng(1)
+    image = rng.normal(size=(100, 120))
+    # target session moved by 4 pixels down and 3 pixels left
+    target_image = np.roll(image, (4, -3), axis=(0, 1))
+    shift = spatial.estimate_shift(image, target_image)
+    assert shift == (3, -4)
+
+    centers = np.array([[20, 20], [40, 60], [80, 30], [60, 75]])
+    reference_pixels = [_disk(*center) for center in centers]
+    # the third cell is missing in the target session, which has a new cell
+    target_centers = np.vstack([centers[[0, 1, 3]], [[10, 85]]]) - shift
+    target_centers[0] += 1  # segmented one pixel off
+    target_pixels = [_disk(*center) for center in target_centers]
+
+    reference_centroids, reference_bboxes = spatial.get_mask_geometry(
+        *zip(*reference_pixels), [np.ones(len(x)) for x, _ in reference_pixels]
+    )
+    target_centroids, _ = spatial.get_mask_geometry(
+        *zip(*target_pixels), [np.ones(len(x)) for x, _ in target_pixels]
+    )
+    reference, target, distance, overlap = spatial.match_masks(
+        spatial.MaskIndex(reference_centroids, reference_bboxes),
+        reference_pixels,
+        target_centroids,
+        target_pixels,
+        shift=shift,
+    )
+
+    assert dict(zip(reference.tolist(), target.tolist())) == {0: 0, 1: 1, 3: 2}
+    np.testing.assert_allclose(distance[reference == 0], np.sqrt(2))
+    np.testing.assert_allclose(distance[reference != 0], 0)
+    assert overlap[reference == 1] == 1 and 0.2 < overlap[reference == 0] < 1
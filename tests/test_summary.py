@@ -0,0 +1,55 @@
+import numpy as np
+
+from .test_movie import write_movie
+
+
+def test_summary_images(tmp_path):
+    from workflow_miniscope.movie import MiniscopeMovie
+    from workflow_miniscope.summary import (
+        get_summary_images,
+        merge_summaries,
+        summarize_frames,
+        summarize_movie,
+    )
+
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 255, size=(50, 10, 12), dtype=np.uint8)
+    data = frames.astype(float)
+    mean, std = data.mean(axis=0), data.std(axis=0)
+    z = (data - mean) / std
+
+    correlation = np.zeros_like(mean)
+    for i in range(frames.shape[1]):
+        for j in range(frames.shape[2]):
+            neighbours = [
+                (i + di, j + dj)
+                for di in (-1, 0, 1)
+                for dj in (-1, 0, 1)
+                if (di or dj)
+                and 0 <= i + di < frames.shape[1]
+                and 0 <= j + dj < frames.shape[2]
+            ]
+            correlation[i, j] = np.mean(
+                [np.mean(z[:, i, j] * z[:, k, m]) for k, m in neighbours]
+            )
+    noise = np.sqrt((np.diff(data, axis=0) ** 2).mean(axis=0) / 2)
+
+    images = get_summary_images(
+        merge_summaries(
+            [summarize_frames(frames[a:b]) for a, b in [(0, 7), (7, 8), (8, 50)]]
+        )
+    )
+    np.testing.assert_allclose(images["mean_image"], mean)
+    np.testing.assert_array_equal(images["max_image"], frames.max(axis=0))
+    np.testing.assert_allclose(images["std_image"], std)
+    np.testing.assert_allclose(images["correlation_image"], correlation, atol=1e-12)
+    np.testing.assert_allclose(images["pnr_image"], (frames.max(axis=0) - mean) / noise)
+
+    write_movie(tmp_path / "0.avi", frames[:30])
+    write_movie(tmp_path / "1.avi", frames[30:])
+    movie = MiniscopeMovie([tmp_path / "0.avi", tmp_path / "1.avi"])
+    for processes in (1, 2):
+        movie_images = summarize_movie(movie, processes=processes, block_bytes=4000)
+        assert movie_images.pop("nframes") == len(frames)
+        for name, image in images.items():
+            np.testing.assert_allclose(movie_images[name], image, err_msg=name)
@@ -1,5 +1,8 @@
 """Tests Element support functions
 """
+from pathlib import Path
+
+import datajoint as dj
 import pytest
 from datajoint.errors import DataJointError
 
@@ -19,6 +22,80 @@ def test_session_dir(pipeline, element_helper_functions):
     assert dir == get_session_directory(key), "Check Element get_session_directory"
 
 
+def test_session_directories(pipeline, ingest_data):
+    from workflow_miniscope.paths import (
+        clear_session_directory_cache,
+        get_miniscope_root_data_dir,
+        get_session_directories,
+        get_session_directory,
+    )
+
+    session = pipeline["session"]
+    miniscope = pipeline["miniscope"]
+
+    recording_keys = miniscope.Recording.fetch("KEY")
+    expected = [
+        (session.SessionDirectory & key).fetch1("session_dir") for key in recording_keys
+    ]
+
+    clear_session_directory_cache()
+    assert get_session_directories(recording_keys) == expected
+    assert [get_session_directory(key) for key in recording_keys] == expected
+
+    key = session.SessionDirectory.fetch("KEY", limit=1)[0]
+    session_dir = (session.SessionDirectory & key).fetch1("session_dir")
+    with dj.config(custom={**dj.config["custom"], "session_dir_cache_ttl": 0}):
+        session.SessionDirectory.update1({**key, "session_dir": "moved"})
+        assert get_session_directory(key) == "moved"
+        session.SessionDirectory.update1({**key, "session_dir": session_dir})
+        assert get_session_directory(key) == session_dir
+
+    # a cached directory that disappears from disk is re-checked before the TTL
+    # expires
+    moved_dir = Path(get_miniscope_root_data_dir()[0]) / "moved"
+    moved_dir.mkdir()
+    try:
+        with dj.config(custom={**dj.config["custom"], "session_dir_cache_ttl": 0}):
+            session.SessionDirectory.update1({**key, "session_dir": "moved"})
+            assert get_session_directory(key) == "moved"
+    finally:
+        moved_dir.rmdir()
+    with dj.config(custom={**dj.config["custom"], "session_dir_cache_ttl": 3600}):
+        session.SessionDirectory.update1({**key, "session_dir": session_dir})
+        assert get_session_directories([key]) == [session_dir]
+
+
+def test_missing_session_directory_rechecked_once(pipeline, ingest_data, monkeypatch):
+    from workflow_miniscope import paths
+
+    session = pipeline["session"]
+    key = session.SessionDirectory.fetch("KEY", limit=1)[0]
+    session_dir = (session.SessionDirectory & key).fetch1("session_dir")
+    forced = []
+    validate = paths._validate_session_directory_cache
+
+    def counted_validate(force=False):
+        forced.append(force)
+        return validate(force=force)
+
+    monkeypatch.setattr(paths, "_validate_session_directory_cache", counted_validate)
+    monkeypatch.setitem(
+        dj.config, "custom", {**dj.config["custom"], "session_dir_cache_ttl": 3600}
+    )
+    session.SessionDirectory.update1({**key, "session_dir": "not_on_this_host"})
+    try:
+        paths.clear_session_directory_cache()
+        for _ in range(3):
+            assert paths.get_session_directory(key) == "not_on_this_host"
+            assert paths.get_session_directories([key]) == ["not_on_this_host"]
+        # one full check on the first call, and one re-check of the missing
+        # directory within the TTL
+        assert forced.count(True) == 1
+    finally:
+        session.SessionDirectory.update1({**key, "session_dir": session_dir})
+        paths.clear_session_directory_cache()
+
+
 def test_loader(pipeline, element_helper_functions):
     from element_interface.caiman_loader import CaImAn
 
@@ -1,4 +1,9 @@
+import importlib
+import importlib.util
+import logging
 import os
+import time
+
 import datajoint as dj
 
 if "custom" not in dj.config:
@@ -14,4 +19,38 @@ dj.config["custom"]["miniscope_root_data_dir"] = os.getenv(
     "MINISCOPE_ROOT_DATA_DIR", dj.config["custom"].get("miniscope_root_data_dir", "")
 )
 
+dj.config["custom"]["lazy_activation"] = os.getenv(
+    "LAZY_ACTIVATION", dj.config["custom"].get("lazy_activation", False)
+)
+
+dj.config["custom"]["profile_makes"] = os.getenv(
+    "PROFILE_MAKES", dj.config["custom"].get("profile_makes", False)
+)
+
 db_prefix = dj.config["custom"].get("database.prefix", "")
+
+# (s) time spent importing each lazily resolved submodule and activating each
+# schema of `workflow_miniscope.pipeline`, in the order they happened
+import_times = {}
+
+
+def __getattr__(name: str):
+    """Import submodules on first attribute access, e.g. `workflow_miniscope.process`"""
+    if name.startswith("_") or importlib.util.find_spec(f"{__name__}.{name}") is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    start = time.perf_counter()
+    module = importlib.import_module(f"{__name__}.{name}")
+    import_times.setdefault(name, time.perf_counter() - start)
+    return module
+
+
+def report_import_times() -> dict:
+    """Log the time spent in lazy imports and schema activations
+
+    Returns:
+        import_times (dict): module or schema name to time in seconds
+    """
+    logger = logging.getLogger("datajoint")
+    for name, seconds in import_times.items():
+        logger.info(f"{name:32s} {seconds:8.3f} s")
+    return dict(import_times)
@@ -0,0 +1,452 @@
+"""Vectorized kernels for event-aligned activity.
+
+These functions operate on plain NumPy arrays and do not touch the database, so they
+can be shared by the `analysis` tables and reused outside of a populate call.
+"""
+import numpy as np
+
+
+def get_alignment_windows(
+    event_times: np.ndarray, start_times: np.ndarray, end_times: np.ndarray
+) -> tuple:
+    """Return the common alignment window for a set of trials
+
+    Args:
+        event_times (np.ndarray): (s) alignment event time of each trial, NaN if the
+            event did not occur in the trial
+        start_times (np.ndarray): (s) start of the alignment window of each trial
+        end_times (np.ndarray): (s) end of the alignment window of each trial
+
+    Returns:
+        valid (np.ndarray): boolean mask of the trials with an alignment event
+        min_limit (float): (s) window extent before the event, shared by all trials
+        max_limit (float): (s) window extent after the event, shared by all trials
+    """
+    event_times = np.asarray(event_times, dtype=float)
+    start_times = np.asarray(start_times, dtype=float)
+    end_times = np.asarray(end_times, dtype=float)
+
+    valid = ~np.isnan(event_times)
+    if not valid.any():
+        return valid, np.nan, np.nan
+
+    min_limit = np.nanmax(event_times[valid] - start_times[valid])
+    max_limit = np.nanmax(end_times[valid] - event_times[valid])
+    return valid, min_limit, max_limit
+
+
+def get_trialized_event_times(
+    trial_starts: np.ndarray,
+    trial_stops: np.ndarray,
+    alignment_times: np.ndarray,
+    start_times: np.ndarray,
+    end_times: np.ndarray,
+    time_shifts: tuple = (0.0, 0.0, 0.0),
+) -> tuple:
+    """Alignment window of every trial from the event times of a session
+
+    Vectorized equivalent of `trial.get_trialized_alignment_event_times`: the
+    alignment event is the last one within the trial, the window starts at the last
+    start event before it, but not before the trial start, and ends at the first end
+    event after it, but not after the trial stop.
+
+    Args:
+        trial_starts (np.ndarray): (s) start time of each trial
+        trial_stops (np.ndarray): (s) stop time of each trial
+        alignment_times (np.ndarray): (s) times of the events to align to
+        start_times (np.ndarray): (s) times of the events starting a window
+        end_times (np.ndarray): (s) times of the events ending a window
+        time_shifts (tuple, optional): (s) start, alignment and end time shifts of the
+            AlignmentEvent. Defaults to no shift.
+
+    Returns:
+        start_times (np.ndarray): (trials,) start of the alignment window of each trial
+        event_times (np.ndarray): (trials,) alignment event time of each trial, NaN if
+            the event did not occur in the trial
+        end_times (np.ndarray): (trials,) end of the alignment window of each trial
+    """
+    trial_starts = np.asarray(trial_starts, dtype=float)
+    trial_stops = np.asarray(trial_stops, dtype=float)
+    alignment_times, start_times, end_times = (
+        np.sort(np.asarray(times, dtype=float))
+        for times in (alignment_times, start_times, end_times)
+    )
+
+    last = np.searchsorted(alignment_times, trial_stops, side="right") - 1
+    event_times = np.full(len(trial_starts), np.nan)
+    event_times[last >= 0] = alignment_times[last[last >= 0]]
+    valid = event_times >= trial_starts
+    event_times[~valid] = np.nan
+
+    window_starts = trial_starts.copy()
+    prior = np.searchsorted(start_times, event_times, side="left") - 1
+    has_prior = valid & (prior >= 0)
+    window_starts[has_prior] = np.maximum(
+        start_times[prior[has_prior]], trial_starts[has_prior]
+    )
+
+    window_ends = trial_stops.copy()
+    following = np.searchsorted(end_times, event_times, side="right")
+    has_following = valid & (following < len(end_times))
+    window_ends[has_following] = np.minimum(
+        end_times[following[has_following]], trial_stops[has_following]
+    )
+
+    start_shift, alignment_shift, end_shift = time_shifts
+    return (
+        np.where(valid, window_starts + start_shift, np.nan),
+        event_times + alignment_shift,
+        np.where(valid, window_ends + end_shift, np.nan),
+    )
+
+
+def get_window_start_indices(
+    event_times: np.ndarray, min_limit: float, frame_rate: float
+) -> np.ndarray:
+    """Frame index of the first sample of every alignment window
+
+    Truncates toward zero, as `int()` does, so windows match the per-trial indexing
+    previously used by `ActivityAlignment.make`.
+
+    Args:
+        event_times (np.ndarray): (s) alignment event time of each trial
+        min_limit (float): (s) window extent before the event
+        frame_rate (float): (Hz) sampling rate of the activity traces
+
+    Returns:
+        start_indices (np.ndarray): (trials,) int64 frame index of each window start
+    """
+    event_times = np.asarray(event_times, dtype=float)
+    return np.trunc((event_times - min_limit) * frame_rate).astype(np.int64)
+
+
+def extend_aligned_timestamps(
+    aligned_timestamps: np.ndarray,
+    min_limit: float,
+    max_limit: float,
+    frame_rate: float,
+) -> tuple:
+    """Widen an existing aligned_timestamps grid to cover a new window
+
+    Samples are added in whole frame periods on either side, so the existing samples
+    keep their values and positions relative to each other. The result may start up
+    to one frame period earlier than `np.arange(-min_limit, max_limit, 1 / fps)`.
+
+    Args:
+        aligned_timestamps (np.ndarray): (samples,) existing grid relative to the event
+        min_limit (float): (s) window extent before the event to cover
+        max_limit (float): (s) window extent after the event to cover
+        frame_rate (float): (Hz) sampling rate of the grid
+
+    Returns:
+        aligned_timestamps (np.ndarray): widened grid, the input if already covering
+        prepended (int): number of samples added before the existing grid
+    """
+    aligned_timestamps = np.asarray(aligned_timestamps, dtype=float)
+    period = 1 / frame_rate
+    # tolerance against rounding of the stored grid
+    prepended = max(
+        0, int(np.ceil((min_limit + aligned_timestamps[0]) * frame_rate - 1e-6))
+    )
+    next_sample = aligned_timestamps[-1] + period
+    appended = max(0, int(np.ceil((max_limit - next_sample) * frame_rate - 1e-6)))
+    if not prepended and not appended:
+        return aligned_timestamps, 0
+    return (
+        np.concatenate(
+            [
+                aligned_timestamps[0] - period * np.arange(prepended, 0, -1),
+                aligned_timestamps,
+                next_sample + period * np.arange(appended),
+            ]
+        ),
+        prepended,
+    )
+
+
+class WindowSampler:
+    """Frames sampled by every alignment window of a set of trials
+
+    Windows are described by the frame index of each window sample. With frame
+    timestamps, each sample lies between two frames and is linearly interpolated;
+    otherwise each sample is a single frame.
+
+    Args:
+        frame_indices (np.ndarray): (1 or 2, trials, samples) frame(s) of each sample
+        in_range (np.ndarray): (trials, samples) mask of samples within the recording
+        weights (np.ndarray, optional): (trials, samples) interpolation weight of the
+            second frame, required when `frame_indices` has two frames per sample
+    """
+
+    def __init__(self, frame_indices, in_range, weights=None):
+        self.frame_indices = frame_indices
+        self.in_range = in_range
+        self.weights = weights
+
+    @classmethod
+    def from_start_indices(cls, start_indices, nsamples: int, nframes: int):
+        """Windows of `nsamples` consecutive frames from each start index
+
+        Args:
+            start_indices (np.ndarray): (trials,) frame index of each window start
+            nsamples (int): number of samples per window
+            nframes (int): number of frames in the recording
+        """
+        start_indices = np.asarray(start_indices, dtype=np.int64)
+        sample_indices = start_indices[:, None] + np.arange(nsamples, dtype=np.int64)
+        in_range = (sample_indices >= 0) & (sample_indices < nframes)
+        np.clip(sample_indices, 0, max(nframes - 1, 0), out=sample_indices)
+        return cls(sample_indices[None], in_range)
+
+    @classmethod
+    def from_timestamps(cls, frame_times, event_times, aligned_timestamps):
+        """Windows resampled from frame timestamps onto a common time grid
+
+        Args:
+            frame_times (np.ndarray): (frames,) non-decreasing time of each frame
+            event_times (np.ndarray): (trials,) alignment event time of each trial
+            aligned_timestamps (np.ndarray): (samples,) time relative to the event
+        """
+        sample_times = np.asarray(event_times, dtype=float)[:, None] + np.asarray(
+            aligned_timestamps, dtype=float
+        )
+        frame_indices, weights, in_range = get_interpolation_indices(
+            frame_times, sample_times
+        )
+        return cls(frame_indices, in_range, weights)
+
+    @property
+    def shape(self) -> tuple:
+        """(trials, samples)"""
+        return self.in_range.shape
+
+    def reduce(self) -> tuple:
+        """Frames used by any window, and a sampler indexing into those frames only
+
+        Returns:
+            frames (np.ndarray): sorted, unique frame indices used by the windows
+            sampler (WindowSampler): sampler for traces reduced to `frames`
+        """
+        used = np.broadcast_to(self.in_range, self.frame_indices.shape)
+        frames, inverse = np.unique(self.frame_indices[used], return_inverse=True)
+        positions = np.zeros(self.frame_indices.shape, dtype=np.int64)
+        positions[used] = inverse
+        return frames, WindowSampler(positions, self.in_range, self.weights)
+
+    @staticmethod
+    def merge(samplers: list) -> tuple:
+        """Reduce several samplers to the union of the frames they use
+
+        Lets traces loaded once, reduced to the returned frames, be sampled by every
+        sampler.
+
+        Args:
+            samplers (list): WindowSampler of each set of trials
+
+        Returns:
+            frames (np.ndarray): sorted, unique frame indices used by any sampler
+            samplers (list): sampler for traces reduced to `frames`, for each input
+        """
+        reduced = [sampler.reduce() for sampler in samplers]
+        frames = np.unique(
+            np.concatenate([np.empty(0, dtype=np.int64)] + [f for f, _ in reduced])
+        )
+        merged = []
+        for sampler_frames, sampler in reduced:
+            positions = sampler.frame_indices
+            if len(sampler_frames):
+                positions = np.searchsorted(frames, sampler_frames)[positions]
+            merged.append(WindowSampler(positions, sampler.in_range, sampler.weights))
+        return frames, merged
+
+    def sample(self, traces: np.ndarray, out=None) -> np.ndarray:
+        """Cut all windows out of the traces at once
+
+        Args:
+            traces (np.ndarray): (rois, frames) activity traces
+            out (np.ndarray, optional): preallocated (trials, rois, samples) float
+                array (e.g. a `np.memmap` or a view of one) to fill in place
+
+        Returns:
+            aligned (np.ndarray): (trials, rois, samples) aligned activity, NaN
+                outside of the recording
+        """
+        if self.weights is not None:
+            return interpolate_aligned_activity(
+                traces, self.frame_indices, self.weights, self.in_range, out=out
+            )
+
+        traces = np.asarray(traces)
+        ntrials, nsamples = self.shape
+        if out is None:
+            out = np.full((ntrials, traces.shape[0], nsamples), np.nan)
+        else:
+            out[...] = np.nan
+
+        if traces.size and self.in_range.any():
+            # (rois, trials, samples) -> (trials, rois, samples)
+            gathered = traces[:, self.frame_indices[0]].transpose(1, 0, 2)
+            np.copyto(out, gathered, where=self.in_range[:, None, :])
+        return out
+
+
+def get_interpolation_indices(frame_times: np.ndarray, sample_times: np.ndarray):
+    """Locate every window sample between two frames with one `np.searchsorted`
+
+    Args:
+        frame_times (np.ndarray): (frames,) non-decreasing time of each frame
+        sample_times (np.ndarray): (trials, samples) time of each window sample
+
+    Returns:
+        frame_indices (np.ndarray): (2, trials, samples) frames before and after
+            each sample
+        weights (np.ndarray): (trials, samples) linear interpolation weight of the
+            frame after each sample
+        in_range (np.ndarray): (trials, samples) mask of samples within the
+            recording
+    """
+    frame_times = np.asarray(frame_times, dtype=float)
+    sample_times = np.asarray(sample_times, dtype=float)
+    if np.any(np.diff(frame_times) < 0):
+        raise ValueError("Frame timestamps must be non-decreasing")
+
+    nframes = len(frame_times)
+    after = np.searchsorted(frame_times, sample_times, side="right")
+    in_range = (
+        (sample_times >= frame_times[0]) & (sample_times <= frame_times[-1])
+        if nframes
+        else np.zeros(sample_times.shape, dtype=bool)
+    )
+    before = np.clip(after - 1, 0, max(nframes - 1, 0))
+    after = np.clip(after, 0, max(nframes - 1, 0))
+
+    if not nframes:
+        return np.stack([before, after]), np.zeros(sample_times.shape), in_range
+
+    gaps = frame_times[after] - frame_times[before]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weights = np.where(gaps > 0, (sample_times - frame_times[before]) / gaps, 0.0)
+    return np.stack([before, after]), weights, in_range
+
+
+def interpolate_aligned_activity(
+    traces: np.ndarray,
+    frame_indices: np.ndarray,
+    weights: np.ndarray,
+    in_range: np.ndarray,
+    out=None,
+) -> np.ndarray:
+    """Resample traces onto the aligned time grid of every trial at once
+
+    Args:
+        traces (np.ndarray): (rois, frames) activity traces
+        frame_indices (np.ndarray): (2, trials, samples) from
+            `get_interpolation_indices` (or the frame indices of the sampler of
+            `WindowSampler.reduce` when `traces` holds only the reduced frames)
+        weights (np.ndarray): (trials, samples) from `get_interpolation_indices`
+        in_range (np.ndarray): (trials, samples) from `get_interpolation_indices`
+        out (np.ndarray, optional): preallocated (trials, rois, samples) float array
+            to fill in place
+
+    Returns:
+        aligned (np.ndarray): (trials, rois, samples) aligned activity, NaN outside
+            of the recording
+    """
+    traces = np.asarray(traces)
+    ntrials, nsamples = in_range.shape
+    if out is None:
+        out = np.full((ntrials, traces.shape[0], nsamples), np.nan)
+    else:
+        out[...] = np.nan
+
+    if not traces.size or not in_range.any():
+        return out
+
+    before = traces[:, frame_indices[0]].astype(
+        float, copy=False
+    )  # (rois, trials, samples)
+    after = traces[:, frame_indices[1]].astype(float, copy=False)
+    after -= before
+    after *= weights
+    before += after
+    np.copyto(out, before.transpose(1, 0, 2), where=in_range[:, None, :])
+    return out
+
+
+def get_roi_chunk_size(
+    memory_budget: int, nframes: int, nwindow_frames: int, itemsize: int = 8
+) -> int:
+    """Number of ROIs to load at once to stay within a memory budget
+
+    A chunk holds the full traces of its ROIs while they are fetched and the traces
+    reduced to the window frames afterwards.
+
+    Args:
+        memory_budget (int): (bytes) memory allowed for one chunk of traces
+        nframes (int): number of frames per full trace
+        nwindow_frames (int): number of frames covered by the alignment windows
+        itemsize (int, optional): bytes per sample. Defaults to 8 (float64).
+
+    Returns:
+        chunk_size (int): ROIs per chunk, at least 1
+    """
+    bytes_per_roi = (nframes + nwindow_frames) * itemsize
+    return max(1, int(memory_budget // max(bytes_per_roi, 1)))
+
+
+def compute_binned_psth(
+    aligned: np.ndarray, aligned_timestamps: np.ndarray, bin_size: float
+) -> tuple:
+    """Bin aligned activity in time and average across trials for every ROI
+
+    Bins are anchored at the alignment event, so t=0 is always a bin edge. Each
+    trial is first averaged within a bin, then trials are averaged, ignoring NaN.
+
+    Args:
+        aligned (np.ndarray): (trials, rois, samples) aligned activity
+        aligned_timestamps (np.ndarray): (samples,) time relative to the event
+        bin_size (float): (s) width of a bin
+
+    Returns:
+        bin_centers (np.ndarray): (bins,) center of each bin relative to the event
+        psth (np.ndarray): (rois, bins) trial-averaged activity
+        psth_sem (np.ndarray): (rois, bins) standard error of the mean across trials
+        trial_counts (np.ndarray): (rois,) trials with any data for each ROI
+    """
+    aligned = np.asarray(aligned, dtype=float)
+    aligned_timestamps = np.asarray(aligned_timestamps, dtype=float)
+
+    bin_indices = np.floor(aligned_timestamps / bin_size + 1e-9).astype(np.int64)
+    first_bin = bin_indices[0]
+    bin_indices -= first_bin
+    nbins = bin_indices[-1] + 1
+    bin_centers = (np.arange(nbins) + first_bin + 0.5) * bin_size
+
+    # samples are sorted in time, so each bin is a contiguous run of samples
+    bin_starts = np.searchsorted(bin_indices, np.arange(nbins))
+    occupied = bin_starts < len(bin_indices)
+    occupied[occupied] = bin_indices[bin_starts[occupied]] == np.arange(nbins)[occupied]
+    bin_starts = bin_starts[occupied]
+
+    finite = ~np.isnan(aligned)
+    sample_sums = np.add.reduceat(np.where(finite, aligned, 0), bin_starts, axis=-1)
+    sample_counts = np.add.reduceat(finite, bin_starts, axis=-1)
+
+    trial_bins = np.full(aligned.shape[:2] + (nbins,), np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        trial_bins[..., occupied] = np.where(
+            sample_counts > 0, sample_sums / sample_counts, np.nan
+        )
+
+    has_data = ~np.isnan(trial_bins)
+    counts = has_data.sum(axis=0)  # (rois, bins)
+    sums = np.where(has_data, trial_bins, 0).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        psth = np.where(counts > 0, sums / counts, np.nan)
+        squares = np.where(has_data, (trial_bins - psth) ** 2, 0).sum(axis=0)
+        psth_sem = np.where(
+            counts > 1, np.sqrt(squares / (counts - 1)) / np.sqrt(counts), np.nan
+        )
+
+    trial_counts = has_data.any(axis=-1).sum(axis=0)
+    return bin_centers, psth, psth_sem, trial_counts
@@ -1,11 +1,198 @@
+import contextlib
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING
+
 import datajoint as dj
-import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
+
+from workflow_miniscope import alignment
+from workflow_miniscope.cache import fetch_traces, get_query_checksum
+from workflow_miniscope.pipeline import (  # noqa: F401
+    db_prefix,
+    event,
+    miniscope,
+    session,
+    trial,
+)
+
+if TYPE_CHECKING:
+    import matplotlib.figure
 
-from workflow_miniscope.pipeline import db_prefix, miniscope, session, trial
+logger = logging.getLogger("datajoint")
 
 schema = dj.schema(db_prefix + "analysis")
 
+# Rows fetched per query by `fetch_population_activity`
+DEFAULT_POPULATION_CHUNK_ROWS = 10000
+
+
+def get_alignment_storage() -> str:
+    """Return the storage layout of ActivityAlignment from the config
+
+    The layout is set by `dj.config["custom"]["activity_alignment.storage"]`:
+        "trial" (default): one `AlignedTrialActivity` row per mask and trial
+        "tensor": one (trials x rois x samples) array per condition, stored in
+            `AlignedActivityChunk` rows of `activity_alignment.roi_chunk_size` ROIs
+
+    Returns:
+        storage (str): "trial" or "tensor"
+    """
+    storage = dj.config.get("custom", {}).get("activity_alignment.storage", "trial")
+    if storage not in ("trial", "tensor"):
+        raise ValueError(
+            f"Unknown activity_alignment.storage: {storage}."
+            ' Expected "trial" or "tensor"'
+        )
+    return storage
+
+
+def get_alignment_timing() -> str:
+    """Return how ActivityAlignment locates frames, from the config
+
+    Set by `dj.config["custom"]["activity_alignment.timing"]`:
+        "frame_rate" (default): frame i is at i / fps seconds
+        "timestamps": frame times from `get_frame_timestamps`, with each window
+            linearly interpolated onto the common `aligned_timestamps` grid
+
+    Returns:
+        timing (str): "frame_rate" or "timestamps"
+    """
+    timing = dj.config.get("custom", {}).get("activity_alignment.timing", "frame_rate")
+    if timing not in ("frame_rate", "timestamps"):
+        raise ValueError(
+            f"Unknown activity_alignment.timing: {timing}."
+            ' Expected "frame_rate" or "timestamps"'
+        )
+    return timing
+
+
+def get_frame_timestamps(key: dict) -> np.ndarray:
+    """Time of each frame of a recording, in seconds from the session start
+
+    Uses the per-frame time stamps of `miniscope.RecordingInfo` (in ms, second column
+    of the Miniscope-DAQ-V4 `timeStamps.csv`), offset by the recording start relative
+    to the session start. Replace this function to read frame times from a
+    synchronization routine instead.
+
+    Args:
+        key (dict): key restricting miniscope.RecordingInfo to one recording
+
+    Returns:
+        frame_times (np.ndarray): (frames,) time of each frame in seconds
+    """
+    session_time, rec_time, time_stamps = (
+        miniscope.RecordingInfo * session.Session & key
+    ).fetch1("session_datetime", "recording_datetime", "time_stamps")
+
+    time_stamps = np.asarray(time_stamps, dtype=float)
+    if time_stamps.ndim == 2:
+        time_stamps = time_stamps[:, 1]
+    frame_times = (time_stamps - time_stamps[0]) / 1000
+
+    rec_start = (rec_time - session_time).total_seconds() if rec_time else 0
+    return frame_times + rec_start
+
+
+class ActivityTraceLoader:
+    """Load the activity traces of one miniscope.Activity in chunks of ROIs
+
+    Each chunk is fetched from the database and reduced to the requested frames, so
+    at most one chunk of full-length traces is held in memory at a time. With a
+    `spill_dir`, reduced chunks are saved as `.npy` files on first load and
+    memory-mapped when iterated again, and `allocate` returns arrays backed by
+    files in the same directory. Spill files are removed on `close`.
+
+    Args:
+        key (dict): key restricting miniscope.Activity to a single entry
+        frames (np.ndarray, optional): frame indices to keep. Frames past the end of
+            a trace are returned as NaN. Defaults to all frames.
+        chunk_size (int, optional): ROIs per chunk. Defaults to all ROIs.
+        spill_dir (str, optional): directory for spill files. Defaults to None,
+            keeping chunks in memory only while they are used.
+    """
+
+    def __init__(self, key, frames=None, chunk_size=None, spill_dir=None):
+        self.activity_key = (miniscope.Activity & key).fetch1("KEY")
+        self.trace_keys = (miniscope.Activity.Trace & self.activity_key).fetch(
+            "KEY", order_by="mask"
+        )
+        self.frames = None if frames is None else np.asarray(frames)
+        self.chunk_size = chunk_size or max(len(self.trace_keys), 1)
+        self._spill_dir = (
+            None if spill_dir is None else Path(tempfile.mkdtemp(dir=spill_dir))
+        )
+        self._spill_files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        """Yield (roi_slice, traces) for each chunk, traces as (rois, frames)"""
+        for chunk_idx, start in enumerate(
+            range(0, len(self.trace_keys), self.chunk_size)
+        ):
+            roi_slice = slice(start, min(start + self.chunk_size, len(self.trace_keys)))
+            yield roi_slice, self._load_chunk(chunk_idx, roi_slice)
+
+    def _load_chunk(self, chunk_idx, roi_slice) -> np.ndarray:
+        if chunk_idx in self._spill_files:
+            return np.load(self._spill_files[chunk_idx], mmap_mode="r")
+
+        _, traces = fetch_traces(
+            miniscope.Activity.Trace & self.trace_keys[roi_slice],
+            "activity_trace",
+            order_by="mask",
+        )
+        traces = np.vstack(traces)
+
+        if self.frames is not None:
+            in_trace = self.frames < traces.shape[1]
+            window_traces = np.full((traces.shape[0], len(self.frames)), np.nan)
+            window_traces[:, in_trace] = traces[:, self.frames[in_trace]]
+            traces = window_traces
+
+        if self._spill_dir is not None:
+            spill_file = self._spill_dir / f"chunk_{chunk_idx}.npy"
+            np.save(spill_file, traces)
+            self._spill_files[chunk_idx] = spill_file
+
+        return traces
+
+    def allocate(self, shape: tuple) -> np.ndarray:
+        """NaN-filled (trials, rois, samples) output array, ROI-major in memory
+
+        Args:
+            shape (tuple): (trials, rois, samples)
+
+        Returns:
+            aligned (np.ndarray): array view, memory-mapped when spilling
+        """
+        ntrials, nrois, nsamples = shape
+        if self._spill_dir is None:
+            roi_major = np.full((nrois, ntrials, nsamples), np.nan)
+        else:
+            roi_major = np.lib.format.open_memmap(
+                self._spill_dir / "aligned_activities.npy",
+                mode="w+",
+                dtype=float,
+                shape=(nrois, ntrials, nsamples),
+            )
+            roi_major[:] = np.nan
+        return roi_major.transpose(1, 0, 2)
+
+    def close(self):
+        """Remove the spill files of this loader"""
+        self._spill_files = {}
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+
 
 @schema
 class ActivityAlignmentCondition(dj.Manual):
@@ -68,68 +255,450 @@ class ActivityAlignment(dj.Computed):
         aligned_trace: longblob  # (s) Calcium activity aligned to the event time
         """
 
+    class AlignedActivityIndex(dj.Part):
+        """Axis labels of the aligned activity tensor of one condition
+
+        Attributes:
+            mask_ids (longblob): (rois,) mask at each position of the ROI axis
+            trial_ids (longblob): (trials,) trial_id at each position of the trial axis
+            roi_chunk_size (int): Number of ROIs stored per AlignedActivityChunk
+        """
+
+        definition = """
+        -> master
+        ---
+        mask_ids: longblob  # (rois,) mask at each position of the ROI axis
+        trial_ids: longblob  # (trials,) trial_id at each position of the trial axis
+        roi_chunk_size: int  # number of ROIs stored per AlignedActivityChunk
+        """
+
+    class AlignedActivityChunk(dj.Part):
+        """Consecutive ROIs of the (trials x rois x samples) aligned activity tensor
+
+        Attributes:
+            roi_chunk (smallint): Chunk index along the ROI axis
+            aligned_activities (longblob): (chunk rois x trials x samples) Calcium
+                activity aligned to the event time
+        """
+
+        definition = """
+        -> master.AlignedActivityIndex
+        roi_chunk: smallint unsigned  # chunk index along the ROI axis
+        ---
+        aligned_activities: longblob  # (chunk rois x trials x samples) aligned activity
+        """
+
     def make(self, key):
         """Populate ActivityAlignment and AlignedTrialActivity
 
+        Window samples are located from the frame rate, or from per-frame timestamps
+        when `dj.config["custom"]["activity_alignment.timing"]` is "timestamps" (see
+        `get_frame_timestamps`). All traces are loaded at once unless
+        `activity_alignment.memory_budget` (bytes) is set, in which case they are
+        streamed in ROI chunks reduced to the frames under the alignment windows,
+        spilling to `activity_alignment.spill_dir` if set.
+
         Args:
             key (dict): Dict uniquely identifying one ActivityAlignmentCondition
         """
-        session_time, rec_time, nframes, frame_rate = (
-            miniscope.RecordingInfo * session.Session & key
-        ).fetch1("session_datetime", "recording_datetime", "nframes", "fps")
+        frame_rate = (miniscope.RecordingInfo & key).fetch1("fps")
+        trial_keys, event_times, min_limit, max_limit = self._get_event_times(
+            key, trial.Trial & (ActivityAlignmentCondition.Trial & key)
+        )
+        aligned_timestamps = np.arange(-min_limit, max_limit, 1 / frame_rate)
+
+        with self._align(key, event_times, aligned_timestamps) as (
+            trace_keys,
+            aligned_activities,
+        ):
+            self.insert1({**key, "aligned_timestamps": aligned_timestamps})
+            self._insert_aligned_activities(
+                key, trial_keys, trace_keys, aligned_activities
+            )
 
-        # Estimation of frame timestamps with respect to the session-start
-        # (to be replaced by timestamps retrieved from some synchronization routine)
-        # rec_start = (rec_time - session_time).total_seconds() if rec_time else 0
-        # frame_timestamps = np.arange(nframes) / frame_rate + rec_start
+    def extend(self, restriction=True) -> list:
+        """Align the condition trials added since ActivityAlignment was populated
 
+        For each ActivityAlignment key, only the trials of
+        `ActivityAlignmentCondition.Trial` without aligned activity are aligned and
+        inserted. If their windows fit within `aligned_timestamps`, existing rows are
+        left untouched, except for the chunks of the "tensor" layout, which are
+        rewritten with the new trials appended along the trial axis. If their
+        windows are wider, `aligned_timestamps` is extended by whole frame periods
+        (see `alignment.extend_aligned_timestamps`) and all trials are realigned on
+        the extended grid, which may then start up to one frame period earlier than
+        that of a full repopulation. The layout of existing rows is kept, and the
+        `ActivityAlignmentPSTH` of extended keys is deleted, to be repopulated.
+
+        Args:
+            restriction (optional): restriction of the ActivityAlignment keys to
+                extend. Defaults to all keys.
+
+        Returns:
+            keys (list): keys that were extended
+        """
+        extended = []
+        for key in (self & restriction).fetch("KEY"):
+            if self._extend(key):
+                extended.append(key)
+        return extended
+
+    def _extend(self, key) -> bool:
+        """Align the missing trials of one key, see `extend`"""
+        index = self.AlignedActivityIndex & key
+        if index:
+            aligned_trial_ids = index.fetch1("trial_ids").tolist()
+        else:
+            aligned_trial_ids = np.unique(
+                (self.AlignedTrialActivity & key).fetch("trial_id")
+            ).tolist()
+        condition_trials = trial.Trial & (ActivityAlignmentCondition.Trial & key)
+        trial_keys, event_times, min_limit, max_limit = self._get_event_times(
+            key, condition_trials - [{"trial_id": t} for t in aligned_trial_ids]
+        )
+        if not trial_keys:
+            return False
+
+        frame_rate = (miniscope.RecordingInfo & key).fetch1("fps")
+        previous_timestamps = (self & key).fetch1("aligned_timestamps")
+        aligned_timestamps, _ = alignment.extend_aligned_timestamps(
+            previous_timestamps, min_limit, max_limit, frame_rate
+        )
+        widened = len(aligned_timestamps) > len(previous_timestamps)
+        storage = "tensor" if index else "trial"
+        if widened:  # realign all trials on the extended grid
+            trial_keys, event_times, _, _ = self._get_event_times(key, condition_trials)
+
+        with self._align(key, event_times, aligned_timestamps) as (
+            trace_keys,
+            aligned_activities,
+        ):
+            with self.connection.transaction:
+                (ActivityAlignmentPSTH & key).delete(transaction=False, safemode=False)
+                if widened:
+                    for part in (
+                        self.AlignedActivityChunk,
+                        self.AlignedActivityIndex,
+                        self.AlignedTrialActivity,
+                    ):
+                        (part & key).delete_quick()
+                    # update1 refuses restricted tables such as `self`
+                    ActivityAlignment().update1(
+                        {**key, "aligned_timestamps": aligned_timestamps}
+                    )
+
+                if storage == "tensor" and not widened:
+                    self._append_tensor_trials(
+                        key, trial_keys, trace_keys, aligned_activities
+                    )
+                else:
+                    self._insert_aligned_activities(
+                        key, trial_keys, trace_keys, aligned_activities, storage
+                    )
+        return True
+
+    def _append_tensor_trials(self, key, trial_keys, trace_keys, aligned_activities):
+        """Rewrite the tensor chunks of a key with new trials appended
+
+        Args:
+            key (dict): ActivityAlignment key
+            trial_keys (list): trial.Trial key of each new trial
+            trace_keys (list): miniscope.Activity.Trace key of each ROI
+            aligned_activities (np.ndarray): (new trials x rois x samples) aligned
+                activity of the new trials
+        """
+        index = (self.AlignedActivityIndex & key).fetch1()
+        mask_pos = _lookup_positions(
+            np.array([k["mask"] for k in trace_keys]), index["mask_ids"], "mask"
+        )
+        # ROI-major, in the ROI order of the existing tensor
+        roi_major = aligned_activities.transpose(1, 0, 2)[mask_pos]
+        chunk_size = index["roi_chunk_size"]
+
+        chunks = []
+        for chunk, chunk_activities in zip(
+            *(self.AlignedActivityChunk & key).fetch(
+                "roi_chunk", "aligned_activities", order_by="roi_chunk"
+            )
+        ):
+            start = chunk * chunk_size
+            new_activities = roi_major[start : start + len(chunk_activities)]
+            chunks.append(
+                {
+                    **key,
+                    "roi_chunk": chunk,
+                    "aligned_activities": np.concatenate(
+                        [chunk_activities, new_activities], axis=1
+                    ),
+                }
+            )
+        index["trial_ids"] = np.concatenate(
+            [index["trial_ids"], [k["trial_id"] for k in trial_keys]]
+        )
+
+        (self.AlignedActivityChunk & key).delete_quick()
+        (self.AlignedActivityIndex & key).delete_quick()
+        self.AlignedActivityIndex.insert1(index)
+        self.AlignedActivityChunk.insert(chunks)
+
+    @staticmethod
+    def _get_event_times(key, trial_restriction) -> tuple:
+        """Alignment event times and common window of the trials of a condition
+
+        Args:
+            key (dict): ActivityAlignmentCondition key
+            trial_restriction (QueryExpression): trial.Trial rows to align
+
+        Returns:
+            trial_keys (list): trial.Trial key of each trial with an alignment event
+            event_times (np.ndarray): (trials,) event time of each of these trials
+            min_limit (float): (s) window extent before the event
+            max_limit (float): (s) window extent after the event
+        """
         trialized_event_times = trial.get_trialized_alignment_event_times(
-            key, trial.Trial & (ActivityAlignmentCondition.Trial & key)
+            key, trial_restriction
         )
+        if trialized_event_times.empty:
+            return [], np.empty(0), np.nan, np.nan
 
-        min_limit = (trialized_event_times.event - trialized_event_times.start).max()
-        max_limit = (trialized_event_times.end - trialized_event_times.event).max()
+        event_times = trialized_event_times.event.to_numpy(dtype=float)
+        valid, min_limit, max_limit = alignment.get_alignment_windows(
+            event_times,
+            trialized_event_times.start.to_numpy(dtype=float),
+            trialized_event_times.end.to_numpy(dtype=float),
+        )
+        trial_keys = trialized_event_times.trial_key[valid].tolist()
+        return trial_keys, event_times[valid], min_limit, max_limit
 
-        aligned_timestamps = np.arange(-min_limit, max_limit, 1 / frame_rate)
-        nsamples = len(aligned_timestamps)
-
-        trace_keys, activity_traces = (miniscope.Activity.Trace & key).fetch(
-            "KEY", "activity_trace", order_by="mask_id"
-        )
-        activity_traces = np.vstack(activity_traces)
-
-        aligned_trial_activities = []
-        for _, r in trialized_event_times.iterrows():
-            if r.event is None or np.isnan(r.event):
-                continue
-            alignment_start_idx = int((r.event - min_limit) * frame_rate)
-            roi_aligned_activities = activity_traces[
-                :, alignment_start_idx : (alignment_start_idx + nsamples)
-            ]
-            if roi_aligned_activities.shape[-1] != nsamples:
-                shape_diff = nsamples - roi_aligned_activities.shape[-1]
-                roi_aligned_activities = np.pad(
-                    roi_aligned_activities,
-                    ((0, 0), (0, shape_diff)),
-                    mode="constant",
-                    constant_values=np.nan,
+    @contextlib.contextmanager
+    def _align(self, key, event_times, aligned_timestamps):
+        """Align the activity traces of a key on a grid of samples
+
+        Streams the traces when `activity_alignment.memory_budget` is set (see
+        `make`). The aligned activities are only valid within the context, as they
+        may be memory-mapped from spill files removed on exit.
+
+        Args:
+            key (dict): ActivityAlignmentCondition key
+            event_times (np.ndarray): (trials,) alignment event time of each trial
+            aligned_timestamps (np.ndarray): (samples,) time relative to the event
+
+        Yields:
+            trace_keys (list): miniscope.Activity.Trace key of each ROI
+            aligned_activities (np.ndarray): (trials x rois x samples) aligned activity
+        """
+        nframes, frame_rate = (miniscope.RecordingInfo & key).fetch1("nframes", "fps")
+
+        memory_budget = dj.config["custom"].get("activity_alignment.memory_budget")
+        if memory_budget is None:
+            trace_keys, activity_traces = fetch_traces(
+                miniscope.Activity.Trace & key, "activity_trace", order_by="mask"
+            )
+            activity_traces = np.vstack(activity_traces)
+
+            sampler = self._get_window_sampler(
+                key,
+                event_times,
+                aligned_timestamps,
+                frame_rate,
+                nframes=activity_traces.shape[1],
+            )
+            yield trace_keys, sampler.sample(activity_traces)
+            return
+
+        # Streaming mode: load ROI chunks reduced to the frames under the windows
+        sampler = self._get_window_sampler(
+            key, event_times, aligned_timestamps, frame_rate, nframes
+        )
+        frames, reduced_sampler = sampler.reduce()
+        chunk_size = alignment.get_roi_chunk_size(memory_budget, nframes, len(frames))
+        spill_dir = dj.config["custom"].get("activity_alignment.spill_dir")
+
+        with ActivityTraceLoader(key, frames, chunk_size, spill_dir) as loader:
+            aligned_activities = loader.allocate(
+                (len(event_times), len(loader.trace_keys), len(aligned_timestamps))
+            )
+            for roi_slice, window_traces in loader:
+                reduced_sampler.sample(
+                    window_traces, out=aligned_activities[:, roi_slice]
                 )
+            yield loader.trace_keys, aligned_activities
 
-            aligned_trial_activities.extend(
-                [
-                    {**key, **r.trial_key, **trace_key, "aligned_trace": aligned_trace}
-                    for trace_key, aligned_trace in zip(
-                        trace_keys, roi_aligned_activities
-                    )
-                ]
+    @staticmethod
+    def _get_window_sampler(
+        key, event_times, aligned_timestamps, frame_rate, nframes, frame_times=None
+    ) -> alignment.WindowSampler:
+        """Locate the frames of every alignment window per `get_alignment_timing`
+
+        Args:
+            key (dict): key restricting miniscope.RecordingInfo to one recording
+            event_times (np.ndarray): (trials,) alignment event time of each trial
+            aligned_timestamps (np.ndarray): (samples,) time relative to the event
+            frame_rate (float): (Hz) frame rate of the recording
+            nframes (int): number of frames of the activity traces
+            frame_times (np.ndarray, optional): timestamps of the recording, if
+                already fetched. Defaults to `get_frame_timestamps(key)`.
+
+        Returns:
+            sampler (alignment.WindowSampler): sampler of the (trials, samples) grid
+        """
+        if get_alignment_timing() == "timestamps":
+            if frame_times is None:
+                frame_times = get_frame_timestamps(key)
+            return alignment.WindowSampler.from_timestamps(
+                frame_times[:nframes], event_times, aligned_timestamps
+            )
+
+        start_indices = alignment.get_window_start_indices(
+            event_times, -aligned_timestamps[0], frame_rate
+        )
+        return alignment.WindowSampler.from_start_indices(
+            start_indices, len(aligned_timestamps), nframes
+        )
+
+    def _insert_aligned_activities(
+        self, key, trial_keys, trace_keys, aligned_activities, storage=None
+    ):
+        """Insert the (trials x rois x samples) array in a storage layout
+
+        Args:
+            key (dict): ActivityAlignment key
+            trial_keys (list): trial.Trial key of each position along the trial axis
+            trace_keys (list): miniscope.Activity.Trace key of each position along the
+                ROI axis
+            aligned_activities (np.ndarray): (trials x rois x samples) aligned activity
+            storage (str, optional): "trial" or "tensor". Defaults to
+                `get_alignment_storage()`.
+        """
+        if (storage or get_alignment_storage()) == "trial":
+            self.AlignedTrialActivity.insert(
+                {**key, **trial_key, **trace_key, "aligned_trace": aligned_trace}
+                for trial_key, trial_activities in zip(trial_keys, aligned_activities)
+                for trace_key, aligned_trace in zip(trace_keys, trial_activities)
+            )
+            return
+
+        roi_chunk_size = int(
+            dj.config["custom"].get("activity_alignment.roi_chunk_size", 1)
+        )
+        # ROI-major layout so that each chunk holds contiguous per-ROI arrays
+        roi_major = aligned_activities.transpose(1, 0, 2)
+
+        self.AlignedActivityIndex.insert1(
+            {
+                **key,
+                "mask_ids": np.array([k["mask"] for k in trace_keys]),
+                "trial_ids": np.array([k["trial_id"] for k in trial_keys]),
+                "roi_chunk_size": roi_chunk_size,
+            }
+        )
+        self.AlignedActivityChunk.insert(
+            {
+                **key,
+                "roi_chunk": chunk_idx,
+                "aligned_activities": np.ascontiguousarray(
+                    roi_major[start : start + roi_chunk_size]
+                ),
+            }
+            for chunk_idx, start in enumerate(
+                range(0, roi_major.shape[0], roi_chunk_size)
+            )
+        )
+
+    def fetch_aligned_activities(
+        self, key: dict, rois: list = None, trials: list = None
+    ) -> tuple:
+        """Fetch aligned activities of selected ROIs and trials as one array
+
+        Works with both storage layouts. With the "tensor" layout, only the chunks
+        holding the requested ROIs are transferred and deserialized. Axes follow the
+        order of `rois` and `trials` when given, else ascending mask and trial_id.
+        Requested ROIs and trials that were not aligned are filled with NaN.
+
+        Args:
+            key (dict): key of ActivityAlignment master table
+            rois (list, optional): masks to fetch. Defaults to all masks.
+            trials (list, optional): trial_ids to fetch. Defaults to all trials.
+
+        Returns:
+            aligned_timestamps (np.ndarray): (samples,) time relative to the event
+            trial_ids (np.ndarray): (trials,) trial_id along the first axis
+            mask_ids (np.ndarray): (rois,) mask along the second axis
+            aligned_activities (np.ndarray): (trials x rois x samples) aligned activity
+        """
+        key = (self & key).fetch1("KEY")
+        aligned_timestamps = (self & key).fetch1("aligned_timestamps")
+
+        if self.AlignedActivityIndex & key:
+            return (aligned_timestamps,) + self._fetch_tensor_activities(
+                key, rois, trials, len(aligned_timestamps)
             )
 
-        self.insert1({**key, "aligned_timestamps": aligned_timestamps})
-        self.AlignedTrialActivity.insert(aligned_trial_activities)
+        query = self.AlignedTrialActivity & key
+        if rois is not None:
+            query &= [{"mask": roi} for roi in rois]
+        if trials is not None:
+            query &= [{"trial_id": trial_id} for trial_id in trials]
+
+        row_trial_ids, row_mask_ids, aligned_traces = query.fetch(
+            "trial_id", "mask", "aligned_trace"
+        )
+        trial_ids = np.unique(row_trial_ids) if trials is None else np.array(trials)
+        mask_ids = np.unique(row_mask_ids) if rois is None else np.array(rois)
+        trial_pos = _lookup_positions(trial_ids, row_trial_ids, "trial_id")
+        mask_pos = _lookup_positions(mask_ids, row_mask_ids, "mask")
+
+        aligned_activities = np.full(
+            (len(trial_ids), len(mask_ids), len(aligned_timestamps)), np.nan
+        )
+        if len(aligned_traces):
+            aligned_activities[trial_pos, mask_pos] = np.vstack(aligned_traces)
+
+        return aligned_timestamps, trial_ids, mask_ids, aligned_activities
+
+    def _fetch_tensor_activities(self, key, rois, trials, nsamples) -> tuple:
+        """Slice the chunked aligned activity tensor by ROI and trial"""
+        mask_ids, trial_ids, roi_chunk_size = (self.AlignedActivityIndex & key).fetch1(
+            "mask_ids", "trial_ids", "roi_chunk_size"
+        )
+        if rois is not None:
+            roi_pos = _lookup_positions(mask_ids, rois, "mask", missing_ok=True)
+            mask_ids = np.array(rois)
+        else:
+            roi_pos = np.arange(len(mask_ids))
+        if trials is not None:
+            trial_pos = _lookup_positions(
+                trial_ids, trials, "trial_id", missing_ok=True
+            )
+            trial_ids = np.array(trials)
+        else:
+            trial_pos = np.arange(len(trial_ids))
+
+        aligned_activities = np.full((len(trial_ids), len(mask_ids), nsamples), np.nan)
+        (out_trials,) = np.nonzero(trial_pos >= 0)
+        chunk_ids = np.unique(roi_pos[roi_pos >= 0] // roi_chunk_size)
+        if not len(out_trials) or not len(chunk_ids):
+            return trial_ids, mask_ids, aligned_activities
+
+        chunk_query = self.AlignedActivityChunk & key
+        if rois is not None:
+            chunk_query &= [{"roi_chunk": chunk} for chunk in chunk_ids.tolist()]
+        for chunk, chunk_activities in zip(
+            *chunk_query.fetch("roi_chunk", "aligned_activities")
+        ):
+            (out_rois,) = np.nonzero(
+                (roi_pos >= 0) & (roi_pos // roi_chunk_size == chunk)
+            )
+            chunk_rows = roi_pos[out_rois] - chunk * roi_chunk_size
+            aligned_activities[np.ix_(out_trials, out_rois)] = chunk_activities[
+                chunk_rows
+            ][:, trial_pos[out_trials]].transpose(1, 0, 2)
+
+        return trial_ids, mask_ids, aligned_activities
 
     def plot_aligned_activities(
         self, key: dict, roi, axs: tuple = None, title: str = None
-    ) -> plt.figure.Figure:
+    ) -> "matplotlib.figure.Figure":
         """Plot event-aligned and trial-averaged calcium activities
 
         Activities including: dF/F, neuropil-corrected dF/F, Calcium events, etc.
@@ -145,6 +714,9 @@ class ActivityAlignment(dj.Computed):
             fig (matplotlib.figure.Figure): Plot event-aligned and trial-averaged
                 calcium activities
         """
+        import matplotlib.pyplot as plt
+
+        from .plotting import draw_aligned_activity
 
         fig = None
         if axs is None:
@@ -152,34 +724,568 @@ class ActivityAlignment(dj.Computed):
         else:
             ax0, ax1 = axs
 
-        aligned_timestamps = (self & key).fetch1("aligned_timestamps")
-        _, aligned_spikes = (self.AlignedTrialActivity & key & {"mask_id": roi}).fetch(
-            "trial_id", "aligned_trace", order_by="trial_id"
-        )
-
-        aligned_spikes = np.vstack(aligned_spikes)
-
-        ax0.imshow(
-            aligned_spikes,
-            cmap="inferno",
-            interpolation="nearest",
-            aspect="auto",
-            extent=(
-                aligned_timestamps[0],
-                aligned_timestamps[-1],
-                0,
-                aligned_spikes.shape[0],
-            ),
+        aligned_timestamps, _, _, aligned_spikes = self.fetch_aligned_activities(
+            key, rois=[roi]
         )
-        ax0.axvline(x=0, linestyle="--", color="white")
-        ax0.set_axis_off()
-
-        ax1.plot(aligned_timestamps, np.nanmean(aligned_spikes, axis=0))
-        ax1.axvline(x=0, linestyle="--", color="black")
-        ax1.set_xlabel("Time (s)")
-        ax1.set_xlim(aligned_timestamps[0], aligned_timestamps[-1])
+        draw_aligned_activity(ax0, ax1, aligned_timestamps, aligned_spikes[:, 0, :])
 
         if title:
             plt.suptitle(title)
 
         return fig
+
+    def plot_aligned_activities_batch(
+        self,
+        key: dict,
+        rois: list = None,
+        output_path: str = None,
+        width: int = 400,
+        dpi: int = 100,
+        ncols: int = 4,
+        nrows: int = 4,
+        processes: int = None,
+        cache_dir: str = None,
+        overwrite: bool = False,
+    ) -> list:
+        """Render event-aligned activity of many ROIs into images and a PDF gallery
+
+        ROI images are cached as PNG files keyed by condition, mask and render
+        settings, and by a checksum of the aligned rows of the condition, so that
+        images of extended or repopulated conditions are never reused. Only ROIs
+        without an image are fetched, in a single query, and rendered in parallel
+        worker processes. The time axis is downsampled to the
+        image width before rendering.
+
+        Args:
+            key (dict): key of ActivityAlignment master table
+            rois (list, optional): masks to render. Defaults to all masks.
+            output_path (str, optional): multi-page PDF with `ncols` x `nrows` ROIs
+                per page. Defaults to None, rendering the ROI images only.
+            width (int, optional): ROI image width in pixels. Defaults to 400.
+            dpi (int, optional): ROI image resolution. Defaults to 100.
+            ncols (int, optional): ROI images per PDF row. Defaults to 4.
+            nrows (int, optional): rows per PDF page. Defaults to 4.
+            processes (int, optional): rendering processes. Defaults to CPU count.
+            cache_dir (str, optional): image cache directory. Defaults to
+                `dj.config["custom"]["plot_cache_dir"]`, else a temporary directory.
+            overwrite (bool, optional): re-render cached images. Defaults to False.
+
+        Returns:
+            paths (list): PNG path of each ROI
+        """
+        from .plotting import get_gallery_paths, render_gallery, save_gallery_pdf
+
+        key = (self & key).fetch1("KEY")
+        if rois is None:
+            rois = (miniscope.Activity.Trace & key).fetch("mask", order_by="mask")
+        rois = list(rois)
+
+        cache_dir = cache_dir or dj.config["custom"].get("plot_cache_dir")
+        if cache_dir is None:
+            cache_dir = Path(tempfile.gettempdir()) / "workflow_miniscope_plots"
+        signature = [
+            get_query_checksum(table & key)
+            for table in (
+                ActivityAlignment,
+                self.AlignedTrialActivity,
+                self.AlignedActivityIndex,
+                self.AlignedActivityChunk,
+            )
+        ]
+        paths = get_gallery_paths(cache_dir, key, rois, width, dpi, signature)
+
+        missing = [i for i, path in enumerate(paths) if overwrite or not path.exists()]
+        if missing:
+            (
+                aligned_timestamps,
+                _,
+                _,
+                aligned_activities,
+            ) = self.fetch_aligned_activities(key, rois=[rois[i] for i in missing])
+            render_gallery(
+                aligned_timestamps,
+                [rois[i] for i in missing],
+                aligned_activities,
+                [paths[i] for i in missing],
+                width=width,
+                dpi=dpi,
+                processes=processes,
+            )
+
+        if output_path is not None:
+            save_gallery_pdf(paths, output_path, ncols=ncols, nrows=nrows)
+
+        return paths
+
+
+@schema
+class ActivityAlignmentPSTH(dj.Computed):
+    """Binned peri-stimulus time histogram (PSTH) of every ROI of a condition
+
+    Attributes:
+        ActivityAlignment (foreign key): ActivityAlignment primary key
+        bin_size (float): (s) Bin size from ActivityAlignmentCondition
+        bin_centers (longblob): (s) Center of each bin relative to the event time
+    """
+
+    definition = """
+    -> ActivityAlignment
+    ---
+    bin_size: float  # (s) bin size from ActivityAlignmentCondition
+    bin_centers: longblob  # (s) center of each bin relative to the event time
+    """
+
+    class Trace(dj.Part):
+        """PSTH of one ROI
+
+        Attributes:
+            miniscope.Activity.Trace (foreign key): Activity trace primary key
+            psth (longblob): Trial-averaged activity in each bin
+            psth_sem (longblob): Standard error of the mean across trials in each bin
+            trial_count (int): Number of trials with data for this ROI
+        """
+
+        definition = """
+        -> master
+        -> miniscope.Activity.Trace
+        ---
+        psth: longblob  # trial-averaged activity in each bin
+        psth_sem: longblob  # standard error of the mean across trials in each bin
+        trial_count: int  # number of trials with data for this ROI
+        """
+
+    def make(self, key):
+        """Populate ActivityAlignmentPSTH and its Trace part in one pass
+
+        Args:
+            key (dict): Dict uniquely identifying one ActivityAlignment
+        """
+        bin_size = (ActivityAlignmentCondition & key).fetch1("bin_size")
+        (
+            aligned_timestamps,
+            _,
+            mask_ids,
+            aligned_activities,
+        ) = ActivityAlignment().fetch_aligned_activities(key)
+
+        bin_centers, psth, psth_sem, trial_counts = alignment.compute_binned_psth(
+            aligned_activities, aligned_timestamps, bin_size
+        )
+
+        trace_keys = {
+            trace_key["mask"]: trace_key
+            for trace_key in (miniscope.Activity.Trace & key).fetch("KEY")
+        }
+
+        self.insert1({**key, "bin_size": bin_size, "bin_centers": bin_centers})
+        self.Trace.insert(
+            {
+                **key,
+                **trace_keys[mask],
+                "psth": roi_psth,
+                "psth_sem": roi_psth_sem,
+                "trial_count": trial_count,
+            }
+            for mask, roi_psth, roi_psth_sem, trial_count in zip(
+                mask_ids.tolist(), psth, psth_sem, trial_counts.tolist()
+            )
+        )
+
+
+def populate_activity_alignments(restriction=True, suppress_errors=False) -> dict:
+    """Grouped alternative to `ActivityAlignment.populate()`
+
+    Pending conditions are grouped by miniscope.Activity. For each Activity, the
+    trials, alignment events and events of the session are fetched with one query
+    per table, the traces are fetched once, reduced to the frames under the windows
+    of any condition, and every condition is aligned from them. The traces are
+    loaded in ROI chunks if `dj.config["custom"]["activity_alignment.memory_budget"]`
+    is set. All conditions of an Activity are inserted in one transaction. Jobs are
+    not reserved, so run it from a single process.
+
+    Conditions without any trial with a valid window are skipped with a warning,
+    and left pending.
+
+    Args:
+        restriction (optional): restriction of the ActivityAlignmentCondition keys to
+            populate. Defaults to all pending keys.
+        suppress_errors (bool, optional): log the error of an Activity and continue
+            with the next one, as `populate` does. Defaults to False.
+
+    Returns:
+        result (dict): as `populate`, the number of conditions populated
+            ("success_count") and the (Activity key, error) of each Activity that
+            failed ("error_list")
+    """
+    pending = (ActivityAlignment.key_source & restriction) - ActivityAlignment
+    count, errors = 0, []
+    for activity_key in (miniscope.Activity & pending).fetch("KEY"):
+        try:
+            count += _populate_activity_group(
+                activity_key, (pending & activity_key).fetch("KEY")
+            )
+        except Exception as error:
+            if not suppress_errors:
+                raise
+            logger.error(f"Failed to align the conditions of {activity_key}: {error}")
+            errors.append((activity_key, error))
+    return {"success_count": count, "error_list": errors}
+
+
+def _populate_activity_group(activity_key: dict, condition_keys: list) -> int:
+    """Align and insert the pending conditions of one Activity, see
+    `populate_activity_alignments`"""
+    nframes, frame_rate = (miniscope.RecordingInfo & activity_key).fetch1(
+        "nframes", "fps"
+    )
+    frame_times = (
+        get_frame_timestamps(activity_key)
+        if get_alignment_timing() == "timestamps"
+        else None
+    )
+
+    conditions, samplers = [], []
+    for key, (trial_keys, event_times, min_limit, max_limit) in zip(
+        condition_keys, _get_condition_event_times(condition_keys)
+    ):
+        if not trial_keys or not np.isfinite([min_limit, max_limit]).all():
+            logger.warning(f"Skipped {key}: no trial with a valid alignment window")
+            continue
+        aligned_timestamps = np.arange(-min_limit, max_limit, 1 / frame_rate)
+        conditions.append((key, trial_keys, aligned_timestamps))
+        samplers.append(
+            ActivityAlignment._get_window_sampler(
+                key,
+                event_times,
+                aligned_timestamps,
+                frame_rate,
+                nframes,
+                frame_times,
+            )
+        )
+    if not conditions:
+        return 0
+    frames, samplers = alignment.WindowSampler.merge(samplers)
+
+    memory_budget = dj.config["custom"].get("activity_alignment.memory_budget")
+    chunk_size = (
+        None
+        if memory_budget is None
+        else alignment.get_roi_chunk_size(memory_budget, nframes, len(frames))
+    )
+    with ActivityTraceLoader(activity_key, frames, chunk_size) as loader:
+        aligned = [
+            loader.allocate(
+                (len(trial_keys), len(loader.trace_keys), len(aligned_timestamps))
+            )
+            for _, trial_keys, aligned_timestamps in conditions
+        ]
+        for roi_slice, window_traces in loader:
+            for sampler, aligned_activities in zip(samplers, aligned):
+                sampler.sample(window_traces, out=aligned_activities[:, roi_slice])
+
+    with ActivityAlignment.connection.transaction:
+        for (key, trial_keys, aligned_timestamps), aligned_activities in zip(
+            conditions, aligned
+        ):
+            ActivityAlignment.insert1(
+                {**key, "aligned_timestamps": aligned_timestamps},
+                allow_direct_insert=True,
+            )
+            ActivityAlignment()._insert_aligned_activities(
+                key, trial_keys, loader.trace_keys, aligned_activities
+            )
+    logger.info(f"---- Aligned {len(conditions)} condition(s) of {activity_key} ----")
+    return len(conditions)
+
+
+def _get_condition_event_times(condition_keys: list) -> list:
+    """Trials and alignment event times of conditions of one session
+
+    Fetches the trials, alignment events and events with one query per table and
+    locates the windows with `alignment.get_trialized_event_times`.
+
+    Args:
+        condition_keys (list): ActivityAlignmentCondition keys of one session
+
+    Returns:
+        event_times (list): for each condition, as `ActivityAlignment._get_event_times`,
+            (trial_keys, event_times, min_limit, max_limit)
+    """
+    condition_trials = ActivityAlignmentCondition.Trial & condition_keys
+    trial_keys, trial_ids, trial_starts, trial_stops = (
+        trial.Trial & condition_trials
+    ).fetch(
+        "KEY", "trial_id", "trial_start_time", "trial_stop_time", order_by="trial_id"
+    )
+    trial_keys = np.array(trial_keys, dtype=object)
+    alignment_names, trial_conditions, condition_trial_ids = condition_trials.fetch(
+        "alignment_name", "trial_condition", "trial_id"
+    )
+
+    specs = {
+        spec["alignment_name"]: spec
+        for spec in (event.AlignmentEvent & condition_keys).fetch(as_dict=True)
+    }
+    event_types = {
+        spec[f"{name}_event_type"]
+        for spec in specs.values()
+        for name in ("alignment", "start", "end")
+    }
+    types, times = (
+        event.Event
+        & (session.Session & condition_keys)
+        & [{"event_type": event_type} for event_type in event_types]
+    ).fetch("event_type", "event_start_time")
+    times = times.astype(float)
+
+    event_times = []
+    for key in condition_keys:
+        spec = specs[key["alignment_name"]]
+        in_condition = np.isin(
+            trial_ids,
+            condition_trial_ids[
+                (alignment_names == key["alignment_name"])
+                & (trial_conditions == key["trial_condition"])
+            ],
+        )
+        starts, events, ends = alignment.get_trialized_event_times(
+            trial_starts[in_condition],
+            trial_stops[in_condition],
+            *(
+                times[types == spec[f"{name}_event_type"]]
+                for name in ("alignment", "start", "end")
+            ),
+            time_shifts=tuple(
+                spec[f"{name}_time_shift"] for name in ("start", "alignment", "end")
+            ),
+        )
+        valid, min_limit, max_limit = alignment.get_alignment_windows(
+            events, starts, ends
+        )
+        event_times.append(
+            (
+                trial_keys[in_condition][valid].tolist(),
+                events[valid],
+                min_limit,
+                max_limit,
+            )
+        )
+    return event_times
+
+
+def fetch_population_activity(
+    restriction=True, chunk_rows: int = None, as_chunks: bool = False
+) -> tuple:
+    """Fetch the aligned activity of many sessions and conditions as one array
+
+    Rows are one (condition, mask, trial) each, ordered by the ActivityAlignment
+    primary key, mask and trial_id. The row metadata is read with one query per
+    storage layout, without blobs, and the activities are then fetched in chunks
+    of about `chunk_rows` rows, one query per chunk, straight into a preallocated
+    array. Conditions stored with the "trial" and the "tensor" layout can be mixed.
+
+    Args:
+        restriction (optional): restriction of ActivityAlignment, e.g. sessions, a
+            subject or a trial_condition. Defaults to every condition.
+        chunk_rows (int, optional): rows per query. Defaults to
+            `DEFAULT_POPULATION_CHUNK_ROWS`.
+        as_chunks (bool, optional): return an iterator of chunks instead of the
+            stacked array. Defaults to False.
+
+    Returns:
+        aligned_timestamps (np.ndarray): (samples,) time relative to the event
+        metadata (pd.DataFrame): ActivityAlignment primary key, "mask" and
+            "trial_id" of each row
+        activities (np.ndarray or iterator): (rows x samples) aligned activity, or
+            with `as_chunks`, an iterator of (row slice, (chunk rows x samples)
+            activity)
+
+    Raises:
+        ValueError: if the conditions do not share the same aligned_timestamps
+    """
+    aligned_timestamps = _get_population_timestamps(restriction)
+    chunks = _get_population_chunks(restriction, chunk_rows)
+    metadata = pd.concat(
+        [chunk_metadata for chunk_metadata, _ in chunks]
+        or [pd.DataFrame(columns=[*ActivityAlignment.primary_key, "mask", "trial_id"])],
+        ignore_index=True,
+    )
+    nsamples = len(aligned_timestamps)
+    starts = np.cumsum([0] + [len(chunk_metadata) for chunk_metadata, _ in chunks])
+    row_slices = [slice(start, stop) for start, stop in zip(starts, starts[1:])]
+
+    if as_chunks:
+
+        def iter_chunks():
+            for row_slice, (_, load) in zip(row_slices, chunks):
+                out = np.empty((row_slice.stop - row_slice.start, nsamples))
+                load(out)
+                yield row_slice, out
+
+        return aligned_timestamps, metadata, iter_chunks()
+
+    activities = np.empty((len(metadata), nsamples))
+    for row_slice, (_, load) in zip(row_slices, chunks):
+        load(activities[row_slice])
+    return aligned_timestamps, metadata, activities
+
+
+def _get_population_timestamps(restriction) -> np.ndarray:
+    """The aligned_timestamps shared by every restricted condition"""
+    all_timestamps = (ActivityAlignment & restriction).fetch("aligned_timestamps")
+    if not len(all_timestamps):
+        return np.empty(0)
+    aligned_timestamps = all_timestamps[0]
+    for timestamps in all_timestamps[1:]:
+        if len(timestamps) != len(aligned_timestamps) or not np.allclose(
+            timestamps, aligned_timestamps
+        ):
+            raise ValueError(
+                "Conditions have different aligned_timestamps: restrict to conditions"
+                " with the same alignment window and frame rate"
+            )
+    return aligned_timestamps
+
+
+def _get_population_chunks(restriction, chunk_rows: int = None) -> list:
+    """Metadata and loader of each chunk of rows of `fetch_population_activity`
+
+    Chunks never split the rows of one mask of one condition ("trial" layout) or
+    one AlignedActivityChunk ("tensor" layout), and each is fetched by one query.
+    """
+    chunk_rows = chunk_rows or DEFAULT_POPULATION_CHUNK_ROWS
+    master_pk = ActivityAlignment.primary_key
+    condition_order = {
+        tuple(key.values()): idx
+        for idx, key in enumerate(
+            (ActivityAlignment & restriction).fetch("KEY", order_by=master_pk)
+        )
+    }
+
+    # units: (condition position, layout, metadata, restriction of the unit rows)
+    units = []
+    trial_rows = ActivityAlignment.AlignedTrialActivity & restriction
+    columns = [*master_pk, "mask", "trial_id"]
+    trial_metadata = pd.DataFrame(
+        dict(
+            zip(
+                columns,
+                trial_rows.fetch(
+                    *columns,
+                    order_by=ActivityAlignment.AlignedTrialActivity.primary_key,
+                ),
+            )
+        ),
+        columns=columns,
+    )
+    for (*condition, mask), unit_metadata in trial_metadata.groupby(
+        [*master_pk, "mask"], sort=False
+    ):
+        condition_key = dict(zip(master_pk, condition))
+        units.append(
+            (
+                condition_order[tuple(condition)],
+                "trial",
+                unit_metadata,
+                {**condition_key, "mask": mask},
+            )
+        )
+
+    index_keys, all_mask_ids, all_trial_ids, roi_chunk_sizes = (
+        ActivityAlignment.AlignedActivityIndex & restriction
+    ).fetch("KEY", "mask_ids", "trial_ids", "roi_chunk_size", order_by=master_pk)
+    for key, mask_ids, trial_ids, roi_chunk_size in zip(
+        index_keys, all_mask_ids, all_trial_ids, roi_chunk_sizes
+    ):
+        for roi_chunk, start in enumerate(range(0, len(mask_ids), roi_chunk_size)):
+            chunk_masks = mask_ids[start : start + roi_chunk_size]
+            unit_metadata = pd.DataFrame(
+                {
+                    **{attr: key[attr] for attr in master_pk},
+                    "mask": np.repeat(chunk_masks, len(trial_ids)),
+                    "trial_id": np.tile(trial_ids, len(chunk_masks)),
+                }
+            )
+            units.append(
+                (
+                    condition_order[tuple(key.values())],
+                    "tensor",
+                    unit_metadata,
+                    {**key, "roi_chunk": roi_chunk},
+                )
+            )
+
+    units.sort(key=lambda unit: unit[0])
+    chunks = []
+    group = []
+    for unit in units:
+        if group and (
+            unit[1] != group[0][1]
+            or sum(len(u[2]) for u in group) + len(unit[2]) > chunk_rows
+        ):
+            chunks.append(_get_population_chunk(group))
+            group = []
+        group.append(unit)
+    if group:
+        chunks.append(_get_population_chunk(group))
+    return chunks
+
+
+def _get_population_chunk(units: list) -> tuple:
+    """Metadata and loader of consecutive units of the same storage layout"""
+    metadata = pd.concat([unit[2] for unit in units], ignore_index=True)
+    unit_keys = [unit[3] for unit in units]
+    layout = units[0][1]
+
+    def load(out: np.ndarray):
+        if layout == "trial":
+            table = ActivityAlignment.AlignedTrialActivity
+            (blobs,) = (table & unit_keys).fetch(
+                "aligned_trace", order_by=table.primary_key
+            )
+            if len(blobs) != len(out):
+                raise dj.DataJointError("Aligned activity changed while fetching")
+            for row, aligned_trace in enumerate(blobs):
+                out[row] = aligned_trace
+            return
+        table = ActivityAlignment.AlignedActivityChunk
+        (blobs,) = (table & unit_keys).fetch(
+            "aligned_activities", order_by=table.primary_key
+        )
+        row = 0
+        for chunk_activities in blobs:
+            nrows = chunk_activities.shape[0] * chunk_activities.shape[1]
+            out[row : row + nrows] = chunk_activities.reshape(nrows, -1)
+            row += nrows
+        if row != len(out):
+            raise dj.DataJointError("Aligned activity changed while fetching")
+
+    return metadata, load
+
+
+def _lookup_positions(
+    labels: np.ndarray, values: list, name: str, missing_ok: bool = False
+) -> np.ndarray:
+    """Positions of `values` along an axis labelled by `labels`
+
+    Args:
+        labels (np.ndarray): label of each position along the axis
+        values (list): labels to look up
+        name (str): name of the labels, for the error message
+        missing_ok (bool, optional): return -1 for values that are not labels
+            instead of raising. Defaults to False.
+
+    Returns:
+        positions (np.ndarray): position of each value
+
+    Raises:
+        ValueError: if a value is not a label and `missing_ok` is False
+    """
+    positions = {label: idx for idx, label in enumerate(np.asarray(labels).tolist())}
+    values = np.asarray(values).tolist()
+    if not missing_ok:
+        missing = [v for v in values if v not in positions]
+        if missing:
+            raise ValueError(f"Unknown {name}: {missing}")
+    return np.array([positions.get(v, -1) for v in values], dtype=int)
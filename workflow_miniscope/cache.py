@@ -0,0 +1,219 @@
+"""Local read-through cache for trace blobs
+
+Fetching `miniscope.Activity.Trace` or `miniscope.Fluorescence.Trace` rows through
+`fetch_traces` stores each trace as an `.npy` file under
+`dj.config["custom"]["trace_cache_dir"]`. Later fetches of the same rows return
+read-only memory-mapped arrays without transferring the blobs again.
+
+Files are named by a hash of the primary key and the MD5 of the stored blob, which
+MySQL computes without sending the blob. A repopulated row has a new blob hash and
+therefore misses the cache, and a deleted row is never listed by the query. The
+total size is capped by `trace_cache_size` (bytes, default 10 GB), evicting the
+least recently used files first.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import datajoint as dj
+import numpy as np
+
+DEFAULT_CACHE_SIZE = 10 * 1024**3
+
+_trace_cache = None
+
+
+class TraceCache:
+    """Least-recently-used cache of trace blobs as memory-mappable `.npy` files
+
+    Args:
+        cache_dir (str): directory holding the cached files
+        max_bytes (int, optional): size cap of the cache directory. Defaults to
+            `DEFAULT_CACHE_SIZE`.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_SIZE):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = sum(f.stat().st_size for f in self.cache_dir.rglob("*.npy"))
+
+    @property
+    def stats(self) -> dict:
+        """Hit, miss and eviction counters and the current cache size in bytes"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": self._size,
+            "max_bytes": self.max_bytes,
+        }
+
+    def fetch(self, query, attribute: str, order_by=None) -> tuple:
+        """Fetch one blob attribute for every row of a query through the cache
+
+        Args:
+            query (dj.Table): restricted table, e.g. `miniscope.Activity.Trace & key`
+            attribute (str): blob attribute to fetch
+            order_by (str, optional): order of the returned rows
+
+        Returns:
+            keys (list): primary key of each row
+            values (list): read-only memory-mapped array of each row
+        """
+        keys, blob_hashes = query.proj(blob_hash=f"MD5(`{attribute}`)").fetch(
+            "KEY", "blob_hash", order_by=order_by
+        )
+        entry_dir = self.cache_dir / query.full_table_name.replace("`", "") / attribute
+        entry_dir.mkdir(parents=True, exist_ok=True)
+        paths = [
+            entry_dir / f"{_key_hash(key)}_{blob_hash}.npy"
+            for key, blob_hash in zip(keys, blob_hashes)
+        ]
+
+        missing = [i for i, path in enumerate(paths) if not path.exists()]
+        self.hits += len(paths) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            missing_keys, values = (query & [keys[i] for i in missing]).fetch(
+                "KEY", attribute
+            )
+            positions = {_key_hash(key): i for i, key in enumerate(missing_keys)}
+            for i in missing:
+                key_hash = _key_hash(keys[i])
+                self._remove_stale(entry_dir, key_hash)
+                self._write(paths[i], values[positions[key_hash]])
+            self._evict(keep=set(paths))
+
+        values = []
+        for path in paths:
+            os.utime(path)  # mark as recently used
+            try:
+                values.append(np.load(path, mmap_mode="r"))
+            except ValueError:  # empty arrays cannot be memory-mapped
+                values.append(np.load(path))
+        return list(keys), values
+
+    def clear(self):
+        """Remove every cached file"""
+        for path in self.cache_dir.rglob("*.npy"):
+            path.unlink(missing_ok=True)
+        self._size = 0
+
+    def _write(self, path: Path, value):
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, suffix=".tmp", delete=False
+        ) as f:
+            np.save(f, np.asarray(value))
+        os.replace(f.name, path)
+        self._size += path.stat().st_size
+
+    def _remove_stale(self, entry_dir: Path, key_hash: str):
+        """Remove files of earlier blob versions of a row"""
+        for path in entry_dir.glob(f"{key_hash}_*.npy"):
+            self._size -= path.stat().st_size
+            path.unlink(missing_ok=True)
+
+    def _evict(self, keep=()):
+        """Remove least recently used files until the cache fits its size cap"""
+        if self._size <= self.max_bytes:
+            return
+        files = []
+        for path in self.cache_dir.rglob("*.npy"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # removed by another process
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        self._size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if self._size <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            path.unlink(missing_ok=True)
+            self._size -= size
+            self.evictions += 1
+
+
+def _key_hash(key: dict) -> str:
+    return hashlib.md5(
+        json.dumps(key, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def get_trace_cache():
+    """Return the cache configured by `trace_cache_dir`, or None if not configured
+
+    Returns:
+        cache (TraceCache): process-wide cache instance
+    """
+    global _trace_cache
+
+    cache_dir = dj.config.get("custom", {}).get("trace_cache_dir")
+    if not cache_dir:
+        return None
+    max_bytes = dj.config["custom"].get("trace_cache_size", DEFAULT_CACHE_SIZE)
+    if (
+        _trace_cache is None
+        or _trace_cache.cache_dir != Path(cache_dir)
+        or _trace_cache.max_bytes != int(max_bytes)
+    ):
+        _trace_cache = TraceCache(cache_dir, max_bytes)
+    return _trace_cache
+
+
+def fetch_traces(query, attribute: str, order_by=None) -> tuple:
+    """Fetch a trace attribute, through the trace cache when one is configured
+
+    Args:
+        query (dj.Table): restricted table, e.g. `miniscope.Activity.Trace & key`
+        attribute (str): blob attribute to fetch, e.g. "activity_trace"
+        order_by (str, optional): order of the returned rows
+
+    Returns:
+        keys (list): primary key of each row
+        values (list): trace of each row
+    """
+    cache = get_trace_cache()
+    if cache is None:
+        keys, values = query.fetch("KEY", attribute, order_by=order_by)
+        return list(keys), list(values)
+    return cache.fetch(query, attribute, order_by=order_by)
+
+
+def get_query_checksum(query) -> list:
+    """Row count and checksum of every attribute of the rows of a query
+
+    Blobs, attachments and filepaths enter the checksum by their MD5 digest. Computed
+    by MySQL, without transferring the rows.
+
+    Args:
+        query (dj.Table): restricted table
+
+    Returns:
+        signature (list): [row count, checksum], [0, 0] for no rows
+    """
+    attributes = ", ".join(
+        f"MD5(`{attr.name}`)"
+        if attr.is_blob or attr.is_attachment or attr.is_filepath
+        else f"`{attr.name}`"
+        for attr in query.heading.attributes.values()
+    )
+    count, checksum = (
+        dj.U()
+        .aggr(
+            query,
+            nrows="COUNT(*)",
+            checksum=f"BIT_XOR(CRC32(CONCAT_WS('|', {attributes})))",
+        )
+        .fetch1("nrows", "checksum")
+    )
+    return [int(count), int(checksum or 0)]
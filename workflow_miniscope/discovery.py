@@ -0,0 +1,268 @@
+"""Incremental discovery of new session directories under the miniscope root directories
+
+A session directory is a directory holding `.avi` recordings together with the
+`metaData.json` and `timeStamps.csv` files of Miniscope-DAQ-V4 or the `timestamp.dat`
+file of Miniscope-DAQ-V3. `discover_sessions` walks every root directory with a pool
+of threads and keeps a JSON index of each directory's modification time, its
+subdirectories and its recording files, at `dj.config["custom"]["discovery_index"]`.
+
+On later scans a directory whose modification time is unchanged is not listed
+again: only its known subdirectories are checked with one `stat()` each. Adding or
+removing a file or subdirectory changes the modification time of its parent, so
+only directories with changes are listed.
+"""
+import csv
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent import futures
+from datetime import datetime
+from pathlib import Path
+
+import datajoint as dj
+
+from .paths import get_miniscope_root_data_dir
+
+logger = logging.getLogger("datajoint")
+
+DEFAULT_INDEX_PATH = Path.home() / ".cache" / "workflow_miniscope" / "discovery.json"
+
+# Files identifying the acquisition software of a session directory
+ACQ_SOFTWARE_FILES = {
+    "Miniscope-DAQ-V4": ("metaData.json", "timeStamps.csv"),
+    "Miniscope-DAQ-V3": ("timestamp.dat",),
+}
+RECORDING_FILES = {name for names in ACQ_SOFTWARE_FILES.values() for name in names}
+
+# (s) directories modified this recently are listed again on the next scan, as
+# file system timestamps may be too coarse to show a later change in the same tick
+MTIME_GRACE = 2.0
+
+
+class DirectoryIndex:
+    """Persistent index of directory modification times, subdirectories and files
+
+    Args:
+        index_path (str, optional): JSON file holding the index. Defaults to
+            `dj.config["custom"]["discovery_index"]` or `DEFAULT_INDEX_PATH`.
+    """
+
+    def __init__(self, index_path=None):
+        self.index_path = Path(
+            index_path
+            or dj.config.get("custom", {}).get("discovery_index")
+            or DEFAULT_INDEX_PATH
+        )
+        try:
+            self.directories = json.loads(self.index_path.read_text())
+        except (FileNotFoundError, ValueError):
+            self.directories = {}
+        self.checked = 0
+        self._lock = threading.Lock()
+
+    def save(self):
+        """Write the index atomically"""
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.index_path.parent, suffix=".tmp", delete=False
+        ) as f:
+            json.dump(self.directories, f)
+        os.replace(f.name, self.index_path)
+
+    def scan(self, root_dirs: list, max_workers: int = 16) -> list:
+        """Update the index from the root directories
+
+        Args:
+            root_dirs (list): directories to scan recursively
+            max_workers (int, optional): threads probing directories. Defaults to 16.
+
+        Returns:
+            changed (list): absolute paths of directories listed in this scan
+        """
+        directories = {}
+        changed = []
+        self.checked = 0
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {
+                executor.submit(self._probe, Path(root).as_posix())
+                for root in root_dirs
+                if Path(root).is_dir()
+            }
+            while pending:
+                done, pending = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    path, entry, listed = future.result()
+                    if entry is None:  # removed during the scan
+                        continue
+                    directories[path] = entry
+                    if listed:
+                        changed.append(path)
+                    pending |= {
+                        executor.submit(self._probe, f"{path}/{name}")
+                        for name in entry["subdirs"]
+                    }
+        self.directories = directories
+        return changed
+
+    def _probe(self, path: str) -> tuple:
+        """Stat a directory and list it only if it changed since the last scan"""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return path, None, False
+        with self._lock:
+            self.checked += 1
+
+        previous = self.directories.get(path)
+        if previous is not None and previous["mtime"] == mtime:
+            return path, previous, False
+
+        subdirs, files = [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.name.endswith(".avi") or entry.name in RECORDING_FILES:
+                        files.append(entry.name)
+        except (FileNotFoundError, NotADirectoryError):
+            return path, None, False
+
+        recent = time.time() - mtime / 1e9 < MTIME_GRACE
+        entry = {
+            "mtime": None if recent else mtime,
+            "subdirs": sorted(subdirs),
+            "files": sorted(files),
+        }
+        return path, entry, True
+
+    def session_directories(self) -> dict:
+        """Directories of the index holding recordings
+
+        Returns:
+            sessions (dict): absolute path to (acquisition software, `.avi` files)
+        """
+        sessions = {}
+        for path, entry in self.directories.items():
+            avi_files = [name for name in entry["files"] if name.endswith(".avi")]
+            if not avi_files:
+                continue
+            for acq_software, required_files in ACQ_SOFTWARE_FILES.items():
+                if all(name in entry["files"] for name in required_files):
+                    sessions[path] = (acq_software, avi_files)
+                    break
+        return sessions
+
+
+def discover_sessions(
+    root_dirs: list = None,
+    index_path=None,
+    known_session_dirs: set = None,
+    max_workers: int = 16,
+) -> list:
+    """Scan the root directories and return session directories not yet ingested
+
+    Args:
+        root_dirs (list, optional): directories to scan, or a single directory.
+            Defaults to `get_miniscope_root_data_dir()`.
+        index_path (str, optional): JSON file holding the directory index. Defaults
+            to `dj.config["custom"]["discovery_index"]` or `DEFAULT_INDEX_PATH`.
+        known_session_dirs (set, optional): relative session directories to ignore.
+            Defaults to every `session_dir` of `session.SessionDirectory`.
+        max_workers (int, optional): threads probing directories. Defaults to 16.
+
+    Returns:
+        candidates (list): one dict per new session directory with "subject" (the
+            first component of the relative path), "session_dir" (relative to its
+            root), "session_datetime" (from Miniscope-DAQ-V4 metadata, else None),
+            "acq_software", "root_dir" and "files" (the `.avi` files)
+
+    Raises:
+        ValueError: if no root directory is given or configured
+    """
+    root_dirs = root_dirs or get_miniscope_root_data_dir()
+    if not root_dirs:
+        raise ValueError(
+            "No root directory to scan: pass root_dirs or set"
+            ' dj.config["custom"]["miniscope_root_data_dir"]'
+        )
+    if isinstance(root_dirs, (str, Path)):
+        root_dirs = [root_dirs]
+    root_dirs = [Path(root).as_posix() for root in root_dirs]
+    if known_session_dirs is None:
+        from .pipeline import session
+
+        known_session_dirs = set(session.SessionDirectory.fetch("session_dir"))
+    known_session_dirs = {Path(d).as_posix() for d in known_session_dirs}
+
+    start = time.perf_counter()
+    index = DirectoryIndex(index_path)
+    changed = index.scan(root_dirs, max_workers=max_workers)
+    index.save()
+    logger.info(
+        f"Scanned {index.checked} directories in {time.perf_counter() - start:.1f} s,"
+        f" listed {len(changed)} new or changed"
+    )
+
+    candidates = []
+    for path, (acq_software, avi_files) in sorted(index.session_directories().items()):
+        root_dir = max(
+            (root for root in root_dirs if path == root or path.startswith(root + "/")),
+            key=len,
+        )
+        session_dir = Path(path).relative_to(root_dir).as_posix()
+        if session_dir in known_session_dirs or session_dir == ".":
+            continue
+        candidates.append(
+            {
+                "subject": session_dir.split("/")[0],
+                "session_dir": session_dir,
+                "session_datetime": _read_session_datetime(Path(path)),
+                "acq_software": acq_software,
+                "root_dir": root_dir,
+                "files": avi_files,
+            }
+        )
+    return candidates
+
+
+def write_session_manifest(candidates: list, path, device: str = None):
+    """Write discovered sessions as a session manifest for `ingest.ingest_sessions`
+
+    Args:
+        candidates (list): output of `discover_sessions`
+        path (str): CSV file to write
+        device (str, optional): device of every recording. If given, each session
+            row also adds a recording with the discovered acquisition software.
+    """
+    columns = ["subject", "session_dir", "session_datetime"]
+    if device:
+        columns += ["device", "acq_software"]
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for candidate in candidates:
+            row = {**candidate, "device": device}
+            writer.writerow(["" if row[c] is None else row[c] for c in columns])
+
+
+def _read_session_datetime(session_path: Path):
+    """Recording start time from Miniscope-DAQ-V4 metadata, or None"""
+    try:
+        metadata = json.loads((session_path / "metaData.json").read_text())
+        start = metadata["recordingStartTime"]
+        return datetime(
+            start["year"],
+            start["month"],
+            start["day"],
+            start["hour"],
+            start["minute"],
+            start["second"],
+        )
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
@@ -0,0 +1,458 @@
+"""Export the processed outputs of sessions to chunked, compressed HDF5 files
+
+Each session is written to `<export_dir>/<subject>/<session_datetime>.h5`, with
+`export_dir` from `dj.config["custom"]["export_dir"]`, in the layout:
+
+    /                                   attrs: subject, session_datetime, signature
+    /<recording_id>/<paramset_id>/<curation_id>/
+        motion_correction/              ref_image, average_image, correlation_image,
+                                        max_proj_image
+        masks/                          mask_ids, npix, center_x, center_y (masks,);
+                                        xpix, ypix, weights (pixels,) of all masks
+                                        concatenated, and offsets (masks + 1,): the
+                                        pixels of mask i are [offsets[i]:offsets[i+1]]
+        fluorescence/                   mask_ids, channels (traces,);
+                                        traces (traces x frames)
+        activity/<extraction_method>/   mask_ids, channels (traces,);
+                                        traces (traces x frames)
+        alignment/<alignment_name>/<trial_condition>/
+                                        aligned_timestamps (samples,), trial_ids
+                                        (trials,), mask_ids (rois,), activities
+                                        (trials x rois x samples)
+
+Traces and aligned activities are chunked along the ROI axis, so that one ROI or
+trial is read without decompressing the rest: `h5py.File(path)["..."][roi]`. Written
+without compression (`compression=None`), datasets are contiguous and can be
+memory-mapped with `memmap_dataset`.
+
+Tables are streamed in batches of ROIs, each batch holding at most `batch_bytes` of
+traces, into a temporary file that replaces the export once complete. A session is
+exported again only when its upstream rows changed: the root attribute `signature`
+holds a checksum of the attributes of each exported table, with blobs included by
+their MD5 digest, so added, deleted, updated or repopulated rows are detected.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent import futures
+from pathlib import Path
+
+import datajoint as dj
+import numpy as np
+
+logger = logging.getLogger("datajoint")
+
+DEFAULT_BATCH_BYTES = 2**28  # trace data fetched per query
+CHUNK_BYTES = 2**20  # target size of a dataset chunk before compression
+
+
+def get_export_dir() -> Path:
+    """Export directory from `dj.config["custom"]["export_dir"]`
+
+    Returns:
+        path (pathlib.Path): export directory
+
+    Raises:
+        ValueError: if `export_dir` is not set
+    """
+    export_dir = dj.config.get("custom", {}).get("export_dir")
+    if not export_dir:
+        raise ValueError('Set dj.config["custom"]["export_dir"] or pass export_dir')
+    return Path(export_dir).expanduser()
+
+
+def get_export_path(session_key: dict, export_dir=None) -> Path:
+    """File holding the export of one session
+
+    Args:
+        session_key (dict): key of one session.Session
+        export_dir (str, optional): Defaults to `get_export_dir()`.
+
+    Returns:
+        path (pathlib.Path): `<export_dir>/<subject>/<session_datetime>.h5`
+    """
+    export_dir = Path(export_dir).expanduser() if export_dir else get_export_dir()
+    session_datetime = session_key["session_datetime"].strftime("%Y%m%dT%H%M%S")
+    return export_dir / session_key["subject"] / f"{session_datetime}.h5"
+
+
+def export_sessions(
+    restriction=True,
+    export_dir=None,
+    processes: int = 1,
+    force: bool = False,
+    compression="gzip",
+    batch_bytes: int = None,
+) -> dict:
+    """Export the processed outputs of every restricted session with curations
+
+    Args:
+        restriction (optional): restriction of session.Session. Defaults to every
+            session with a miniscope.Curation.
+        export_dir (str, optional): Defaults to `get_export_dir()`.
+        processes (int, optional): sessions exported in parallel, each by its own
+            worker process. Defaults to 1.
+        force (bool, optional): export sessions whose upstream rows did not
+            change. Defaults to False.
+        compression (str, optional): h5py compression of the datasets, None for
+            contiguous datasets that can be memory-mapped. Defaults to "gzip".
+        batch_bytes (int, optional): trace data fetched per query. Defaults to
+            `DEFAULT_BATCH_BYTES`.
+
+    Returns:
+        results (dict): export path to "exported" or "unchanged", or the error
+            message for sessions that failed in parallel runs
+    """
+    from .pipeline import miniscope, session
+
+    export_dir = Path(export_dir).expanduser() if export_dir else get_export_dir()
+    session_keys = ((session.Session & restriction) & miniscope.Curation).fetch(
+        "KEY", order_by=session.Session.primary_key
+    )
+    arguments = [
+        (key, export_dir, force, compression, batch_bytes) for key in session_keys
+    ]
+    if processes <= 1:
+        return {
+            get_export_path(key, export_dir).as_posix(): _export(*args)
+            for key, args in zip(session_keys, arguments)
+        }
+
+    results = {}
+    with futures.ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        submitted = {
+            executor.submit(_export, *args): get_export_path(key, export_dir)
+            for key, args in zip(session_keys, arguments)
+        }
+        for future in futures.as_completed(submitted):
+            path = submitted[future].as_posix()
+            try:
+                results[path] = future.result()
+            except Exception as error:
+                logger.error(f"Export ERROR for {path}: {error}")
+                results[path] = f"{type(error).__name__}: {error}"
+    return results
+
+
+def export_session(
+    session_key: dict,
+    path=None,
+    force: bool = False,
+    compression="gzip",
+    batch_bytes: int = None,
+) -> bool:
+    """Export the processed outputs of one session
+
+    Args:
+        session_key (dict): key of one session.Session
+        path (str, optional): Defaults to `get_export_path(session_key)`.
+        force (bool, optional): export even if the upstream rows did not change.
+            Defaults to False.
+        compression (str, optional): h5py compression, None for contiguous
+            datasets. Defaults to "gzip".
+        batch_bytes (int, optional): trace data fetched per query. Defaults to
+            `DEFAULT_BATCH_BYTES`.
+
+    Returns:
+        exported (bool): False if the existing export was up to date
+    """
+    import h5py
+
+    from .pipeline import session
+
+    session_key = (session.Session & session_key).fetch1("KEY")
+    path = Path(path) if path else get_export_path(session_key)
+    signature = json.dumps(get_session_signature(session_key), sort_keys=True)
+    if not force and path.exists():
+        try:
+            with h5py.File(path, "r") as f:
+                if f.attrs.get("signature") == signature:
+                    return False
+        except OSError:  # not a readable HDF5 file: export again
+            pass
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=path.parent, suffix=".h5.tmp", delete=False
+    ) as tmp_file:
+        tmp_path = Path(tmp_file.name)
+    try:
+        with h5py.File(tmp_path, "w") as f:
+            f.attrs["subject"] = session_key["subject"]
+            f.attrs["session_datetime"] = str(session_key["session_datetime"])
+            writer = _SessionWriter(f, compression, batch_bytes)
+            writer.write(session_key)
+            f.attrs["signature"] = signature
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    logger.info(f"Exported {session_key} to {path}")
+    return True
+
+
+def get_session_signature(session_key: dict) -> dict:
+    """Row count and checksum of every exported table, restricted to one session
+
+    The checksum covers every attribute of each row, blobs by their MD5 digest as in
+    `cache.fetch_traces`, and is computed by MySQL, without transferring the rows.
+
+    Args:
+        session_key (dict): key of one session.Session
+
+    Returns:
+        signature (dict): table name to [row count, checksum]
+    """
+    from .cache import get_query_checksum
+
+    return {
+        name: get_query_checksum(table & session_key)
+        for name, table in _get_exported_tables().items()
+    }
+
+
+def memmap_dataset(path, name: str) -> np.memmap:
+    """Memory-map a contiguous, uncompressed dataset of an export
+
+    Args:
+        path (str): export file
+        name (str): dataset path in the file, e.g.
+            "0/0/0/fluorescence/traces"
+
+    Returns:
+        data (np.memmap): read-only array backed by the file
+
+    Raises:
+        ValueError: if the dataset is chunked or compressed
+    """
+    import h5py
+
+    with h5py.File(path, "r") as f:
+        dataset = f[name]
+        offset = dataset.id.get_offset()
+        if dataset.chunks is not None or offset is None:
+            raise ValueError(
+                f"{name} is chunked or empty: export with compression=None to"
+                " memory-map it, or slice it with h5py"
+            )
+        dtype, shape = dataset.dtype, dataset.shape
+    return np.memmap(path, mode="r", dtype=dtype, shape=shape, offset=offset)
+
+
+def _export(session_key, export_dir, force, compression, batch_bytes) -> str:
+    exported = export_session(
+        session_key,
+        get_export_path(session_key, export_dir),
+        force=force,
+        compression=compression,
+        batch_bytes=batch_bytes,
+    )
+    return "exported" if exported else "unchanged"
+
+
+def _get_exported_tables() -> dict:
+    """Every table read by `_SessionWriter`, by name in the export signature"""
+    from .analysis import ActivityAlignment
+    from .pipeline import miniscope
+
+    return {
+        "Curation": miniscope.Curation,
+        "MotionCorrection.Summary": miniscope.MotionCorrection.Summary,
+        "Segmentation.Mask": miniscope.Segmentation.Mask,
+        "Fluorescence.Trace": miniscope.Fluorescence.Trace,
+        "Activity.Trace": miniscope.Activity.Trace,
+        "ActivityAlignment": ActivityAlignment,
+        "ActivityAlignment.AlignedTrialActivity": (
+            ActivityAlignment.AlignedTrialActivity
+        ),
+        "ActivityAlignment.AlignedActivityIndex": (
+            ActivityAlignment.AlignedActivityIndex
+        ),
+        "ActivityAlignment.AlignedActivityChunk": (
+            ActivityAlignment.AlignedActivityChunk
+        ),
+    }
+
+
+class _SessionWriter:
+    """Write the tables of one session into an open HDF5 file, table by table"""
+
+    def __init__(self, file, compression="gzip", batch_bytes=None):
+        self.file = file
+        self.compression = compression
+        self.batch_bytes = batch_bytes or DEFAULT_BATCH_BYTES
+
+    def write(self, session_key: dict):
+        from .pipeline import miniscope
+
+        for key in (miniscope.Curation & session_key).fetch(
+            "KEY", order_by=miniscope.Curation.primary_key
+        ):
+            group = self.file.require_group(
+                f"{key['recording_id']}/{key['paramset_id']}/{key['curation_id']}"
+            )
+            self._write_motion_correction(group, key)
+            self._write_masks(group, key)
+            self._write_traces(
+                group.require_group("fluorescence"),
+                miniscope.Fluorescence.Trace & key,
+                "fluorescence",
+            )
+            for activity_key in (miniscope.Activity & key).fetch("KEY"):
+                self._write_traces(
+                    group.require_group(
+                        f"activity/{activity_key['extraction_method']}"
+                    ),
+                    miniscope.Activity.Trace & activity_key,
+                    "activity_trace",
+                )
+            self._write_alignments(group, key)
+
+    def _write_motion_correction(self, group, key):
+        from .pipeline import miniscope
+
+        summary = (miniscope.MotionCorrection.Summary & key).fetch(as_dict=True)
+        if not summary:
+            return
+        mc_group = group.require_group("motion_correction")
+        for name in (
+            "ref_image",
+            "average_image",
+            "correlation_image",
+            "max_proj_image",
+        ):
+            if summary[0][name] is not None:
+                self._create(mc_group, name, np.asarray(summary[0][name]))
+
+    def _write_masks(self, group, key):
+        from .pipeline import miniscope
+
+        mask_ids, npix, center_x, center_y, xpix, ypix, weights = (
+            miniscope.Segmentation.Mask & key
+        ).fetch(
+            "mask",
+            "mask_npix",
+            "mask_center_x",
+            "mask_center_y",
+            "mask_xpix",
+            "mask_ypix",
+            "mask_weights",
+            order_by="mask",
+        )
+        if not len(mask_ids):
+            return
+        mask_group = group.require_group("masks")
+        lengths = [len(np.atleast_1d(w)) for w in weights]
+        self._create(mask_group, "mask_ids", mask_ids.astype(int))
+        self._create(mask_group, "npix", npix.astype(int))
+        for name, values in (("center_x", center_x), ("center_y", center_y)):
+            self._create(
+                mask_group,
+                name,
+                np.array([np.nan if v is None else v for v in values], dtype=float),
+            )
+        self._create(mask_group, "offsets", np.concatenate([[0], np.cumsum(lengths)]))
+        for name, values in (("xpix", xpix), ("ypix", ypix), ("weights", weights)):
+            self._create(
+                mask_group,
+                name,
+                np.concatenate([np.atleast_1d(v) for v in values]),
+            )
+
+    def _write_traces(self, group, query, attribute: str):
+        """Stream traces into a (traces x frames) dataset in batches of rows"""
+        from .cache import fetch_traces
+
+        trace_keys = query.fetch("KEY", order_by=query.primary_key)
+        if not trace_keys:
+            return
+        self._create(group, "mask_ids", np.array([k["mask"] for k in trace_keys]))
+        self._create(
+            group,
+            "channels",
+            np.array([k["fluorescence_channel"] for k in trace_keys]),
+        )
+        traces = None
+        batch_size = len(trace_keys)
+        start = 0
+        while start < len(trace_keys):
+            _, batch = fetch_traces(
+                query & trace_keys[start : start + batch_size],
+                attribute,
+                order_by=query.primary_key,
+            )
+            batch = np.vstack(batch)
+            if traces is None:  # size the batches from the first trace
+                traces = self._create(
+                    group,
+                    "traces",
+                    shape=(len(trace_keys), batch.shape[1]),
+                    dtype=batch.dtype,
+                )
+                batch_size = max(1, self.batch_bytes // batch[0].nbytes)
+            traces[start : start + len(batch)] = batch
+            start += len(batch)
+
+    def _write_alignments(self, group, key):
+        """Stream each aligned activity tensor in batches of ROIs"""
+        from .analysis import ActivityAlignment
+
+        for alignment_key in (ActivityAlignment & key).fetch(
+            "KEY", order_by=ActivityAlignment.primary_key
+        ):
+            aligned_timestamps = (ActivityAlignment & alignment_key).fetch1(
+                "aligned_timestamps"
+            )
+            index = ActivityAlignment.AlignedActivityIndex & alignment_key
+            if index:
+                mask_ids, trial_ids = index.fetch1("mask_ids", "trial_ids")
+            else:
+                mask_ids, trial_ids = (
+                    ActivityAlignment.AlignedTrialActivity & alignment_key
+                ).fetch("mask", "trial_id")
+                mask_ids, trial_ids = np.unique(mask_ids), np.unique(trial_ids)
+
+            alignment_group = group.require_group(
+                f"alignment/{alignment_key['alignment_name']}"
+                f"/{alignment_key['trial_condition']}"
+            )
+            self._create(alignment_group, "aligned_timestamps", aligned_timestamps)
+            self._create(alignment_group, "trial_ids", np.asarray(trial_ids))
+            self._create(alignment_group, "mask_ids", np.asarray(mask_ids))
+            shape = (len(trial_ids), len(mask_ids), len(aligned_timestamps))
+            activities = self._create(
+                alignment_group, "activities", shape=shape, dtype=float, chunk_axis=1
+            )
+            roi_bytes = max(8 * shape[0] * shape[2], 1)
+            batch_size = max(1, self.batch_bytes // roi_bytes)
+            for start in range(0, len(mask_ids), batch_size):
+                rois = mask_ids[start : start + batch_size].tolist()
+                *_, batch = ActivityAlignment().fetch_aligned_activities(
+                    alignment_key, rois=rois, trials=list(trial_ids)
+                )
+                activities[:, start : start + len(rois)] = batch
+
+    def _create(self, group, name, data=None, shape=None, dtype=None, chunk_axis=0):
+        """Create a dataset chunked along `chunk_axis` in chunks of about
+        `CHUNK_BYTES`, or contiguous without compression"""
+        shape = data.shape if data is not None else shape
+        dtype = data.dtype if data is not None else np.dtype(dtype)
+        chunks = None
+        if self.compression is not None and len(shape) and all(shape):
+            row_bytes = dtype.itemsize * int(np.prod(shape)) // shape[chunk_axis]
+            chunks = list(shape)
+            chunks[chunk_axis] = int(
+                np.clip(CHUNK_BYTES // max(row_bytes, 1), 1, shape[chunk_axis])
+            )
+            chunks = tuple(chunks)
+        return group.create_dataset(
+            name,
+            shape=shape,
+            dtype=dtype,
+            data=data,
+            chunks=chunks,
+            compression=self.compression if chunks else None,
+        )
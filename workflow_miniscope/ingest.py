@@ -0,0 +1,402 @@
+"""Bulk ingestion of subject, session and recording manifests
+
+Each manifest is a CSV file with one row per entry. A manifest is read and validated
+in memory as a whole, including references to rows already in the database, and
+nothing is inserted unless every row is valid. Rows whose primary key is already in
+the database are skipped, and the remaining rows are inserted with multi-row inserts
+in one transaction per `batch_size` manifest rows, so a rerun is idempotent and only
+fetches primary keys.
+
+Manifest columns, optional ones in brackets:
+
+    subjects.csv: subject, sex, subject_birth_date, [subject_nickname],
+        [subject_description]
+    sessions.csv: subject, session_dir, session_datetime, [session_note], [user],
+        [recording_id], [device], [acq_software], [recording_notes]
+    recordings.csv: subject, session_datetime, recording_id, device, acq_software,
+        [recording_notes], [recording_location_id]
+
+A session row with `acq_software` also adds one recording of that session, with
+`recording_id` 0 unless given.
+"""
+import csv
+import logging
+from datetime import date, datetime
+
+import datajoint as dj
+
+logger = logging.getLogger("datajoint")
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def ingest_subjects(
+    subject_csv_path: str = "./user_data/subjects.csv",
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    skip_duplicates: bool = True,
+    verbose: bool = True,
+) -> dict:
+    """Insert the subjects of a subject manifest
+
+    Args:
+        subject_csv_path (str, optional): manifest path. Defaults to
+            "./user_data/subjects.csv".
+        batch_size (int, optional): manifest rows per transaction. Defaults to
+            `DEFAULT_BATCH_SIZE`.
+        skip_duplicates (bool, optional): skip rows already in the database instead
+            of raising `dj.errors.DuplicateError`. Defaults to True.
+        verbose (bool, optional): log the number of added and skipped rows. Defaults
+            to True.
+
+    Returns:
+        report (dict): table name to numbers of "added" and "skipped" rows
+    """
+    from .pipeline import subject
+
+    rows = read_manifest(
+        subject_csv_path,
+        required=["subject", "sex", "subject_birth_date"],
+        optional=["subject_nickname", "subject_description"],
+    )
+    errors = []
+    entries = []
+    for line, row in rows:
+        try:
+            if row["sex"] not in ("M", "F", "U"):
+                raise ValueError(f"sex must be M, F or U, got {row['sex']!r}")
+            row["subject_birth_date"] = _parse(
+                date.fromisoformat, row["subject_birth_date"], "subject_birth_date"
+            )
+        except ValueError as error:
+            errors.append(f"line {line}: {error}")
+            continue
+        entries.append((line, {"Subject": row}))
+
+    tables = {"Subject": subject.Subject}
+    _check_duplicate_keys(entries, tables, errors)
+    _raise_errors(subject_csv_path, errors)
+    return insert_entries(tables, entries, batch_size, skip_duplicates, verbose)
+
+
+def ingest_sessions(
+    session_csv_path: str = "./user_data/sessions.csv",
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    skip_duplicates: bool = True,
+    verbose: bool = True,
+) -> dict:
+    """Insert the sessions of a session manifest with their directories and notes
+
+    Args:
+        session_csv_path (str, optional): manifest path. Defaults to
+            "./user_data/sessions.csv".
+        batch_size (int, optional): manifest rows per transaction. Defaults to
+            `DEFAULT_BATCH_SIZE`.
+        skip_duplicates (bool, optional): skip rows already in the database instead
+            of raising `dj.errors.DuplicateError`. Defaults to True.
+        verbose (bool, optional): log the number of added and skipped rows. Defaults
+            to True.
+
+    Returns:
+        report (dict): table name to numbers of "added" and "skipped" rows
+    """
+    from .pipeline import lab, miniscope, session, subject
+
+    rows = read_manifest(
+        session_csv_path,
+        required=["subject", "session_dir", "session_datetime"],
+        optional=[
+            "session_note",
+            "user",
+            "recording_id",
+            "device",
+            "acq_software",
+            "recording_notes",
+        ],
+    )
+    subjects = set(subject.Subject.fetch("subject"))
+    users = set(lab.User.fetch("user"))
+    references = _get_recording_references()
+
+    errors = []
+    entries = []
+    for line, row in rows:
+        try:
+            if row["subject"] not in subjects:
+                raise ValueError(f"unknown subject {row['subject']!r}")
+            session_key = {
+                "subject": row["subject"],
+                "session_datetime": _parse(
+                    datetime.fromisoformat, row["session_datetime"], "session_datetime"
+                ),
+            }
+            entry = {
+                "Session": session_key,
+                "SessionDirectory": {**session_key, "session_dir": row["session_dir"]},
+            }
+            if "session_note" in row:
+                entry["SessionNote"] = {
+                    **session_key,
+                    "session_note": row["session_note"],
+                }
+            if "user" in row:
+                if row["user"] not in users:
+                    raise ValueError(f"unknown user {row['user']!r}")
+                entry["SessionExperimenter"] = {**session_key, "user": row["user"]}
+            if "acq_software" in row:
+                entry.update(
+                    _recording_entry(
+                        {"recording_id": "0", **row}, session_key, references
+                    )
+                )
+        except ValueError as error:
+            errors.append(f"line {line}: {error}")
+            continue
+        entries.append((line, entry))
+
+    tables = {
+        "Session": session.Session,
+        "SessionDirectory": session.SessionDirectory,
+        "SessionNote": session.SessionNote,
+        "SessionExperimenter": session.SessionExperimenter,
+        "Recording": miniscope.Recording,
+    }
+    _check_duplicate_keys(entries, tables, errors)
+    _raise_errors(session_csv_path, errors)
+    return insert_entries(tables, entries, batch_size, skip_duplicates, verbose)
+
+
+def ingest_recordings(
+    recording_csv_path: str = "./user_data/recordings.csv",
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    skip_duplicates: bool = True,
+    verbose: bool = True,
+) -> dict:
+    """Insert the recordings of a recording manifest with their locations
+
+    Args:
+        recording_csv_path (str, optional): manifest path. Defaults to
+            "./user_data/recordings.csv".
+        batch_size (int, optional): manifest rows per transaction. Defaults to
+            `DEFAULT_BATCH_SIZE`.
+        skip_duplicates (bool, optional): skip rows already in the database instead
+            of raising `dj.errors.DuplicateError`. Defaults to True.
+        verbose (bool, optional): log the number of added and skipped rows. Defaults
+            to True.
+
+    Returns:
+        report (dict): table name to numbers of "added" and "skipped" rows
+    """
+    from .pipeline import miniscope, session
+
+    rows = read_manifest(
+        recording_csv_path,
+        required=[
+            "subject",
+            "session_datetime",
+            "recording_id",
+            "device",
+            "acq_software",
+        ],
+        optional=["recording_notes", "recording_location_id"],
+    )
+    sessions = set(_key_tuples(session.Session))
+    references = _get_recording_references()
+
+    errors = []
+    entries = []
+    for line, row in rows:
+        try:
+            session_key = {
+                "subject": row["subject"],
+                "session_datetime": _parse(
+                    datetime.fromisoformat, row["session_datetime"], "session_datetime"
+                ),
+            }
+            if _key_tuple(session.Session, session_key) not in sessions:
+                raise ValueError(f"unknown session {session_key}")
+            entry = _recording_entry(row, session_key, references)
+        except ValueError as error:
+            errors.append(f"line {line}: {error}")
+            continue
+        entries.append((line, entry))
+
+    tables = {
+        "Recording": miniscope.Recording,
+        "RecordingLocation": miniscope.RecordingLocation,
+    }
+    _check_duplicate_keys(entries, tables, errors)
+    _raise_errors(recording_csv_path, errors)
+    return insert_entries(tables, entries, batch_size, skip_duplicates, verbose)
+
+
+def read_manifest(path: str, required: list, optional: list = ()) -> list:
+    """Read a CSV manifest, checking its columns and required values
+
+    Args:
+        path (str): CSV file with a header row
+        required (list): columns that must be present with a value in every row
+        optional (list, optional): other columns to keep if present and not empty
+
+    Returns:
+        rows (list): (line number, row dict) of every row
+
+    Raises:
+        ValueError: if required columns are missing or empty in any row
+    """
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f, skipinitialspace=True)
+        columns = [column.strip() for column in reader.fieldnames or []]
+        missing = [column for column in required if column not in columns]
+        if missing:
+            raise ValueError(f"{path}: missing column(s) {missing}")
+
+        keep = set(required) | set(optional)
+        rows, errors = [], []
+        for line, row in enumerate(reader, start=2):
+            row = {
+                column.strip(): value.strip()
+                for column, value in row.items()
+                if column and column.strip() in keep and value and value.strip()
+            }
+            empty = [column for column in required if column not in row]
+            if empty:
+                errors.append(f"line {line}: empty {empty}")
+            rows.append((line, row))
+
+    _raise_errors(path, errors)
+    return rows
+
+
+def insert_entries(
+    tables: dict,
+    entries: list,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    skip_duplicates: bool = True,
+    verbose: bool = True,
+) -> dict:
+    """Insert validated manifest entries in transactions of `batch_size` entries
+
+    Args:
+        tables (dict): table name to table, in insertion order
+        entries (list): (line number, entry) of each manifest row, where an entry
+            maps table names to the row to insert
+        batch_size (int, optional): entries per transaction. Defaults to
+            `DEFAULT_BATCH_SIZE`.
+        skip_duplicates (bool, optional): skip rows already in the database instead
+            of raising `dj.errors.DuplicateError`. Defaults to True.
+        verbose (bool, optional): log the number of added and skipped rows. Defaults
+            to True.
+
+    Returns:
+        report (dict): table name to numbers of "added" and "skipped" rows
+    """
+    existing = {}
+    report = {}
+    for name, table in tables.items():
+        rows = [entry[name] for _, entry in entries if name in entry]
+        existing[name] = set(_key_tuples(table)) if rows else set()
+        skipped = sum(_key_tuple(table, row) in existing[name] for row in rows)
+        if skipped and not skip_duplicates:
+            raise dj.errors.DuplicateError(
+                f"{skipped} row(s) of {name} are already in the database"
+            )
+        report[name] = {"added": len(rows) - skipped, "skipped": skipped}
+
+    connection = dj.conn()
+    for start in range(0, len(entries), batch_size):
+        batch = entries[start : start + batch_size]
+        with connection.transaction:
+            for name, table in tables.items():
+                rows = [
+                    entry[name]
+                    for _, entry in batch
+                    if name in entry
+                    and _key_tuple(table, entry[name]) not in existing[name]
+                ]
+                if rows:
+                    table.insert(rows, skip_duplicates=True)
+
+    if verbose:
+        for name, counts in report.items():
+            logger.info(
+                f"---- Inserted {counts['added']} and skipped {counts['skipped']}"
+                f" entry(s) in {name} ----"
+            )
+    return report
+
+
+def _get_recording_references() -> dict:
+    from .pipeline import AnatomicalLocation, Device, miniscope
+
+    return {
+        "device": set(Device.fetch("device")),
+        "acq_software": set(miniscope.AcquisitionSoftware.fetch("acq_software")),
+        "recording_location_id": set(AnatomicalLocation.fetch("recording_location_id")),
+    }
+
+
+def _recording_entry(row: dict, session_key: dict, references: dict) -> dict:
+    """Recording and RecordingLocation rows of a manifest row"""
+    missing = [column for column in ("device", "acq_software") if column not in row]
+    if missing:
+        raise ValueError(f"empty {missing}")
+    for column, values in references.items():
+        if column in row and row[column] not in values:
+            raise ValueError(f"unknown {column} {row[column]!r}")
+    recording_key = {
+        **session_key,
+        "recording_id": _parse(int, row["recording_id"], "recording_id"),
+    }
+    entry = {
+        "Recording": {
+            **recording_key,
+            "device": row["device"],
+            "acq_software": row["acq_software"],
+            "recording_notes": row.get("recording_notes", ""),
+        }
+    }
+    if "recording_location_id" in row:
+        entry["RecordingLocation"] = {
+            **recording_key,
+            "recording_location_id": row["recording_location_id"],
+        }
+    return entry
+
+
+def _parse(parser, value: str, column: str):
+    try:
+        return parser(value)
+    except ValueError:
+        raise ValueError(f"invalid {column} {value!r}") from None
+
+
+def _key_tuple(table, row: dict) -> tuple:
+    return tuple(row[attr] for attr in table.primary_key)
+
+
+def _key_tuples(table) -> list:
+    return [_key_tuple(table, key) for key in table.fetch("KEY")]
+
+
+def _check_duplicate_keys(entries: list, tables: dict, errors: list):
+    """Report rows of a manifest with the same primary key in any table"""
+    for name, table in tables.items():
+        first_lines = {}
+        for line, entry in entries:
+            if name not in entry:
+                continue
+            key = _key_tuple(table, entry[name])
+            if key in first_lines:
+                errors.append(
+                    f"line {line}: duplicate {name} of line {first_lines[key]}"
+                )
+            first_lines.setdefault(key, line)
+
+
+def _raise_errors(path: str, errors: list, max_errors: int = 20):
+    if errors:
+        raise ValueError(
+            f"{path}: {len(errors)} invalid row(s)\n"
+            + "\n".join(errors[:max_errors])
+            + ("\n..." if len(errors) > max_errors else "")
+        )
@@ -0,0 +1,316 @@
+"""Random and chunked access to the frames of multi-file Miniscope recordings
+
+`MiniscopeMovie` presents the `.avi` files of a recording (`0.avi`, `1.avi`, ...) as
+one lazy (frames, height, width) uint8 array. Frame ranges are decoded in chunks by
+a pool of threads, each with its own `cv2.VideoCapture`; OpenCV releases the GIL
+while decoding. Miniscope files are intra-frame coded, so seeking is exact.
+
+With a cache directory, the first full pass over the movie also writes the decoded
+frames to a memory-mapped `.npy` file, and every later access, from any process,
+reads from that file instead of decoding again. The cache file is named by the
+paths, sizes and modification times of the movie files.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+from concurrent import futures
+from pathlib import Path
+
+import cv2
+import datajoint as dj
+import numpy as np
+
+logger = logging.getLogger("datajoint")
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class MiniscopeMovie:
+    """Lazy (frames, height, width) array over the `.avi` files of one recording
+
+    Supports `len`, `np.asarray` and NumPy indexing of the frame axis with integers,
+    slices and integer arrays, followed by indices of the other axes.
+
+    Args:
+        file_paths (list): `.avi` files, ordered by their numeric file names
+        chunk_size (int, optional): frames decoded per thread task. Defaults to
+            `DEFAULT_CHUNK_SIZE`.
+        max_workers (int, optional): decoding threads. Defaults to `os.cpu_count()`.
+        cache_dir (str, optional): directory of memory-mapped decoded movies. Defaults
+            to `dj.config["custom"]["movie_cache_dir"]`; no cache if not set.
+    """
+
+    def __init__(self, file_paths, chunk_size=None, max_workers=None, cache_dir=None):
+        self.file_paths = sorted((Path(p) for p in file_paths), key=_file_order)
+        if not self.file_paths:
+            raise ValueError("No movie files given")
+        self.chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        self.max_workers = max_workers or os.cpu_count()
+
+        nframes = []
+        for path in self.file_paths:
+            capture = _open_capture(path)
+            nframes.append(int(capture.get(cv2.CAP_PROP_FRAME_COUNT)))
+            height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            capture.release()
+        self._file_starts = np.concatenate([[0], np.cumsum(nframes)])
+        self.shape = (int(self._file_starts[-1]), height, width)
+        self.dtype = np.dtype(np.uint8)
+        self.ndim = 3
+
+        cache_dir = cache_dir or dj.config.get("custom", {}).get("movie_cache_dir")
+        self.cache_path = (
+            Path(cache_dir) / f"{self._cache_key()}.npy" if cache_dir else None
+        )
+        self._cache = None
+        if self.cache_path is not None and self.cache_path.exists():
+            self._cache = np.load(self.cache_path, mmap_mode="r")
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        frames = self.read()
+        return frames if dtype is None else frames.astype(dtype, copy=False)
+
+    def __getitem__(self, index):
+        frame_index, other_index = (
+            (index[0], index[1:]) if isinstance(index, tuple) else (index, ())
+        )
+        if isinstance(frame_index, (int, np.integer)):
+            frame = (
+                int(frame_index) + len(self) if frame_index < 0 else int(frame_index)
+            )
+            if not 0 <= frame < len(self):
+                raise IndexError(f"frame {frame_index} out of range for {len(self)}")
+            frame = self.read(frame, frame + 1)[0]
+            return frame[other_index] if other_index else frame
+        elif isinstance(frame_index, slice):
+            start, stop, step = frame_index.indices(len(self))
+            if step == 1:
+                frames = self.read(start, max(start, stop))
+            else:
+                frames = self.read_frames(np.arange(start, stop, step))
+        else:
+            frames = self.read_frames(frame_index)
+        return frames[(slice(None), *other_index)] if other_index else frames
+
+    @property
+    def is_cached(self) -> bool:
+        """Whether frames are read from the memory-mapped cache"""
+        return self._cache is not None
+
+    def read(self, start: int = 0, stop: int = None, out: np.ndarray = None):
+        """Decode a contiguous range of frames in parallel chunks
+
+        Args:
+            start (int, optional): first frame. Defaults to 0.
+            stop (int, optional): frame after the last one. Defaults to all frames.
+            out (np.ndarray, optional): (stop - start, height, width) output buffer
+
+        Returns:
+            frames (np.ndarray): (stop - start, height, width) uint8 frames
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        if out is None:
+            out = np.empty((max(stop - start, 0), *self.shape[1:]), dtype=self.dtype)
+        if self._cache is not None:
+            out[:] = self._cache[start:stop]
+            return out
+
+        chunk_starts = range(start, stop, self.chunk_size)
+        if len(chunk_starts) <= 1 or self.max_workers <= 1:
+            self._decode(start, stop, out)
+            return out
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(
+                executor.map(
+                    lambda chunk_start: self._decode(
+                        chunk_start,
+                        min(chunk_start + self.chunk_size, stop),
+                        out[chunk_start - start :],
+                    ),
+                    chunk_starts,
+                )
+            )
+        return out
+
+    def read_frames(self, frames) -> np.ndarray:
+        """Decode frames at arbitrary positions, each consecutive run once
+
+        Args:
+            frames (array_like): frame indices, negative ones counted from the end
+
+        Returns:
+            frames (np.ndarray): (len(frames), height, width) uint8 frames
+        """
+        frames = np.asarray(frames, dtype=np.int64)
+        frames = np.where(frames < 0, frames + len(self), frames)
+        if frames.size and (frames.min() < 0 or frames.max() >= len(self)):
+            raise IndexError(f"frame index out of range for {len(self)} frames")
+        if self._cache is not None:
+            return np.asarray(self._cache[frames])
+
+        unique = np.unique(frames)
+        buffer = np.empty((len(unique), *self.shape[1:]), dtype=self.dtype)
+        if not unique.size:
+            return buffer
+        run_breaks = np.flatnonzero(np.diff(unique) != 1) + 1
+        runs = zip(
+            np.split(unique, run_breaks), np.split(np.arange(len(unique)), run_breaks)
+        )
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(
+                executor.map(
+                    lambda run: self._decode(
+                        int(run[0][0]), int(run[0][-1]) + 1, buffer[run[1][0] :]
+                    ),
+                    runs,
+                )
+            )
+        return buffer[np.searchsorted(unique, frames)]
+
+    def iter_chunks(self, chunk_size: int = None, start: int = 0, stop: int = None):
+        """Yield consecutive chunks of frames, decoding the next chunk in the background
+
+        A full pass over a movie with a cache directory also fills the cache.
+
+        Args:
+            chunk_size (int, optional): frames per chunk. Defaults to `chunk_size` x
+                `max_workers`.
+            start (int, optional): first frame. Defaults to 0.
+            stop (int, optional): frame after the last one. Defaults to all frames.
+
+        Yields:
+            chunk_start (int): index of the first frame of the chunk
+            frames (np.ndarray): (chunk frames, height, width) uint8 frames
+        """
+        chunk_size = chunk_size or self.chunk_size * self.max_workers
+        stop = len(self) if stop is None else min(stop, len(self))
+        spill = self._cache is None and self.cache_path is not None
+        spill = spill and start == 0 and stop == len(self) and self._has_cache_space()
+        if spill:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.cache_path.with_name(
+                f"{self.cache_path.stem}.{os.getpid()}.tmp"
+            )
+            cache = np.lib.format.open_memmap(
+                tmp_path, mode="w+", dtype=self.dtype, shape=self.shape
+            )
+
+        try:
+            with futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+                chunk_starts = list(range(start, stop, chunk_size))
+                next_chunk = None
+                for i, chunk_start in enumerate(chunk_starts):
+                    chunk_stop = min(chunk_start + chunk_size, stop)
+                    frames = (
+                        next_chunk.result()
+                        if next_chunk is not None
+                        else self.read(chunk_start, chunk_stop)
+                    )
+                    if i + 1 < len(chunk_starts):
+                        next_chunk = prefetcher.submit(
+                            self.read,
+                            chunk_starts[i + 1],
+                            min(chunk_starts[i + 1] + chunk_size, stop),
+                        )
+                    if spill:
+                        cache[chunk_start:chunk_stop] = frames
+                    yield chunk_start, frames
+        except BaseException:
+            if spill:
+                del cache
+                tmp_path.unlink(missing_ok=True)
+            raise
+
+        if spill:
+            cache.flush()
+            del cache
+            os.replace(tmp_path, self.cache_path)
+            self._cache = np.load(self.cache_path, mmap_mode="r")
+
+    def cache(self):
+        """Decode the whole movie into the cache directory, if not already cached"""
+        if self.cache_path is None:
+            raise ValueError("No cache directory: set `movie_cache_dir` or `cache_dir`")
+        for _ in self.iter_chunks():
+            pass
+
+    def _decode(self, start: int, stop: int, out: np.ndarray):
+        """Decode frames [start, stop) into out[:stop - start], file by file"""
+        position = start
+        while position < stop:
+            file_idx = (
+                int(np.searchsorted(self._file_starts, position, side="right")) - 1
+            )
+            file_stop = min(stop, int(self._file_starts[file_idx + 1]))
+            path = self.file_paths[file_idx]
+            capture = _open_capture(path)
+            try:
+                local_start = position - int(self._file_starts[file_idx])
+                if local_start:
+                    capture.set(cv2.CAP_PROP_POS_FRAMES, local_start)
+                for frame_idx in range(position, file_stop):
+                    success, frame = capture.read()
+                    if not success:
+                        raise OSError(
+                            f"Cannot decode frame {frame_idx - position + local_start}"
+                            f" of {path}"
+                        )
+                    out[frame_idx - start] = frame[..., 0] if frame.ndim == 3 else frame
+            finally:
+                capture.release()
+            position = file_stop
+
+    def _cache_key(self) -> str:
+        files = []
+        for path in self.file_paths:
+            stat = path.stat()
+            files.append([path.resolve().as_posix(), stat.st_size, stat.st_mtime_ns])
+        return hashlib.md5(json.dumps(files).encode()).hexdigest()
+
+    def _has_cache_space(self) -> bool:
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        required = int(np.prod(self.shape)) * self.dtype.itemsize
+        free = shutil.disk_usage(self.cache_path.parent).free
+        if free < required:
+            logger.warning(
+                f"Not caching movie: {required / 1e9:.1f} GB needed in"
+                f" {self.cache_path.parent}, {free / 1e9:.1f} GB free"
+            )
+        return free >= required
+
+
+def get_recording_movie(key: dict, **kwargs) -> MiniscopeMovie:
+    """Return the movie of a recording from its `miniscope.RecordingInfo.File` rows
+
+    Args:
+        key (dict): primary key of `miniscope.RecordingInfo`
+        **kwargs: arguments of `MiniscopeMovie`
+
+    Returns:
+        movie (MiniscopeMovie): lazy array over the recording files
+    """
+    from .paths import find_full_paths, get_miniscope_root_data_dir
+    from .pipeline import miniscope
+
+    file_paths = (miniscope.RecordingInfo.File & key).fetch("file_path")
+    return MiniscopeMovie(
+        find_full_paths(get_miniscope_root_data_dir(), list(file_paths)), **kwargs
+    )
+
+
+def _open_capture(path: Path):
+    capture = cv2.VideoCapture(Path(path).as_posix())
+    if not capture.isOpened():
+        raise OSError(f"Cannot open movie file {path}")
+    return capture
+
+
+def _file_order(path: Path) -> tuple:
+    """Order numbered Miniscope files (0.avi, 1.avi, ..., 10.avi) numerically"""
+    return (0, int(path.stem), "") if path.stem.isdigit() else (1, 0, path.stem)
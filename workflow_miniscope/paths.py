@@ -1,8 +1,24 @@
+import atexit
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
 from collections import abc
+from concurrent import futures
+from pathlib import Path
 from typing import Union
 
 import datajoint as dj
 
+_resolvers = {}
+_resolvers_lock = threading.Lock()
+
+_session_dirs = {}  # SessionDirectory primary key values -> session_dir
+_session_dirs_state = {"checked": None, "signature": None, "rechecked": {}}
+_session_dirs_lock = threading.Lock()
+
 
 def get_miniscope_root_data_dir() -> Union[list, None]:
     """Return root directory for miniscope from 'miniscope_root_data_dir' config as list
@@ -23,13 +39,399 @@ def get_miniscope_root_data_dir() -> Union[list, None]:
 def get_session_directory(session_key: dict) -> str:
     """Return relative path from SessionDirectory table given key
 
+    Served from the per-process cache of `get_session_directories`. On a cache miss
+    every row of `SessionDirectory` is loaded in one query, so that calls for the
+    other sessions of a backlog do not query the database.
+
     Args:
         session_key (dict): Key uniquely identifying a session
 
     Returns:
         path (str): Relative path of session directory
     """
+    _validate_session_directory_cache()
+    session_dir = _lookup_session_directory(session_key)
+    if _needs_recheck([session_dir]) and _validate_session_directory_cache(force=True):
+        session_dir = _lookup_session_directory(session_key)
+    return session_dir
+
+
+def _lookup_session_directory(session_key: dict) -> str:
     from .pipeline import session
 
-    session_dir = (session.SessionDirectory & session_key).fetch1("session_dir")
+    key = _session_key_tuple(session_key)
+    with _session_dirs_lock:
+        session_dir = _session_dirs.get(key)
+    if session_dir is None and key is not None:
+        _load_session_directories(session.SessionDirectory)
+        with _session_dirs_lock:
+            session_dir = _session_dirs.get(key)
+    if session_dir is None:  # partial key, or not in SessionDirectory
+        session_dir = (session.SessionDirectory & session_key).fetch1("session_dir")
     return session_dir
+
+
+def get_session_directories(session_keys: list) -> list:
+    """Return the relative session directories of many sessions with one query
+
+    Directories are cached per process. The cache is cleared when the rows of
+    `SessionDirectory` change, which is checked with one aggregate query at most
+    every `dj.config["custom"]["session_dir_cache_ttl"]` seconds (default 60), and
+    right away when a cached directory is not found under the root data
+    directories, at most once per TTL for each such directory.
+
+    Args:
+        session_keys (list): keys uniquely identifying each session, e.g. recording
+            keys
+
+    Returns:
+        paths (list): relative path of each session directory
+
+    Raises:
+        dj.errors.DataJointError: if a session has no `SessionDirectory` row
+    """
+    _validate_session_directory_cache()
+    session_dirs = _lookup_session_directories(session_keys)
+    if _needs_recheck(session_dirs) and _validate_session_directory_cache(force=True):
+        session_dirs = _lookup_session_directories(session_keys)
+    return session_dirs
+
+
+def _lookup_session_directories(session_keys: list) -> list:
+    from .pipeline import session
+
+    keys = [_session_key_tuple(session_key) for session_key in session_keys]
+    with _session_dirs_lock:
+        missing = [
+            session_key
+            for session_key, key in zip(session_keys, keys)
+            if key not in _session_dirs
+        ]
+    if missing:
+        _load_session_directories(session.SessionDirectory & missing)
+
+    session_dirs = []
+    for session_key, key in zip(session_keys, keys):
+        with _session_dirs_lock:
+            session_dir = _session_dirs.get(key)
+        if session_dir is None:  # partial key, or not in SessionDirectory
+            session_dir = get_session_directory(session_key)
+        session_dirs.append(session_dir)
+    return session_dirs
+
+
+def clear_session_directory_cache():
+    """Forget every cached session directory of this process"""
+    with _session_dirs_lock:
+        _session_dirs.clear()
+        _session_dirs_state.update(checked=None, signature=None, rechecked={})
+
+
+def _session_key_tuple(session_key: dict):
+    from .pipeline import session
+
+    try:
+        return tuple(session_key[attr] for attr in session.SessionDirectory.primary_key)
+    except (KeyError, TypeError):
+        return None
+
+
+def _load_session_directories(query):
+    """Cache the session directories of every row of a SessionDirectory query"""
+    rows = query.fetch(*query.primary_key, "session_dir", as_dict=True)
+    with _session_dirs_lock:
+        for row in rows:
+            session_dir = row.pop("session_dir")
+            _session_dirs[tuple(row.values())] = session_dir
+
+
+def _validate_session_directory_cache(force: bool = False) -> bool:
+    """Clear the cache if SessionDirectory changed since it was last checked
+
+    Args:
+        force (bool, optional): check even if the last check is more recent than
+            the TTL. Defaults to False.
+
+    Returns:
+        cleared (bool): whether the cache was cleared
+    """
+    from .pipeline import session
+
+    now = time.monotonic()
+    ttl = dj.config.get("custom", {}).get("session_dir_cache_ttl", 60.0)
+    checked = _session_dirs_state["checked"]
+    if not force and checked is not None and now - checked < ttl:
+        return False
+
+    attributes = ", ".join(
+        f"`{attr}`" for attr in [*session.SessionDirectory.primary_key, "session_dir"]
+    )
+    signature = (
+        dj.U()
+        .aggr(
+            session.SessionDirectory,
+            nrows="COUNT(*)",
+            checksum=f"BIT_XOR(CRC32(CONCAT_WS('|', {attributes})))",
+        )
+        .fetch1("nrows", "checksum")
+    )
+    with _session_dirs_lock:
+        cleared = signature != _session_dirs_state["signature"]
+        if cleared:
+            _session_dirs.clear()
+        _session_dirs_state.update(checked=now, signature=signature)
+    return cleared
+
+
+def _needs_recheck(session_dirs: list) -> bool:
+    """Whether a session directory is not found under the root data directories
+    and was not re-checked in SessionDirectory within the TTL
+
+    Directories missing on this host, e.g. on workers that only use the database,
+    thus cost one check per TTL instead of one per call. Nothing is re-checked if no
+    root directory is configured.
+    """
+    root_dirs = get_miniscope_root_data_dir()
+    if not root_dirs:
+        return False
+    full_paths = get_path_resolver(root_dirs).resolve_many(
+        session_dirs, missing_ok=True
+    )
+    now = time.monotonic()
+    ttl = dj.config.get("custom", {}).get("session_dir_cache_ttl", 60.0)
+    with _session_dirs_lock:
+        rechecked = _session_dirs_state["rechecked"]
+        due = {
+            session_dir
+            for session_dir, full_path in zip(session_dirs, full_paths)
+            if full_path is None and now - rechecked.get(session_dir, -ttl) >= ttl
+        }
+        rechecked.update(dict.fromkeys(due, now))
+    return bool(due)
+
+
+class PathResolver:
+    """Resolve relative paths against root directories, remembering each path's root
+
+    As in `element_interface.utils.find_full_path`, a path that exists as given
+    (absolute, or relative to the working directory) is returned as is, and other
+    paths are searched under each root in order. The root of a resolved path is
+    remembered and checked with a single `stat()` on later calls, and every root is
+    probed again if the path has disappeared. Paths found under no root are
+    remembered for `negative_ttl` seconds. With `cache_path`, the resolved roots are
+    also saved to a JSON file and loaded by later processes.
+
+    Args:
+        root_dirs (list): root directories, searched in order
+        cache_path (str, optional): JSON file persisting resolved roots
+        negative_ttl (float, optional): (s) how long unresolved paths are
+            remembered. Defaults to 60.
+        max_workers (int, optional): threads probing paths in `resolve_many`.
+            Defaults to 16.
+    """
+
+    def __init__(self, root_dirs, cache_path=None, negative_ttl=60.0, max_workers=16):
+        if isinstance(root_dirs, (str, Path)):
+            root_dirs = [root_dirs]
+        self.root_dirs = [Path(root).expanduser() for root in root_dirs]
+        self.cache_path = Path(cache_path).expanduser() if cache_path else None
+        self.negative_ttl = negative_ttl
+        self.max_workers = max_workers
+        self._roots = {}  # relative path -> root directory, "." if found as given
+        self._missing = {}  # relative path -> expiry time
+        self._lock = threading.Lock()
+        self._changed = False
+
+        if self.cache_path is not None:
+            try:
+                saved = json.loads(self.cache_path.read_text())
+            except (FileNotFoundError, ValueError):
+                saved = {}
+            roots = {root.as_posix(): root for root in self.root_dirs}
+            self._roots = {
+                relative_path: roots[root]
+                for relative_path, root in saved.items()
+                if root in roots
+            }
+
+    def resolve(self, relative_path) -> Path:
+        """Full path of a relative path, like `element_interface.utils.find_full_path`
+
+        Args:
+            relative_path (str): path relative to one of the root directories
+
+        Returns:
+            full_path (pathlib.Path): root directory joined with `relative_path`
+
+        Raises:
+            FileNotFoundError: if the path is under none of the root directories
+        """
+        return self.resolve_many([relative_path])[0]
+
+    def resolve_many(self, relative_paths: list, missing_ok: bool = False) -> list:
+        """Full paths of many relative paths, probing uncached paths concurrently
+
+        Args:
+            relative_paths (list): paths relative to the root directories
+            missing_ok (bool, optional): return None for unresolved paths instead of
+                raising. Defaults to False.
+
+        Returns:
+            full_paths (list): full path of each relative path
+
+        Raises:
+            FileNotFoundError: if a path is under none of the root directories
+        """
+        keys = [Path(path).expanduser().as_posix() for path in relative_paths]
+        now = time.monotonic()
+        with self._lock:
+            roots = {key: self._roots.get(key) for key in keys}
+            to_probe = {
+                key
+                for key, root in roots.items()
+                if root is None and self._missing.get(key, 0) <= now
+            }
+
+        to_verify = sorted(key for key, root in roots.items() if root is not None)
+        exists = self._map(lambda key: (roots[key] / key).exists(), to_verify)
+        to_probe |= {key for key, found in zip(to_verify, exists) if not found}
+        if to_probe:
+            to_probe = sorted(to_probe)
+            probed = dict(zip(to_probe, self._map(self._probe, to_probe)))
+            expiry = time.monotonic() + self.negative_ttl
+            with self._lock:
+                for key, root in probed.items():
+                    if root is None:
+                        self._roots.pop(key, None)
+                        self._missing[key] = expiry
+                    else:
+                        self._roots[key] = root
+                        self._missing.pop(key, None)
+                self._changed = True
+            roots.update(probed)
+
+        full_paths = []
+        for key in keys:
+            full_path = roots[key] / key if roots[key] is not None else None
+            if full_path is None and not missing_ok:
+                raise FileNotFoundError(
+                    f"No valid full-path found (from {self.root_dirs}) for {key}"
+                )
+            full_paths.append(full_path)
+        return full_paths
+
+    def invalidate(self, relative_path=None):
+        """Forget the root of one relative path, or of every path"""
+        with self._lock:
+            if relative_path is None:
+                self._roots.clear()
+                self._missing.clear()
+            else:
+                key = Path(relative_path).expanduser().as_posix()
+                self._roots.pop(key, None)
+                self._missing.pop(key, None)
+            self._changed = True
+
+    def save(self):
+        """Write the resolved roots to `cache_path`, if set"""
+        if self.cache_path is None or not self._changed:
+            return
+        with self._lock:
+            saved = {key: root.as_posix() for key, root in self._roots.items()}
+            self._changed = False
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.cache_path.parent, suffix=".tmp", delete=False
+        ) as f:
+            json.dump(saved, f)
+        os.replace(f.name, self.cache_path)
+
+    def _probe(self, key: str):
+        """Root directory holding `key`, or None. Paths existing as given have root
+        ".", which joined with `key` gives `key` back."""
+        if Path(key).exists():
+            return Path(".")
+        return next((root for root in self.root_dirs if (root / key).exists()), None)
+
+    def _map(self, func, keys: list) -> list:
+        """Apply a file system probe to every key, in threads if there are several"""
+        if len(keys) <= 1 or self.max_workers <= 1:
+            return [func(key) for key in keys]
+        with futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(func, keys))
+
+
+def get_path_resolver(root_dirs=None) -> PathResolver:
+    """Return the per-process resolver of a list of root directories
+
+    The resolver is persisted to `dj.config["custom"]["path_cache"]` if set, with
+    unresolved paths remembered for `path_cache_negative_ttl` seconds (default 60).
+
+    Args:
+        root_dirs (list, optional): root directories. Defaults to
+            `get_miniscope_root_data_dir()`.
+
+    Returns:
+        resolver (PathResolver): resolver shared by every caller in the process
+    """
+    if root_dirs is None:
+        root_dirs = get_miniscope_root_data_dir() or []
+    if isinstance(root_dirs, (str, Path)):
+        root_dirs = [root_dirs]
+    resolver_key = tuple(Path(root).expanduser().as_posix() for root in root_dirs)
+
+    with _resolvers_lock:
+        if resolver_key not in _resolvers:
+            custom = dj.config.get("custom", {})
+            cache_path = custom.get("path_cache")
+            if cache_path:
+                digest = hashlib.md5("\n".join(resolver_key).encode()).hexdigest()
+                cache_path = Path(cache_path).expanduser()
+                cache_path = cache_path.with_name(
+                    f"{cache_path.stem}_{digest[:8]}{cache_path.suffix}"
+                )
+            resolver = PathResolver(
+                root_dirs,
+                cache_path=cache_path,
+                negative_ttl=custom.get("path_cache_negative_ttl", 60.0),
+            )
+            if cache_path:
+                atexit.register(resolver.save)
+            _resolvers[resolver_key] = resolver
+        return _resolvers[resolver_key]
+
+
+def find_full_path(root_directories, relative_path) -> Path:
+    """Memoized `element_interface.utils.find_full_path` through `get_path_resolver`
+
+    Returns the same paths as the element: `relative_path` itself if it exists as
+    given, else the first root directory holding it. A remembered root is checked
+    with one `stat()` per call instead of probing every root.
+
+    Args:
+        root_directories (list): root directories, searched in order
+        relative_path (str): path relative to one of the root directories
+
+    Returns:
+        full_path (pathlib.Path): root directory joined with `relative_path`
+
+    Raises:
+        FileNotFoundError: if the path is under none of the root directories
+    """
+    return get_path_resolver(root_directories).resolve(relative_path)
+
+
+def find_full_paths(root_directories, relative_paths: list) -> list:
+    """Memoized `find_full_path` of many relative paths with concurrent probes
+
+    Args:
+        root_directories (list): root directories, searched in order
+        relative_paths (list): paths relative to one of the root directories
+
+    Returns:
+        full_paths (list): full path of each relative path
+
+    Raises:
+        FileNotFoundError: if a path is under none of the root directories
+    """
+    return get_path_resolver(root_directories).resolve_many(relative_paths)
@@ -1,22 +1,26 @@
+"""Activation of the element schemas of the workflow
+
+By default every schema is activated on import. With `lazy_activation` set in
+`dj.config["custom"]` (or the `LAZY_ACTIVATION` environment variable), importing this
+module neither imports the elements nor connects to the database. Each schema is
+activated, together with the schemas it depends on, on first access of one of its
+names, e.g. `from workflow_miniscope.pipeline import miniscope`.
+"""
+import threading
+import time
+
 import datajoint as dj
-from element_animal import subject
-from element_animal.subject import Subject
-from element_event import event, trial
-from element_lab import lab
-from element_lab.lab import Lab, Project, Protocol, Source, User
-from element_miniscope import miniscope, miniscope_report
-from element_session import session_with_datetime as session
-from element_session.session_with_datetime import Session
+from element_interface.utils import value_to_bool
 
+from . import import_times
 from .paths import get_miniscope_root_data_dir, get_session_directory
-from .reference import AnatomicalLocation, Device
 
 if "custom" not in dj.config:
     dj.config["custom"] = {}
 
 db_prefix = dj.config["custom"].get("database.prefix", "")
 
-__all__ = [
+__all__ = [  # noqa: F822 - resolved by __getattr__ in lazy mode
     "lab",
     "subject",
     "session",
@@ -37,11 +41,128 @@ __all__ = [
     "get_session_directory",
 ]
 
+
 # Activate schemas
 
-Experimenter = lab.User
-lab.activate(db_prefix + "lab")
-subject.activate(db_prefix + "subject", linking_module=__name__)
-session.activate(db_prefix + "session", linking_module=__name__)
-trial.activate(db_prefix + "trial", db_prefix + "event", linking_module=__name__)
-miniscope.activate(db_prefix + "miniscope", linking_module=__name__)
+
+def _activate_lab() -> dict:
+    from element_lab import lab
+    from element_lab.lab import Lab, Project, Protocol, Source, User
+
+    lab.activate(db_prefix + "lab")
+    return dict(
+        lab=lab,
+        Lab=Lab,
+        Project=Project,
+        Protocol=Protocol,
+        Source=Source,
+        User=User,
+        Experimenter=lab.User,
+    )
+
+
+def _activate_subject() -> dict:
+    from element_animal import subject
+    from element_animal.subject import Subject
+
+    subject.activate(db_prefix + "subject", linking_module=__name__)
+    return dict(subject=subject, Subject=Subject)
+
+
+def _activate_session() -> dict:
+    from element_session import session_with_datetime as session
+    from element_session.session_with_datetime import Session
+
+    session.activate(db_prefix + "session", linking_module=__name__)
+    return dict(session=session, Session=Session)
+
+
+def _activate_trial() -> dict:
+    from element_event import event, trial
+
+    trial.activate(db_prefix + "trial", db_prefix + "event", linking_module=__name__)
+    return dict(trial=trial, event=event)
+
+
+def _activate_reference() -> dict:
+    from .reference import AnatomicalLocation, Device
+
+    return dict(AnatomicalLocation=AnatomicalLocation, Device=Device)
+
+
+def _activate_miniscope() -> dict:
+    from element_miniscope import miniscope, miniscope_report
+
+    miniscope.activate(db_prefix + "miniscope", linking_module=__name__)
+    return dict(miniscope=miniscope, miniscope_report=miniscope_report)
+
+
+# Schema name to (activation function, schemas that must be activated first), in
+# dependency order. Each activation function returns the names it adds to the module.
+_SCHEMAS = {
+    "lab": (_activate_lab, []),
+    "subject": (_activate_subject, ["lab"]),
+    "session": (_activate_session, ["subject"]),
+    "trial": (_activate_trial, ["session"]),
+    "reference": (_activate_reference, []),
+    "miniscope": (_activate_miniscope, ["session", "reference"]),
+}
+
+# Module attribute to the schema providing it
+_PROVIDED_BY = {
+    "lab": "lab",
+    "Lab": "lab",
+    "Project": "lab",
+    "Protocol": "lab",
+    "Source": "lab",
+    "User": "lab",
+    "Experimenter": "lab",
+    "subject": "subject",
+    "Subject": "subject",
+    "session": "session",
+    "Session": "session",
+    "trial": "trial",
+    "event": "trial",
+    "AnatomicalLocation": "reference",
+    "Device": "reference",
+    "miniscope": "miniscope",
+    "miniscope_report": "miniscope",
+}
+
+_activated = set()
+_activation_lock = threading.RLock()
+
+
+def activate(*schemas: str):
+    """Activate schemas and their upstream schemas, if not already activated
+
+    Args:
+        *schemas (str): keys of `_SCHEMAS`. Defaults to all schemas.
+    """
+    with _activation_lock:
+        for schema in schemas or _SCHEMAS:
+            _activate(schema)
+
+
+def _activate(schema: str):
+    if schema in _activated:
+        return
+    activation, upstream = _SCHEMAS[schema]
+    for upstream_schema in upstream:
+        _activate(upstream_schema)
+    start = time.perf_counter()
+    globals().update(activation())
+    import_times[f"pipeline.{schema}"] = time.perf_counter() - start
+    _activated.add(schema)
+
+
+def __getattr__(name: str):
+    """Activate the schema providing `name` on first access in lazy mode"""
+    if name not in _PROVIDED_BY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    activate(_PROVIDED_BY[name])
+    return globals()[name]
+
+
+if not value_to_bool(dj.config["custom"].get("lazy_activation")):
+    activate()
@@ -0,0 +1,200 @@
+"""Rendering of event-aligned activity for single ROIs and ROI galleries"""
+import hashlib
+import json
+import os
+from concurrent import futures
+from pathlib import Path
+
+import numpy as np
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+from matplotlib.image import imread
+
+
+def downsample_time_axis(
+    values: np.ndarray, timestamps: np.ndarray, width: int
+) -> tuple:
+    """Average consecutive samples so that the last axis has at most `width` samples
+
+    Args:
+        values (np.ndarray): (..., samples) array, NaN for missing samples
+        timestamps (np.ndarray): (samples,) time of each sample
+        width (int): maximum number of samples to keep, e.g. the plot width in pixels
+
+    Returns:
+        values (np.ndarray): (..., <=width) downsampled array
+        timestamps (np.ndarray): (<=width,) time of the first sample of each group
+    """
+    nsamples = values.shape[-1]
+    if nsamples <= width:
+        return values, timestamps
+
+    group_starts = np.unique(
+        np.linspace(0, nsamples, width, endpoint=False).astype(int)
+    )
+    finite = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(finite, values, 0), group_starts, axis=-1)
+    counts = np.add.reduceat(finite, group_starts, axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        downsampled = np.where(counts > 0, sums / counts, np.nan)
+    return downsampled, timestamps[group_starts]
+
+
+def draw_aligned_activity(
+    ax0, ax1, aligned_timestamps: np.ndarray, aligned_trials: np.ndarray
+):
+    """Draw the trial heatmap and trial-averaged trace of one ROI
+
+    Args:
+        ax0 (matplotlib.axes.Axes): axes for the (trials x samples) heatmap
+        ax1 (matplotlib.axes.Axes): axes for the trial-averaged trace
+        aligned_timestamps (np.ndarray): (samples,) time relative to the event
+        aligned_trials (np.ndarray): (trials, samples) aligned activity
+    """
+    ax0.imshow(
+        aligned_trials,
+        cmap="inferno",
+        interpolation="nearest",
+        aspect="auto",
+        extent=(
+            aligned_timestamps[0],
+            aligned_timestamps[-1],
+            0,
+            aligned_trials.shape[0],
+        ),
+    )
+    ax0.axvline(x=0, linestyle="--", color="white")
+    ax0.set_axis_off()
+
+    finite = ~np.isnan(aligned_trials)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        trial_average = np.where(finite, aligned_trials, 0).sum(axis=0) / finite.sum(
+            axis=0
+        )
+    ax1.plot(aligned_timestamps, trial_average)
+    ax1.axvline(x=0, linestyle="--", color="black")
+    ax1.set_xlabel("Time (s)")
+    ax1.set_xlim(aligned_timestamps[0], aligned_timestamps[-1])
+
+
+def render_roi_images(
+    aligned_timestamps: np.ndarray,
+    rois: list,
+    aligned_activities: np.ndarray,
+    paths: list,
+    width: int = 400,
+    dpi: int = 100,
+):
+    """Render one PNG per ROI. Runs in worker processes of `render_gallery`.
+
+    Args:
+        aligned_timestamps (np.ndarray): (samples,) time relative to the event
+        rois (list): mask of each ROI
+        aligned_activities (np.ndarray): (rois, trials, samples) aligned activity,
+            already downsampled to `width`
+        paths (list): output PNG path of each ROI
+        width (int, optional): image width in pixels. Defaults to 400.
+        dpi (int, optional): image resolution. Defaults to 100.
+    """
+    for roi, aligned_trials, path in zip(rois, aligned_activities, paths):
+        fig = Figure(figsize=(width / dpi, 0.75 * width / dpi), dpi=dpi)
+        ax0, ax1 = fig.subplots(2, 1)
+        draw_aligned_activity(ax0, ax1, aligned_timestamps, aligned_trials)
+        fig.suptitle(f"mask {roi}")
+        tmp_path = Path(path).with_suffix(".tmp.png")
+        fig.savefig(tmp_path, dpi=dpi)
+        os.replace(tmp_path, path)
+
+
+def get_gallery_paths(
+    cache_dir, key: dict, rois: list, width: int, dpi: int, signature=None
+) -> list:
+    """Cached PNG path of each ROI, keyed by condition, content signature, ROI and
+    render settings
+
+    Args:
+        cache_dir (str): image cache directory
+        key (dict): key of the condition
+        rois (list): mask of each ROI
+        width (int): image width in pixels
+        dpi (int): image resolution
+        signature (optional): JSON-serializable summary of the plotted data, e.g.
+            checksums of its rows, so that changed data never maps to a cached image
+
+    Returns:
+        paths (list): PNG path of each ROI
+    """
+    condition_hash = hashlib.md5(
+        json.dumps([key, signature], sort_keys=True, default=str).encode()
+    ).hexdigest()
+    condition_dir = Path(cache_dir) / condition_hash
+    condition_dir.mkdir(parents=True, exist_ok=True)
+    return [condition_dir / f"mask_{roi}_{width}px_{dpi}dpi.png" for roi in rois]
+
+
+def render_gallery(
+    aligned_timestamps: np.ndarray,
+    rois: list,
+    aligned_activities: np.ndarray,
+    paths: list,
+    width: int = 400,
+    dpi: int = 100,
+    processes: int = None,
+    rois_per_task: int = 16,
+):
+    """Render ROI images in parallel worker processes
+
+    Args:
+        aligned_timestamps (np.ndarray): (samples,) time relative to the event
+        rois (list): mask of each ROI
+        aligned_activities (np.ndarray): (trials, rois, samples) aligned activity
+        paths (list): output PNG path of each ROI
+        width (int, optional): image width in pixels. Defaults to 400.
+        dpi (int, optional): image resolution. Defaults to 100.
+        processes (int, optional): worker processes. Defaults to `os.cpu_count()`.
+        rois_per_task (int, optional): ROIs rendered per worker task. Defaults to 16.
+    """
+    roi_major, timestamps = downsample_time_axis(
+        np.asarray(aligned_activities).transpose(1, 0, 2), aligned_timestamps, width
+    )
+    tasks = [
+        (
+            timestamps,
+            rois[start : start + rois_per_task],
+            roi_major[start : start + rois_per_task],
+            paths[start : start + rois_per_task],
+            width,
+            dpi,
+        )
+        for start in range(0, len(rois), rois_per_task)
+    ]
+    if processes == 1 or len(tasks) <= 1:
+        for task in tasks:
+            render_roi_images(*task)
+        return
+
+    with futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        for result in [executor.submit(render_roi_images, *task) for task in tasks]:
+            result.result()
+
+
+def save_gallery_pdf(paths: list, output_path, ncols: int = 4, nrows: int = 4):
+    """Arrange ROI images into grid pages of a multi-page PDF
+
+    Args:
+        paths (list): PNG path of each ROI
+        output_path (str): PDF file to write
+        ncols (int, optional): ROI images per row. Defaults to 4.
+        nrows (int, optional): rows per page. Defaults to 4.
+    """
+    per_page = ncols * nrows
+    with PdfPages(output_path) as pdf:
+        for start in range(0, len(paths), per_page):
+            fig = Figure(figsize=(4 * ncols, 3 * nrows))
+            axs = np.ravel(fig.subplots(nrows, ncols, squeeze=False))
+            for ax, path in zip(axs, paths[start : start + per_page]):
+                ax.imshow(imread(path))
+            for ax in axs:
+                ax.set_axis_off()
+            fig.tight_layout()
+            pdf.savefig(fig)
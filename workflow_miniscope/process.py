@@ -0,0 +1,477 @@
+"""Populate the auto-processing tables of the workflow
+
+Run all tables in dependency order in the current process with `run()`, or spread
+the work over a pool of worker processes with `run(processes=N)`. From a shell:
+
+    workflow-miniscope-process --processes 8 --concurrency Processing=1
+
+With a memory budget, the number of concurrent Processing jobs is limited by their
+estimated memory instead of a fixed count (see `scheduler`):
+
+    workflow-miniscope-process --processes 8 --memory-budget 200
+"""
+import argparse
+import logging
+import multiprocessing
+import signal
+import threading
+from concurrent import futures
+
+import datajoint as dj
+from element_interface.utils import dict_to_uuid, value_to_bool
+
+from .scheduler import MemoryScheduler, populate_processing
+
+logger = logging.getLogger("datajoint")
+
+# Tables populated by `run`, in dependency order
+POPULATE_TABLES = [
+    "RecordingInfo",
+    "RecordingSummary",
+    "Processing",
+    "MotionCorrection",
+    "Segmentation",
+    "MaskSpatialIndex",
+    "Fluorescence",
+    "Activity",
+    "ActivityPyramid",
+    "QualityMetrics",
+    "ActivityAlignment",
+    "ActivityAlignmentPSTH",
+    "MaskRegistration",
+]
+
+# Default per-table limit on concurrent populate calls when running in parallel;
+# tables not listed may use every worker. RecordingSummary already starts a worker
+# process per CPU in each call.
+DEFAULT_CONCURRENCY = {"Processing": 1, "RecordingSummary": 1}
+
+
+def get_populate_tables() -> dict:
+    """Return the auto-processing tables of the workflow by name
+
+    With `dj.config["custom"]["profile_makes"]` set, the `make` calls of the
+    tables are recorded by `profiling.instrument`.
+
+    Returns:
+        tables (dict): table name to table class, in dependency order
+    """
+    from .analysis import ActivityAlignment, ActivityAlignmentPSTH
+    from .pipeline import miniscope, miniscope_report
+    from .quality import RecordingSummary
+    from .registration import MaskRegistration, MaskSpatialIndex
+    from .visualization import ActivityPyramid
+
+    tables = {
+        "RecordingInfo": miniscope.RecordingInfo,
+        "RecordingSummary": RecordingSummary,
+        "Processing": miniscope.Processing,
+        "MotionCorrection": miniscope.MotionCorrection,
+        "Segmentation": miniscope.Segmentation,
+        "MaskSpatialIndex": MaskSpatialIndex,
+        "Fluorescence": miniscope.Fluorescence,
+        "Activity": miniscope.Activity,
+        "ActivityPyramid": ActivityPyramid,
+        "QualityMetrics": miniscope_report.QualityMetrics,
+        "ActivityAlignment": ActivityAlignment,
+        "ActivityAlignmentPSTH": ActivityAlignmentPSTH,
+        "MaskRegistration": MaskRegistration,
+    }
+    tables = {name: tables[name] for name in POPULATE_TABLES}
+    if value_to_bool(dj.config.get("custom", {}).get("profile_makes")):
+        from .profiling import instrument
+
+        instrument(tables.values())
+    return tables
+
+
+def run(
+    display_progress: bool = True,
+    reserve_jobs: bool = False,
+    suppress_errors: bool = False,
+    processes: int = 1,
+    table_concurrency: dict = None,
+    tables: list = None,
+    memory_budget: int = None,
+):
+    """Populate the auto-processing tables of the workflow
+
+    With `processes=1` each table is populated in turn in the current process. With
+    more processes, keys are dispatched one at a time to a pool of workers as soon
+    as they appear in a table's key source, so downstream tables start while
+    upstream tables are still being populated. Parallel runs always reserve jobs so
+    that several nodes can work on the same pipeline. SIGINT and SIGTERM stop new
+    dispatches and wait for running `make` calls to finish.
+
+    Args:
+        display_progress (bool, optional): Show progress bars. Defaults to True.
+        reserve_jobs (bool, optional): Reserve jobs in sequential runs. Defaults to
+            False.
+        suppress_errors (bool, optional): Continue past errors in sequential runs.
+            Parallel runs always continue and log errors. Defaults to False.
+        processes (int, optional): Number of worker processes. Defaults to 1.
+        table_concurrency (dict, optional): Table name to maximum concurrent
+            populate calls in parallel runs. Updates `DEFAULT_CONCURRENCY`.
+        tables (list, optional): Names of the tables to populate. Defaults to
+            `POPULATE_TABLES`.
+        memory_budget (int, optional): Bytes available to Processing jobs in
+            parallel runs. If set, or if `dj.config["custom"]
+            ["processing_memory_budget"]` is set, Processing jobs are packed within
+            this budget by `scheduler.MemoryScheduler`, each in a fresh process, and
+            are not limited by `DEFAULT_CONCURRENCY`.
+    """
+    table_names = tables or POPULATE_TABLES
+    unknown = set(table_names) - set(POPULATE_TABLES)
+    if unknown:
+        raise ValueError(f"Unknown table(s): {sorted(unknown)}")
+    table_names = [name for name in POPULATE_TABLES if name in table_names]
+
+    if processes <= 1:
+        populate_settings = {
+            "display_progress": display_progress,
+            "reserve_jobs": reserve_jobs,
+            "suppress_errors": suppress_errors,
+        }
+        populate_tables = get_populate_tables()
+        logger.info("---- Populate imported and computed tables ----")
+        for name in table_names:
+            populate_tables[name].populate(**populate_settings)
+        logger.info("---- Successfully completed workflow_miniscope/process.py ----")
+        return
+
+    memory_budget = memory_budget or dj.config.get("custom", {}).get(
+        "processing_memory_budget"
+    )
+    default_concurrency = {
+        name: limit
+        for name, limit in DEFAULT_CONCURRENCY.items()
+        if not (memory_budget and name == "Processing")
+    }
+    concurrency = {**default_concurrency, **(table_concurrency or {})}
+    return ParallelPopulate(
+        table_names, processes, concurrency, memory_budget=memory_budget
+    ).run()
+
+
+class ParallelPopulate:
+    """Dispatch populate calls for individual keys to a pool of worker processes
+
+    Args:
+        table_names (list): names from `POPULATE_TABLES`, in dependency order
+        processes (int): number of worker processes
+        concurrency (dict): table name to maximum concurrent populate calls
+        poll_interval (float, optional): (s) how often to look for new keys while
+            workers are busy. Defaults to 5.
+        memory_budget (int, optional): bytes available to Processing jobs. If set,
+            Processing keys are picked by `scheduler.MemoryScheduler` and each is
+            run in a fresh process so that its peak memory can be measured.
+    """
+
+    def __init__(
+        self,
+        table_names,
+        processes,
+        concurrency,
+        poll_interval=5.0,
+        memory_budget=None,
+    ):
+        self.table_names = table_names
+        self.processes = processes
+        self.concurrency = {
+            name: min(concurrency.get(name, processes), processes)
+            for name in table_names
+        }
+        self.poll_interval = poll_interval
+        self.tables = get_populate_tables()
+        self.attempted = {name: set() for name in table_names}
+        self.running = {}  # future -> table name
+        self.reserved = {}  # future of a Processing job -> reserved memory
+        self.scheduler = (
+            MemoryScheduler(memory_budget)
+            if memory_budget and "Processing" in table_names
+            else None
+        )
+        self.errors = []
+        self._stop = threading.Event()
+
+    def stop(self, signum=None, frame=None):
+        """Stop dispatching new keys; running populate calls are allowed to finish"""
+        if self._stop.is_set():
+            raise KeyboardInterrupt
+        logger.info("Stopping: waiting for running populate calls to finish")
+        self._stop.set()
+
+    def run(self) -> list:
+        """Populate until no table has keys left to dispatch
+
+        Returns:
+            errors (list): (table name, key, error message) of failed populate calls
+        """
+        previous_handlers = {
+            sig: signal.signal(sig, self.stop)
+            for sig in (signal.SIGINT, signal.SIGTERM)
+        }
+        executor = futures.ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+        # one fresh process per Processing job, to measure its peak memory
+        processing_executor = (
+            FreshProcessExecutor() if self.scheduler is not None else None
+        )
+        try:
+            while not self._stop.is_set():
+                dispatched = self._dispatch(executor, processing_executor)
+                if not self.running:
+                    if not dispatched:
+                        break
+                    continue
+                done, _ = futures.wait(
+                    self.running,
+                    timeout=self.poll_interval,
+                    return_when=futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    self._collect(future)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            if processing_executor is not None:
+                processing_executor.shutdown(wait=True, cancel_futures=True)
+            for future in list(self.running):
+                if future.done() and not future.cancelled():
+                    self._collect(future)
+            for sig, handler in previous_handlers.items():
+                signal.signal(sig, handler)
+
+        logger.info(
+            f"---- Completed workflow_miniscope/process.py with {len(self.errors)}"
+            " error(s) ----"
+        )
+        return self.errors
+
+    def _dispatch(self, executor, processing_executor=None) -> int:
+        """Submit new keys of every table up to its concurrency limit"""
+        dispatched = 0
+        running_counts = {name: 0 for name in self.table_names}
+        for name in self.running.values():
+            running_counts[name] += 1
+
+        for name in self.table_names:
+            free_slots = min(
+                self.concurrency[name] - running_counts[name],
+                self.processes - len(self.running),
+            )
+            if free_slots <= 0:
+                continue
+
+            table = self.tables[name]
+            if name == "Processing" and self.scheduler is not None:
+                dispatched += self._dispatch_processing(processing_executor, free_slots)
+                continue
+            for key in (table.key_source - table).fetch("KEY"):
+                if free_slots <= 0 or self._stop.is_set():
+                    break
+                key_hash = dict_to_uuid(key)
+                if key_hash in self.attempted[name]:
+                    continue
+                self.attempted[name].add(key_hash)
+                future = executor.submit(_populate_key, name, key)
+                self.running[future] = name
+                free_slots -= 1
+                dispatched += 1
+        return dispatched
+
+    def _dispatch_processing(self, executor, free_slots) -> int:
+        """Submit the pending Processing keys picked by the memory scheduler"""
+        table = self.tables["Processing"]
+        keys = [
+            key
+            for key in (table.key_source - table).fetch("KEY")
+            if dict_to_uuid(key) not in self.attempted["Processing"]
+        ]
+        if not keys or self._stop.is_set():
+            return 0
+        jobs = self.scheduler.select(keys, free_slots, sum(self.reserved.values()))
+        for key, estimate, reserved in jobs:
+            self.attempted["Processing"].add(dict_to_uuid(key))
+            future = executor.submit(_populate_processing, key, estimate)
+            self.running[future] = "Processing"
+            self.reserved[future] = reserved
+        return len(jobs)
+
+    def _collect(self, future):
+        name = self.running.pop(future)
+        if self.reserved.pop(future, None) is not None:
+            self.scheduler.refresh()
+        try:
+            errors = future.result()
+        except Exception as error:
+            errors = [(None, f"{type(error).__name__}: {error}")]
+        for key, message in errors:
+            logger.error(f'Populate ERROR in "{name}" for {key}: {message}')
+            self.errors.append((name, key, message))
+
+
+class FreshProcessExecutor:
+    """Run each submitted call in its own spawned process
+
+    Like `ProcessPoolExecutor(max_tasks_per_child=1)`, which needs Python 3.11, so
+    that the peak resident memory of the process is that of a single call. The
+    number of concurrent calls is limited by the caller.
+    """
+
+    def __init__(self):
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = []
+
+    def submit(self, fn, *args) -> futures.Future:
+        """Start `fn(*args)` in a new process
+
+        Returns:
+            future (futures.Future): resolved when the process exits
+        """
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_run_in_process, args=(sender, fn, args), daemon=False
+        )
+        process.start()
+        sender.close()
+        self._processes.append(process)
+
+        future = futures.Future()
+        future.set_running_or_notify_cancel()
+        threading.Thread(
+            target=self._wait, args=(future, process, receiver), daemon=True
+        ).start()
+        return future
+
+    @staticmethod
+    def _wait(future, process, receiver):
+        """Resolve the future from the result sent by the process"""
+        try:
+            succeeded, value = receiver.recv()
+        except EOFError:
+            succeeded, value = False, None
+        finally:
+            receiver.close()
+        process.join()
+        if succeeded:
+            future.set_result(value)
+        else:
+            future.set_exception(
+                RuntimeError(value or f"worker exited with code {process.exitcode}")
+            )
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        """Wait for the running processes, as `ProcessPoolExecutor.shutdown`"""
+        if wait:
+            for process in self._processes:
+                process.join()
+        self._processes = []
+
+
+def _run_in_process(sender, fn, args):
+    """Call `fn(*args)` in a FreshProcessExecutor process and send back the result"""
+    _init_worker()
+    try:
+        result = (True, fn(*args))
+    except Exception as error:
+        result = (False, f"{type(error).__name__}: {error}")
+    sender.send(result)
+    sender.close()
+
+
+def _init_worker():
+    """Let the parent process handle interrupts; workers finish their current key"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def _populate_key(table_name: str, key: dict) -> list:
+    """Populate one key of one table in a worker process"""
+    table = get_populate_tables()[table_name]
+    result = table.populate(
+        key, reserve_jobs=True, suppress_errors=True, display_progress=False
+    )
+    return _get_errors(result)
+
+
+def _populate_processing(key: dict, estimated_memory: int) -> list:
+    """Populate one Processing key in a fresh worker process, recording its memory"""
+    return _get_errors(populate_processing(key, estimated_memory))
+
+
+def _get_errors(result) -> list:
+    """(key, message) of each error of `populate`, which returns a dict of counts
+    and errors since DataJoint 0.14 and a list of errors before"""
+    errors = result.get("error_list", []) if isinstance(result, dict) else result
+    return [(error_key, str(message)) for error_key, message in errors or []]
+
+
+def _parse_concurrency(value: str) -> tuple:
+    name, _, limit = value.partition("=")
+    if name not in POPULATE_TABLES or not limit.isdigit():
+        raise argparse.ArgumentTypeError(
+            f"Expected TABLE=N with TABLE in {POPULATE_TABLES}, got {value!r}"
+        )
+    return name, int(limit)
+
+
+def main(argv=None):
+    """Command line entry point for `run`"""
+    parser = argparse.ArgumentParser(
+        prog="workflow-miniscope-process", description=run.__doc__.splitlines()[0]
+    )
+    parser.add_argument(
+        "-p", "--processes", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=_parse_concurrency,
+        action="append",
+        default=[],
+        metavar="TABLE=N",
+        help="maximum concurrent populate calls for one table (repeatable)",
+    )
+    parser.add_argument(
+        "-t",
+        "--tables",
+        nargs="+",
+        choices=POPULATE_TABLES,
+        metavar="TABLE",
+        help="tables to populate (default: all)",
+    )
+    parser.add_argument(
+        "-m",
+        "--memory-budget",
+        type=float,
+        metavar="GB",
+        help="memory available to Processing jobs, packed by estimated memory",
+    )
+    parser.add_argument(
+        "--reserve-jobs",
+        action="store_true",
+        help="reserve jobs when running in a single process",
+    )
+    parser.add_argument(
+        "--suppress-errors",
+        action="store_true",
+        help="continue past errors when running in a single process",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    run(
+        reserve_jobs=args.reserve_jobs,
+        suppress_errors=args.suppress_errors,
+        processes=args.processes,
+        table_concurrency=dict(args.concurrency),
+        tables=args.tables,
+        memory_budget=int(args.memory_budget * 1e9) if args.memory_budget else None,
+    )
+
+
+if __name__ == "__main__":
+    main()
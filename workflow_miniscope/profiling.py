@@ -0,0 +1,398 @@
+"""Per-`make` profiling of the auto-processing tables
+
+`instrument` wraps the `make` method of each table so that every call appends one
+JSON line to a local statistics file, `dj.config["custom"]["profile_path"]`, with:
+
+    table, key, pid, host, start (ISO time), status ("ok" or the error type)
+    wall_time, cpu_time (s): of the process and its waited-for children
+    peak_rss (bytes): highest resident memory of the process during the call
+    bytes_fetched, bytes_inserted: serialized blob bytes read and written
+    rows_fetched, rows_inserted: rows returned by `fetch` and passed to `insert`
+    profile (optional): {"stack;of;functions": samples} of the `make` thread
+
+Set `dj.config["custom"]["profile_makes"]` (or the `PROFILE_MAKES` environment
+variable) to instrument the tables of `process.get_populate_tables`, including in
+the worker processes of parallel runs. Stacks are sampled every
+`profile_sampling_interval` seconds if set; the resident memory is sampled every
+`RSS_SAMPLING_INTERVAL` seconds, which may miss short spikes unless they also raise
+the lifetime peak of the process.
+
+Rank tables or keys by cost with `report`, or from a shell:
+
+    workflow-miniscope-profile --by key --top 20
+"""
+import argparse
+import collections
+import functools
+import json
+import logging
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import datajoint as dj
+from datajoint import blob
+from datajoint.fetch import Fetch, Fetch1
+
+logger = logging.getLogger("datajoint")
+
+DEFAULT_PROFILE_PATH = Path.home() / ".cache" / "workflow_miniscope" / "profile.jsonl"
+RSS_SAMPLING_INTERVAL = 0.05  # (s)
+MAX_PROFILE_STACKS = 50  # most sampled stacks kept per call
+
+_active = []  # statistics of the `make` calls in progress in this process
+_active_lock = threading.Lock()
+_write_lock = threading.Lock()
+
+
+def get_profile_path() -> Path:
+    """Statistics file from `dj.config["custom"]["profile_path"]`
+
+    Returns:
+        path (pathlib.Path): JSON lines file. Defaults to `DEFAULT_PROFILE_PATH`.
+    """
+    return Path(
+        dj.config.get("custom", {}).get("profile_path") or DEFAULT_PROFILE_PATH
+    ).expanduser()
+
+
+def instrument(tables=None, path=None, sampling_interval=None):
+    """Record statistics of every `make` call of the given tables
+
+    Args:
+        tables (list, optional): table classes. Defaults to the tables of
+            `process.get_populate_tables`.
+        path (str, optional): statistics file. Defaults to `get_profile_path()`.
+        sampling_interval (float, optional): (s) interval of stack samples.
+            Defaults to `dj.config["custom"]["profile_sampling_interval"]`; no stack
+            sampling if not set.
+    """
+    if tables is None:
+        from .process import get_populate_tables
+
+        tables = get_populate_tables().values()
+    path = Path(path).expanduser() if path else get_profile_path()
+    sampling_interval = sampling_interval or dj.config.get("custom", {}).get(
+        "profile_sampling_interval"
+    )
+    _install_counters()
+    for table in tables:
+        make = table.make
+        if getattr(make, "_profiled", False):
+            continue
+        table.make = _profiled(make, path, sampling_interval)
+
+
+def _profiled(make, path: Path, sampling_interval: float):
+    @functools.wraps(make)
+    def profiled_make(self, key, *args, **kwargs):
+        stats = {
+            "table": self.__class__.__name__,
+            "full_table_name": self.full_table_name,
+            "key": json.loads(json.dumps(key, default=str)),
+            "pid": os.getpid(),
+            "host": socket.gethostname(),
+            "start": datetime.now().isoformat(timespec="seconds"),
+            "status": "ok",
+            "bytes_fetched": 0,
+            "bytes_inserted": 0,
+            "rows_fetched": 0,
+            "rows_inserted": 0,
+        }
+        sampler = _Sampler(threading.get_ident(), sampling_interval)
+        usage = _get_usage()
+        with _active_lock:
+            _active.append(stats)
+        sampler.start()
+        try:
+            return make(self, key, *args, **kwargs)
+        except BaseException as error:
+            stats["status"] = type(error).__name__
+            raise
+        finally:
+            sampler.stop()
+            with _active_lock:
+                _active.remove(stats)
+            end_usage = _get_usage()
+            stats["wall_time"] = end_usage["wall"] - usage["wall"]
+            stats["cpu_time"] = end_usage["cpu"] - usage["cpu"]
+            # a new lifetime peak of the process was reached during the call
+            lifetime_peak = (
+                end_usage["maxrss"] if end_usage["maxrss"] > usage["maxrss"] else 0
+            )
+            stats["peak_rss"] = max(sampler.peak_rss, lifetime_peak)
+            if sampler.stacks:
+                stats["profile"] = dict(sampler.stacks.most_common(MAX_PROFILE_STACKS))
+            _write(path, stats)
+
+    profiled_make._profiled = True
+    return profiled_make
+
+
+def _get_usage() -> dict:
+    """Wall time, CPU time of the process and its children, and peak memory"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return {
+        "wall": time.perf_counter(),
+        "cpu": own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        "maxrss": own.ru_maxrss * unit,
+    }
+
+
+def _write(path: Path, stats: dict):
+    """Append one line; single appended lines do not interleave across processes"""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with _write_lock, open(path, "a") as f:
+            f.write(json.dumps(stats) + "\n")
+    except OSError as error:
+        logger.warning(f"Cannot write profile statistics to {path}: {error}")
+
+
+class _Sampler:
+    """Background thread sampling resident memory and, optionally, a thread's stack"""
+
+    def __init__(self, thread_id: int, sampling_interval: float = None):
+        self.thread_id = thread_id
+        self.sampling_interval = sampling_interval
+        self.interval = min(
+            sampling_interval or RSS_SAMPLING_INTERVAL, RSS_SAMPLING_INTERVAL
+        )
+        self.peak_rss = _get_rss()
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, _get_rss())
+
+    def _run(self):
+        next_stack = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, _get_rss())
+            if self.sampling_interval and time.perf_counter() >= next_stack:
+                next_stack += self.sampling_interval
+                frame = sys._current_frames().get(self.thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{Path(code.co_filename).name}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+
+def _get_rss() -> int:
+    """Current resident memory in bytes, 0 where `/proc` is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _count(name: str, value: int):
+    with _active_lock:
+        for stats in _active:
+            stats[name] += value
+
+
+def _install_counters():
+    """Count blob bytes and rows moved by DataJoint, once per process"""
+    if getattr(blob.pack, "_counted", False):
+        return
+    pack, unpack = blob.pack, blob.unpack
+    fetch, fetch1, insert = Fetch.__call__, Fetch1.__call__, dj.Table.insert
+
+    @functools.wraps(pack)
+    def counted_pack(obj, *args, **kwargs):
+        packed = pack(obj, *args, **kwargs)
+        _count("bytes_inserted", len(packed))
+        return packed
+
+    @functools.wraps(unpack)
+    def counted_unpack(data, *args, **kwargs):
+        _count("bytes_fetched", len(data))
+        return unpack(data, *args, **kwargs)
+
+    @functools.wraps(fetch)
+    def counted_fetch(self, *args, **kwargs):
+        result = fetch(self, *args, **kwargs)
+        rows = result[0] if isinstance(result, tuple) and result else result
+        _count("rows_fetched", len(rows) if hasattr(rows, "__len__") else 0)
+        return result
+
+    @functools.wraps(fetch1)
+    def counted_fetch1(self, *args, **kwargs):
+        result = fetch1(self, *args, **kwargs)
+        _count("rows_fetched", 1)
+        return result
+
+    @functools.wraps(insert)
+    def counted_insert(self, rows, *args, **kwargs):
+        if _active and not isinstance(rows, dj.expression.QueryExpression):
+            rows = rows if hasattr(rows, "__len__") else list(rows)
+            _count("rows_inserted", len(rows))
+        return insert(self, rows, *args, **kwargs)
+
+    counted_pack._counted = True
+    blob.pack, blob.unpack = counted_pack, counted_unpack
+    Fetch.__call__, Fetch1.__call__ = counted_fetch, counted_fetch1
+    dj.Table.insert = counted_insert
+
+
+def load_stats(path=None) -> list:
+    """Read the statistics file
+
+    Args:
+        path (str, optional): statistics file. Defaults to `get_profile_path()`.
+
+    Returns:
+        stats (list): one dict per `make` call
+    """
+    path = Path(path).expanduser() if path else get_profile_path()
+    stats = []
+    with open(path) as f:
+        for line in f:
+            try:
+                stats.append(json.loads(line))
+            except ValueError:  # line cut short by a killed process
+                continue
+    return stats
+
+
+def summarize_stats(stats: list, by: str = "table", table: str = None) -> list:
+    """Rank tables or keys by total wall time
+
+    Args:
+        stats (list): output of `load_stats`
+        by (str, optional): "table" to aggregate the calls of each table, "key" to
+            rank individual calls. Defaults to "table".
+        table (str, optional): only include the calls of this table
+
+    Returns:
+        rows (list): dicts with "table", "key" (None by table), "calls", "errors",
+            "wall_time", "cpu_time", "peak_rss" (max), "bytes_fetched",
+            "bytes_inserted", "rows_fetched" and "rows_inserted" (totals)
+    """
+    if by not in ("table", "key"):
+        raise ValueError(f'Unknown grouping: {by}. Expected "table" or "key"')
+    totals = {}
+    for call in stats:
+        if table is not None and call["table"] != table:
+            continue
+        key = json.dumps(call["key"], sort_keys=True) if by == "key" else None
+        row = totals.setdefault(
+            (call["table"], key),
+            {
+                "table": call["table"],
+                "key": call["key"] if by == "key" else None,
+                "calls": 0,
+                "errors": 0,
+                "peak_rss": 0,
+                **{name: 0 for name in _SUMMED},
+            },
+        )
+        row["calls"] += 1
+        row["errors"] += call["status"] != "ok"
+        row["peak_rss"] = max(row["peak_rss"], call.get("peak_rss", 0))
+        for name in _SUMMED:
+            row[name] += call.get(name, 0)
+    return sorted(totals.values(), key=lambda row: row["wall_time"], reverse=True)
+
+
+_SUMMED = (
+    "wall_time",
+    "cpu_time",
+    "bytes_fetched",
+    "bytes_inserted",
+    "rows_fetched",
+    "rows_inserted",
+)
+
+
+def summarize_profile(stats: list, table: str, top: int = 20) -> list:
+    """Most sampled stacks of the calls of one table
+
+    Args:
+        stats (list): output of `load_stats`
+        table (str): table name
+        top (int, optional): number of stacks. Defaults to 20.
+
+    Returns:
+        stacks (list): (stack, samples), most sampled first
+    """
+    stacks = collections.Counter()
+    for call in stats:
+        if call["table"] == table:
+            stacks.update(call.get("profile", {}))
+    return stacks.most_common(top)
+
+
+def report(path=None, by: str = "table", table: str = None, top: int = 20) -> str:
+    """Text report ranking tables or keys by cost
+
+    Args:
+        path (str, optional): statistics file. Defaults to `get_profile_path()`.
+        by (str, optional): "table" or "key". Defaults to "table".
+        table (str, optional): only include the calls of this table, and list its
+            most sampled stacks
+        top (int, optional): number of rows. Defaults to 20.
+
+    Returns:
+        report (str): one line per table or key, most wall time first
+    """
+    stats = load_stats(path)
+    rows = summarize_stats(stats, by=by, table=table)[:top]
+    total_wall_time = sum(call.get("wall_time", 0) for call in stats) or 1
+    lines = [
+        f"{'table':24s} {'calls':>6s} {'errors':>6s} {'wall s':>10s} {'%':>5s}"
+        f" {'cpu s':>10s} {'peak GB':>8s} {'in MB':>9s} {'out MB':>9s}"
+        f" {'rows in':>9s} {'rows out':>9s}" + ("  key" if by == "key" else "")
+    ]
+    for row in rows:
+        lines.append(
+            f"{row['table'][:24]:24s} {row['calls']:6d} {row['errors']:6d}"
+            f" {row['wall_time']:10.1f} {100 * row['wall_time'] / total_wall_time:5.1f}"
+            f" {row['cpu_time']:10.1f} {row['peak_rss'] / 1e9:8.2f}"
+            f" {row['bytes_fetched'] / 1e6:9.1f} {row['bytes_inserted'] / 1e6:9.1f}"
+            f" {row['rows_fetched']:9d} {row['rows_inserted']:9d}"
+            + (f"  {json.dumps(row['key'])}" if by == "key" else "")
+        )
+    if table is not None:
+        stacks = summarize_profile(stats, table, top=top)
+        if stacks:
+            lines += ["", f"Most sampled stacks of {table}:"]
+            lines += [f"{samples:8d}  {stack}" for stack, samples in stacks]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    """Command line entry point for `report`"""
+    parser = argparse.ArgumentParser(
+        prog="workflow-miniscope-profile", description=report.__doc__.splitlines()[0]
+    )
+    parser.add_argument("--path", help="statistics file (default: from the config)")
+    parser.add_argument(
+        "--by", choices=("table", "key"), default="table", help="rank tables or keys"
+    )
+    parser.add_argument("--table", help="only this table, with its sampled stacks")
+    parser.add_argument("--top", type=int, default=20, help="number of rows")
+    args = parser.parse_args(argv)
+    print(report(path=args.path, by=args.by, table=args.table, top=args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Min/max/mean decimation pyramids of activity traces for interactive plots
+
+Level k of a pyramid holds, for every bin of 2**k consecutive frames, the minimum,
+maximum and mean of each trace. Level 0 is the traces themselves, and each level is
+reduced from the previous one by combining pairs of bins, so the whole pyramid is
+built with one vectorized pass per level over arrays that halve in length. The last
+bin of a level holds the remaining frames when the number of frames is not a multiple
+of 2**k. Level 0 is stored as a single array by `iter_blocks`, since its minimum,
+maximum and mean are all the traces.
+
+A plot of a time range only needs the coarsest level with at least one bin per
+pixel: drawing the minimum and maximum of each bin preserves the peaks that plain
+subsampling would miss, with a number of points bounded by the plot width.
+
+These functions do not touch the database.
+"""
+import numpy as np
+
+# Bins per stored block of a level
+DEFAULT_BLOCK_SIZE = 4096
+# Levels are built until they have at most this many bins
+DEFAULT_MIN_BINS = 256
+
+
+def iter_pyramid(traces: np.ndarray, min_bins: int = None):
+    """Yield the levels of the pyramid of a set of traces, finest first
+
+    Args:
+        traces (np.ndarray): (rois, frames) traces
+        min_bins (int, optional): stop after the first level with at most this many
+            bins. Defaults to `DEFAULT_MIN_BINS`.
+
+    Yields:
+        level (int): bins of 2**level frames
+        trace_min (np.ndarray): (rois, bins) minimum of each bin, ignoring NaN
+        trace_max (np.ndarray): (rois, bins) maximum of each bin, ignoring NaN
+        trace_mean (np.ndarray): (rois, bins) mean of each bin
+    """
+    min_bins = max(int(min_bins or DEFAULT_MIN_BINS), 1)
+    trace_min = trace_max = trace_sum = np.asarray(traces, dtype=float)
+    counts = np.ones(trace_sum.shape[1])
+    level = 0
+    while True:
+        yield level, trace_min, trace_max, trace_sum / counts
+        if trace_sum.shape[1] <= min_bins:
+            return
+        trace_min = _combine_pairs(np.fmin, trace_min)
+        trace_max = _combine_pairs(np.fmax, trace_max)
+        trace_sum = _combine_pairs(np.add, trace_sum)
+        counts = _combine_pairs(np.add, counts[None])[0]
+        level += 1
+
+
+def _combine_pairs(ufunc, data: np.ndarray) -> np.ndarray:
+    """Combine consecutive pairs of columns, keeping an odd last column as is"""
+    nbins = data.shape[1]
+    paired = ufunc(data[:, 0 : nbins - 1 : 2], data[:, 1:nbins:2])
+    if nbins % 2:
+        paired = np.concatenate([paired, data[:, -1:]], axis=1)
+    return paired
+
+
+def get_pyramid_nlevels(nframes: int, min_bins: int = None) -> int:
+    """Number of levels yielded by `iter_pyramid` for traces of `nframes` frames"""
+    min_bins = max(int(min_bins or DEFAULT_MIN_BINS), 1)
+    nlevels, nbins = 1, nframes
+    while nbins > min_bins:
+        nbins = -(-nbins // 2)
+        nlevels += 1
+    return nlevels
+
+
+def get_pyramid_level(nframes: int, width: int, nlevels: int) -> int:
+    """Coarsest level with at least one bin per pixel over a range of frames
+
+    Args:
+        nframes (int): number of frames in the requested range
+        width (int): plot width in pixels
+        nlevels (int): number of levels of the pyramid
+
+    Returns:
+        level (int): pyramid level, at most `nlevels - 1`
+    """
+    if nframes <= width:
+        return 0
+    level = int(np.floor(np.log2(nframes / max(width, 1))))
+    return min(max(level, 0), nlevels - 1)
+
+
+def get_bin_range(level: int, start_frame: int, stop_frame: int) -> tuple:
+    """Bins of a level covering a range of frames
+
+    Args:
+        level (int): pyramid level
+        start_frame (int): first frame of the range
+        stop_frame (int): frame after the last frame of the range
+
+    Returns:
+        start_bin (int): first bin overlapping the range
+        stop_bin (int): bin after the last bin overlapping the range
+    """
+    return start_frame >> level, -(-stop_frame >> level)
+
+
+def split_blocks(data: np.ndarray, block_size: int = None) -> list:
+    """Split the bins of one level into blocks stored as separate rows
+
+    Args:
+        data (np.ndarray): (rois, bins) one statistic of a level
+        block_size (int, optional): bins per block. Defaults to `DEFAULT_BLOCK_SIZE`.
+
+    Returns:
+        blocks (list): (rois, block bins) views of consecutive bins
+    """
+    block_size = block_size or DEFAULT_BLOCK_SIZE
+    return [
+        data[:, start : start + block_size]
+        for start in range(0, data.shape[1], block_size)
+    ]
+
+
+def iter_blocks(traces: np.ndarray, block_size: int = None, min_bins: int = None):
+    """Yield the blocks of every level of the pyramid of a set of traces
+
+    Level 0 yields the traces as its means only, with no minimum and maximum, so
+    that the full resolution traces are stored once.
+
+    Args:
+        traces (np.ndarray): (rois, frames) traces
+        block_size (int, optional): bins per block. Defaults to `DEFAULT_BLOCK_SIZE`.
+        min_bins (int, optional): see `iter_pyramid`
+
+    Yields:
+        level (int): bins of 2**level frames
+        block (int): index of the block along the bins of the level
+        trace_min (np.ndarray): (rois, block bins) minimum of each bin, None at
+            level 0
+        trace_max (np.ndarray): (rois, block bins) maximum of each bin, None at
+            level 0
+        trace_mean (np.ndarray): (rois, block bins) mean of each bin
+    """
+    for level, *stats in iter_pyramid(traces, min_bins):
+        if level == 0:
+            stats = [None, None, stats[2]]
+        blocks = [
+            split_blocks(data, block_size) if data is not None else None
+            for data in stats
+        ]
+        for block, trace_mean in enumerate(blocks[2]):
+            trace_min, trace_max = (
+                data[block] if data is not None else None for data in blocks[:2]
+            )
+            yield level, block, trace_min, trace_max, trace_mean
@@ -0,0 +1,138 @@
+import logging
+
+import datajoint as dj
+import numpy as np
+
+from workflow_miniscope import summary
+from workflow_miniscope.cache import fetch_traces
+from workflow_miniscope.movie import get_recording_movie
+from workflow_miniscope.pipeline import db_prefix, miniscope  # noqa: F401
+
+logger = logging.getLogger("datajoint")
+
+schema = dj.schema(db_prefix + "quality")
+
+DEFAULT_TRACE_CHUNK_BYTES = 2**28  # float64 trace data held at a time
+
+
+@schema
+class RecordingSummary(dj.Computed):
+    """Summary images of each raw recording, to check recordings before processing
+
+    Computed in one pass over the movie by `summary.summarize_movie`, split across
+    `dj.config["custom"]["recording_summary.processes"]` worker processes (default:
+    one per CPU). Parallel runs of `process.run` populate it one key at a time.
+
+    Attributes:
+        miniscope.RecordingInfo (foreign key): Primary key from RecordingInfo.
+        nframes (int): Number of frames summarized.
+        mean_image (longblob): Temporal mean of each pixel.
+        max_image (longblob): Temporal maximum of each pixel.
+        std_image (longblob): Temporal standard deviation of each pixel.
+        correlation_image (longblob): Mean correlation of each pixel with its 8
+            neighbours.
+        pnr_image (longblob): Peak-to-noise ratio of each pixel.
+    """
+
+    definition = """
+    -> miniscope.RecordingInfo
+    ---
+    nframes: int  # number of frames summarized
+    mean_image: longblob  # temporal mean of each pixel
+    max_image: longblob  # temporal maximum of each pixel
+    std_image: longblob  # temporal standard deviation of each pixel
+    correlation_image: longblob  # mean correlation with the 8 neighbouring pixels
+    pnr_image: longblob  # peak-to-noise ratio of each pixel
+    """
+
+    def make(self, key):
+        """Read the recording once and insert its summary images"""
+        movie = get_recording_movie(key)
+        images = summary.summarize_movie(
+            movie,
+            processes=dj.config.get("custom", {}).get("recording_summary.processes"),
+        )
+        self.insert1({**key, **images})
+
+
+def get_trace_metrics(traces, chunk_bytes: int = None) -> tuple:
+    """Skewness and standard deviation of every trace, as in
+    `miniscope.ProcessingQualityMetrics`
+
+    Computed with vectorized reductions over chunks of traces, each holding at most
+    `chunk_bytes` of float64 data. The skewness is the biased sample skewness of
+    `scipy.stats.skew`, NaN for constant traces.
+
+    Args:
+        traces (list): equal-length 1D traces, or a (traces x frames) array
+        chunk_bytes (int, optional): Defaults to `DEFAULT_TRACE_CHUNK_BYTES`.
+
+    Returns:
+        skewness (np.ndarray): skewness of each trace
+        std (np.ndarray): standard deviation of each trace, stored as "variance"
+            by `ProcessingQualityMetrics.Trace`
+    """
+    ntraces = len(traces)
+    skewness, std = np.empty(ntraces), np.empty(ntraces)
+    if not ntraces:
+        return skewness, std
+    nframes = len(traces[0])
+    chunk_size = max(1, (chunk_bytes or DEFAULT_TRACE_CHUNK_BYTES) // (8 * nframes))
+    for start in range(0, ntraces, chunk_size):
+        chunk = slice(start, min(start + chunk_size, ntraces))
+        data = np.array(np.stack(traces[chunk]), dtype=np.float64)
+        data -= data.mean(axis=1, keepdims=True)
+        m2 = np.einsum("ij,ij->i", data, data) / nframes
+        m3 = np.einsum("ij,ij,ij->i", data, data, data) / nframes
+        std[chunk] = np.sqrt(m2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            skewness[chunk] = np.where(m2 > 0, m3 / m2**1.5, np.nan)
+    return skewness, std
+
+
+def populate_trace_quality_metrics(
+    restriction=True, chunk_bytes: int = None, batch_size: int = 100
+) -> int:
+    """Batch alternative to `miniscope.ProcessingQualityMetrics.populate()`
+
+    Loads the traces of each pending Fluorescence key once, through the trace
+    cache, computes the metrics of all masks with `get_trace_metrics`, and inserts
+    the master and part rows of `batch_size` keys at a time in one transaction, with
+    one multi-row insert per table. Jobs are not reserved, so run it from a single
+    process.
+
+    Args:
+        restriction (optional): restriction of the Fluorescence keys to populate.
+            Defaults to all pending keys.
+        chunk_bytes (int, optional): trace data held at a time. Defaults to
+            `DEFAULT_TRACE_CHUNK_BYTES`.
+        batch_size (int, optional): keys per transaction. Defaults to 100.
+
+    Returns:
+        count (int): number of keys populated
+    """
+    table = miniscope.ProcessingQualityMetrics
+    keys = ((table.key_source & restriction) - table).fetch("KEY")
+    connection = dj.conn()
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start : start + batch_size]
+        trace_rows = []
+        for key in batch:
+            trace_keys, traces = fetch_traces(
+                miniscope.Fluorescence.Trace & key, "fluorescence"
+            )
+            skewness, std = get_trace_metrics(traces, chunk_bytes)
+            trace_rows += [
+                {**trace_key, "skewness": trace_skewness, "variance": trace_std}
+                for trace_key, trace_skewness, trace_std in zip(
+                    trace_keys, skewness, std
+                )
+            ]
+        with connection.transaction:
+            table.insert(batch, allow_direct_insert=True)
+            table.Trace.insert(trace_rows, allow_direct_insert=True)
+        logger.info(
+            f"---- Inserted quality metrics of {len(trace_rows)} trace(s) of"
+            f" {start + len(batch)}/{len(keys)} key(s) ----"
+        )
+    return len(keys)
@@ -0,0 +1,233 @@
+import datajoint as dj
+import numpy as np
+
+from workflow_miniscope import spatial
+from workflow_miniscope.pipeline import db_prefix, miniscope  # noqa: F401
+
+schema = dj.schema(db_prefix + "registration")
+
+# Segmentation primary key attributes renamed for the target session of a pair
+TARGET_ATTRIBUTES = {
+    "target_session_datetime": "session_datetime",
+    "target_recording_id": "recording_id",
+    "target_paramset_id": "paramset_id",
+    "target_curation_id": "curation_id",
+}
+
+
+@schema
+class MaskSpatialIndex(dj.Computed):
+    """Centroid and bounding box of every mask of a segmentation
+
+    Loaded into a `spatial.MaskIndex` KD-tree by `get_index` to find the masks near
+    a location, or near the masks of another session.
+
+    Attributes:
+        miniscope.Segmentation (foreign key): Primary key from Segmentation.
+        mask_ids (longblob): Mask at each row of the arrays below.
+        centroids (longblob): (pixels) Weighted x, y centroid of each mask.
+        bboxes (longblob): (pixels) x min, y min, x max, y max of each mask.
+    """
+
+    definition = """
+    -> miniscope.Segmentation
+    ---
+    mask_ids: longblob  # (masks,) mask at each row of the arrays below
+    centroids: longblob  # (masks x 2) (pixels) weighted x, y centroid of each mask
+    bboxes: longblob  # (masks x 4) (pixels) x min, y min, x max, y max of each mask
+    """
+
+    def make(self, key):
+        """Compute the geometry of all masks from one fetch of their pixels"""
+        mask_ids, xpix, ypix, weights = (miniscope.Segmentation.Mask & key).fetch(
+            "mask", "mask_xpix", "mask_ypix", "mask_weights", order_by="mask"
+        )
+        centroids, bboxes = spatial.get_mask_geometry(xpix, ypix, weights)
+        self.insert1(
+            {**key, "mask_ids": mask_ids, "centroids": centroids, "bboxes": bboxes}
+        )
+
+    def get_index(self, key: dict) -> tuple:
+        """KD-tree over the masks of one segmentation
+
+        Args:
+            key (dict): key of MaskSpatialIndex
+
+        Returns:
+            mask_ids (np.ndarray): mask at each index of the tree
+            index (spatial.MaskIndex): index of the masks
+        """
+        mask_ids, centroids, bboxes = (self & key).fetch1(
+            "mask_ids", "centroids", "bboxes"
+        )
+        return mask_ids, spatial.MaskIndex(centroids, bboxes)
+
+    def query(self, key: dict, x: float, y: float, radius: float = 0.0) -> np.ndarray:
+        """Masks of one segmentation near a location
+
+        Args:
+            key (dict): key of MaskSpatialIndex
+            x (float): (pixels) x coordinate
+            y (float): (pixels) y coordinate
+            radius (float, optional): (pixels) maximum distance from the location to
+                the bounding box of a mask. Defaults to 0, masks whose bounding box
+                contains the location.
+
+        Returns:
+            masks (np.ndarray): masks near the location
+        """
+        mask_ids, index = self.get_index(key)
+        return mask_ids[index.query(x, y, radius)]
+
+
+@schema
+class RegistrationPair(dj.Manual):
+    """Pairs of segmentations of one subject whose masks are matched
+
+    Attributes:
+        MaskSpatialIndex (foreign key): Segmentation of the reference session.
+        MaskSpatialIndex.proj (foreign key): Segmentation of the target session,
+            with attributes prefixed by "target_".
+    """
+
+    definition = """
+    -> MaskSpatialIndex
+    -> MaskSpatialIndex.proj(target_session_datetime='session_datetime', target_recording_id='recording_id', target_paramset_id='paramset_id', target_curation_id='curation_id')
+    """
+
+
+@schema
+class MaskRegistration(dj.Computed):
+    """Masks of a target session matched to masks of a reference session
+
+    The target session is registered to the reference session by the translation
+    between their motion-corrected average images. Candidate pairs are the masks
+    whose centroids are within `dj.config["custom"]["mask_registration.max_distance"]`
+    pixels (default 10) after the translation, matched one-to-one by pixel overlap
+    of at least `mask_registration.min_overlap` (default 0.2), see
+    `spatial.match_masks`. Only the pixels of masks with candidates are fetched.
+
+    Attributes:
+        RegistrationPair (foreign key): Primary key from RegistrationPair.
+        shift_x (int): (pixels) x offset from target to reference coordinates.
+        shift_y (int): (pixels) y offset from target to reference coordinates.
+        max_distance (float): (pixels) Maximum centroid distance of a match.
+        min_overlap (float): Minimum intersection over union of a match.
+    """
+
+    definition = """
+    -> RegistrationPair
+    ---
+    shift_x: int  # (pixels) x offset from target to reference coordinates
+    shift_y: int  # (pixels) y offset from target to reference coordinates
+    max_distance: float  # (pixels) maximum centroid distance of a match
+    min_overlap: float  # minimum intersection over union of a match
+    """
+
+    class Match(dj.Part):
+        """A reference mask and its matching target mask
+
+        Attributes:
+            miniscope.Segmentation.Mask (foreign key): Reference mask.
+            miniscope.Segmentation.Mask.proj (foreign key): Target mask.
+            centroid_distance (float): (pixels) Distance between the centroids
+                after registration.
+            overlap (float): Intersection over union of the mask pixels.
+        """
+
+        definition = """
+        -> master
+        -> miniscope.Segmentation.Mask
+        ---
+        -> miniscope.Segmentation.Mask.proj(target_session_datetime='session_datetime', target_recording_id='recording_id', target_paramset_id='paramset_id', target_curation_id='curation_id', target_mask='mask')
+        centroid_distance: float  # (pixels) distance between the registered centroids
+        overlap: float  # intersection over union of the mask pixels
+        """
+
+    @property
+    def key_source(self):
+        """Pairs whose reference and target sessions both have motion correction
+        summary images"""
+        summaries = miniscope.MotionCorrection.Summary.proj()
+        return RegistrationPair & summaries & summaries.proj(**TARGET_ATTRIBUTES)
+
+    def make(self, key):
+        """Register the target session and match its masks to the reference"""
+        config = dj.config.get("custom", {})
+        max_distance = float(config.get("mask_registration.max_distance", 10.0))
+        min_overlap = float(config.get("mask_registration.min_overlap", 0.2))
+
+        reference_key = (MaskSpatialIndex & key).fetch1("KEY")
+        target_key = (
+            MaskSpatialIndex
+            & {"subject": key["subject"]}
+            & {name: key[target] for target, name in TARGET_ATTRIBUTES.items()}
+        ).fetch1("KEY")
+
+        shift = spatial.estimate_shift(
+            (miniscope.MotionCorrection.Summary & reference_key).fetch1(
+                "average_image"
+            ),
+            (miniscope.MotionCorrection.Summary & target_key).fetch1("average_image"),
+        )
+
+        reference_ids, reference_index = MaskSpatialIndex().get_index(reference_key)
+        target_ids, target_centroids = (MaskSpatialIndex & target_key).fetch1(
+            "mask_ids", "centroids"
+        )
+        neighbours = reference_index.query_neighbours(
+            target_centroids + shift, max_distance
+        )
+        reference_pixels = _fetch_mask_pixels(
+            reference_key,
+            reference_ids,
+            {i for candidates in neighbours for i in candidates},
+        )
+        target_pixels = _fetch_mask_pixels(
+            target_key,
+            target_ids,
+            {j for j, candidates in enumerate(neighbours) if candidates},
+        )
+
+        reference, target, distance, overlap = spatial.match_masks(
+            reference_index,
+            reference_pixels,
+            target_centroids,
+            target_pixels,
+            shift=shift,
+            max_distance=max_distance,
+            min_overlap=min_overlap,
+        )
+
+        self.insert1(
+            {
+                **key,
+                "shift_x": shift[0],
+                "shift_y": shift[1],
+                "max_distance": max_distance,
+                "min_overlap": min_overlap,
+            }
+        )
+        self.Match.insert(
+            {
+                **key,
+                "mask": reference_ids[i],
+                "target_mask": target_ids[j],
+                "centroid_distance": d,
+                "overlap": o,
+            }
+            for i, j, d, o in zip(reference, target, distance, overlap)
+        )
+
+
+def _fetch_mask_pixels(key: dict, mask_ids: np.ndarray, indices: set) -> dict:
+    """Pixels of selected masks of a segmentation, by index in `mask_ids`"""
+    if not indices:
+        return {}
+    position = {mask: i for i, mask in enumerate(mask_ids.tolist())}
+    masks, xpix, ypix = (
+        miniscope.Segmentation.Mask
+        & key
+        & [{"mask": mask_ids[i]} for i in sorted(indices)]
+    ).fetch("mask", "mask_xpix", "mask_ypix")
+    return {position[mask]: (x, y) for mask, x, y in zip(masks.tolist(), xpix, ypix)}
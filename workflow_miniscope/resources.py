@@ -0,0 +1,31 @@
+import datajoint as dj
+
+from workflow_miniscope.pipeline import db_prefix, miniscope  # noqa: F401
+
+schema = dj.schema(db_prefix + "resources")
+
+
+@schema
+class ProcessingMemory(dj.Manual):
+    """Estimated and measured peak memory of completed Processing jobs
+
+    Inserted by `scheduler.populate_processing` for jobs run by the memory-aware
+    scheduler of `process.run`, and used to correct later estimates.
+
+    Attributes:
+        miniscope.ProcessingTask (foreign key): Primary key from ProcessingTask.
+        estimated_memory (int): Bytes, estimate of `estimate_processing_memory`,
+            before correction.
+        peak_memory (int): Bytes, measured peak resident memory of the job.
+        duration (float): Seconds, wall time of the job.
+        completion_time (datetime): Time the job finished.
+    """
+
+    definition = """
+    -> miniscope.ProcessingTask
+    ---
+    estimated_memory: bigint unsigned  # (bytes) estimate before correction
+    peak_memory: bigint unsigned  # (bytes) measured peak resident memory
+    duration: float  # (s) wall time of the job
+    completion_time=CURRENT_TIMESTAMP: timestamp
+    """
@@ -0,0 +1,268 @@
+"""Memory-aware scheduling of CaImAn `miniscope.Processing` jobs
+
+The peak memory of a Processing job grows with the size of its movie and depends on
+its parameter set. `estimate_processing_memory` gives a first estimate from the
+`RecordingInfo` of the recording and the CaImAn parameters. `MemoryScheduler` scales
+it by a correction factor learned from the peaks measured in past jobs, stored in
+`resources.ProcessingMemory`, and picks the pending jobs to start so that the
+corrected estimates of all running jobs stay within a memory budget.
+
+Jobs are packed largest first: large jobs start as soon as memory allows instead of
+being left for the end of the queue, and smaller jobs fill the remaining memory. A
+job larger than the whole budget runs alone.
+"""
+import logging
+import math
+import os
+import resource
+import sys
+import time
+
+import datajoint as dj
+import numpy as np
+from element_interface.utils import dict_to_uuid
+
+logger = logging.getLogger("datajoint")
+
+BYTES_PER_PIXEL = 4  # CaImAn works on float32 movies
+# float32 copies of the movie held at the peak of a job: the memory-mapped movie
+# written by motion correction and the movie loaded by CNMF-E
+MOVIE_COPIES = 2
+PW_RIGID_COPIES = 1  # additional copy for piecewise-rigid motion correction
+BASE_MEMORY = 2**30  # interpreter, CaImAn and DataJoint
+BUDGET_FRACTION = 0.8  # of physical memory, if no budget is configured
+
+
+def estimate_processing_memory(
+    nframes: int, height: int, width: int, params: dict, task_mode: str = "trigger"
+) -> int:
+    """Uncorrected estimate of the peak memory of a Processing job
+
+    Args:
+        nframes (int): frames of the recording
+        height (int): frame height in pixels
+        width (int): frame width in pixels
+        params (dict): CaImAn parameters of the ProcessingParamSet
+        task_mode (str, optional): "trigger" or "load". Loading existing results
+            needs `BASE_MEMORY` only. Defaults to "trigger".
+
+    Returns:
+        memory (int): estimated peak memory in bytes
+    """
+    if task_mode == "load":
+        return BASE_MEMORY
+    movie_bytes = nframes * height * width * BYTES_PER_PIXEL
+    copies = MOVIE_COPIES + (PW_RIGID_COPIES if params.get("pw_rigid") else 0)
+    memory = BASE_MEMORY + copies * movie_bytes
+
+    rf = params.get("rf")
+    if rf is not None:  # CNMF-E on patches of 2 x rf pixels, one per process
+        patch_size = 2 * int(np.max(rf))
+        step = max(patch_size - int(np.max(params.get("stride") or 0)), 1)
+        npatches = math.prod(
+            math.ceil(max(size - patch_size, 0) / step) + 1 for size in (height, width)
+        )
+        patch_bytes = (
+            nframes * min(patch_size, height) * min(patch_size, width) * BYTES_PER_PIXEL
+        )
+        nprocesses = params.get("n_processes") or os.cpu_count()
+        memory += min(nprocesses, npatches) * patch_bytes
+    return int(memory)
+
+
+def get_correction_factor(estimates, peaks, quantile: float = 0.9) -> float:
+    """Factor scaling estimates to the measured peaks of past jobs
+
+    Args:
+        estimates (array_like): uncorrected estimates of past jobs
+        peaks (array_like): measured peak memory of the same jobs
+        quantile (float, optional): quantile of the peak-to-estimate ratios, so
+            that most jobs stay within their corrected estimate. Defaults to 0.9.
+
+    Returns:
+        factor (float): 1.0 if there are no past jobs
+    """
+    estimates = np.asarray(estimates, dtype=float)
+    peaks = np.asarray(peaks, dtype=float)
+    valid = estimates > 0
+    if not valid.any():
+        return 1.0
+    return float(np.quantile(peaks[valid] / estimates[valid], quantile))
+
+
+def pack_jobs(estimates: list, available: int, slots: int, idle: bool = False):
+    """Pick jobs fitting in the available memory, largest first
+
+    Args:
+        estimates (list): memory of each pending job
+        available (int): memory not reserved by running jobs
+        slots (int): maximum number of jobs to pick
+        idle (bool, optional): no job is running. The largest job is then picked
+            alone if it does not fit. Defaults to False.
+
+    Returns:
+        picked (list): indices of the picked jobs, largest first
+    """
+    if slots <= 0 or not len(estimates):
+        return []
+    order = sorted(range(len(estimates)), key=lambda i: estimates[i], reverse=True)
+    if idle and estimates[order[0]] > available:
+        return [order[0]]
+    picked = []
+    for i in order:
+        if len(picked) >= slots:
+            break
+        if estimates[i] <= available:
+            picked.append(i)
+            available -= estimates[i]
+    return picked
+
+
+def get_memory_budget() -> int:
+    """Memory available to Processing jobs
+
+    Set by `dj.config["custom"]["processing_memory_budget"]` in bytes, otherwise
+    `BUDGET_FRACTION` of the physical memory.
+
+    Returns:
+        budget (int): memory budget in bytes
+    """
+    budget = dj.config.get("custom", {}).get("processing_memory_budget")
+    if budget:
+        return int(budget)
+    physical = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return int(BUDGET_FRACTION * physical)
+
+
+class MemoryScheduler:
+    """Select pending Processing jobs whose estimated memory fits a budget
+
+    Args:
+        memory_budget (int, optional): bytes available to Processing jobs. Defaults
+            to `get_memory_budget()`.
+        history (int, optional): number of most recent measured jobs the correction
+            factor is learned from. Defaults to 100.
+    """
+
+    def __init__(self, memory_budget=None, history=100):
+        self.memory_budget = int(memory_budget or get_memory_budget())
+        self.history = history
+        self.correction = 1.0
+        self._estimates = {}  # key hash -> uncorrected estimate
+        self.refresh()
+
+    def refresh(self):
+        """Learn the correction factor from the most recent measured jobs"""
+        from .resources import ProcessingMemory
+
+        estimates, peaks = ProcessingMemory.fetch(
+            "estimated_memory",
+            "peak_memory",
+            order_by="completion_time DESC",
+            limit=self.history,
+        )
+        self.correction = get_correction_factor(estimates, peaks)
+
+    def estimate(self, keys: list) -> list:
+        """Uncorrected memory estimates of ProcessingTask keys, cached per key"""
+        from .pipeline import miniscope
+
+        hashes = [dict_to_uuid(key) for key in keys]
+        missing = [key for key, h in zip(keys, hashes) if h not in self._estimates]
+        if missing:
+            rows = (
+                miniscope.ProcessingTask
+                * miniscope.ProcessingParamSet
+                * miniscope.RecordingInfo
+                & missing
+            ).fetch(
+                *miniscope.ProcessingTask.primary_key,
+                "nframes",
+                "px_height",
+                "px_width",
+                "params",
+                "task_mode",
+                as_dict=True,
+            )
+            for row in rows:
+                estimate = estimate_processing_memory(
+                    row.pop("nframes"),
+                    row.pop("px_height"),
+                    row.pop("px_width"),
+                    row.pop("params"),
+                    row.pop("task_mode"),
+                )
+                self._estimates[dict_to_uuid(row)] = estimate
+        return [self._estimates.get(h, BASE_MEMORY) for h in hashes]
+
+    def select(self, keys: list, slots: int, reserved: int) -> list:
+        """Pick pending jobs to start
+
+        Args:
+            keys (list): primary keys of pending ProcessingTask rows
+            slots (int): maximum number of jobs to start
+            reserved (int): corrected estimates of the running jobs, in bytes
+
+        Returns:
+            jobs (list): (key, uncorrected estimate, corrected estimate) of each
+                job to start
+        """
+        estimates = self.estimate(keys)
+        corrected = [int(estimate * self.correction) for estimate in estimates]
+        picked = pack_jobs(
+            corrected, self.memory_budget - reserved, slots, idle=not reserved
+        )
+        for i in picked:
+            if corrected[i] > self.memory_budget:
+                logger.warning(
+                    f"Processing {keys[i]} is estimated at {corrected[i] / 1e9:.1f} GB,"
+                    f" above the {self.memory_budget / 1e9:.1f} GB budget: running alone"
+                )
+        return [(keys[i], estimates[i], corrected[i]) for i in picked]
+
+
+def populate_processing(key: dict, estimated_memory: int):
+    """Populate one Processing key and record its peak memory
+
+    Run in a fresh process per job, so that the peak resident memory of the
+    process and its children is that of the job. The children's peak is added to
+    the process's own, so the measurement errs on the high side.
+
+    Args:
+        key (dict): primary key of ProcessingTask
+        estimated_memory (int): uncorrected estimate of the job
+
+    Returns:
+        result: output of `Processing.populate`
+    """
+    from .pipeline import miniscope
+    from .resources import ProcessingMemory
+
+    start = time.monotonic()
+    result = miniscope.Processing.populate(
+        key, reserve_jobs=True, suppress_errors=True, display_progress=False
+    )
+    duration = time.monotonic() - start
+    if isinstance(result, dict):  # DataJoint >= 0.14
+        succeeded = result["success_count"] > 0
+    else:
+        succeeded = not result and bool(miniscope.Processing & key)
+    if not succeeded:
+        return result
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    peak_memory = unit * (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    ProcessingMemory.insert1(
+        {
+            **key,
+            "estimated_memory": estimated_memory,
+            "peak_memory": peak_memory,
+            "duration": duration,
+        },
+        replace=True,
+    )
+    return result
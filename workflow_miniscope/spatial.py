@@ -0,0 +1,206 @@
+"""Spatial indexing and cross-session matching of segmentation masks
+
+Masks are summarized by their weighted centroid and bounding box. `MaskIndex` keeps a
+KD-tree over the centroids of one segmentation, so that the masks near a location, or
+near each mask of another segmentation, are found without comparing all pairs. Masks
+of two sessions are then matched by `match_masks`, scoring the pixel overlap of the
+candidate pairs only, after shifting the second session by the translation between
+the motion-corrected average images of both sessions (`estimate_shift`).
+
+These functions do not touch the database. The KD-tree is from `scipy.spatial`.
+"""
+import numpy as np
+
+# Offset between rows of the integer pixel keys of `_pixel_keys`
+PIXEL_KEY_STRIDE = 2**20
+
+
+def get_mask_geometry(xpix: list, ypix: list, weights: list) -> tuple:
+    """Weighted centroid and bounding box of each mask
+
+    Args:
+        xpix (list): (pixels,) x coordinates of each mask
+        ypix (list): (pixels,) y coordinates of each mask
+        weights (list): (pixels,) weight of each pixel of each mask
+
+    Returns:
+        centroids (np.ndarray): (masks x 2) x, y centroid of each mask
+        bboxes (np.ndarray): (masks x 4) x min, y min, x max, y max of each mask
+    """
+    centroids = np.empty((len(xpix), 2))
+    bboxes = np.empty((len(xpix), 4))
+    for i, (x, y, w) in enumerate(zip(xpix, ypix, weights)):
+        x, y, w = (np.asarray(a, dtype=float).ravel() for a in (x, y, w))
+        if not w.sum() > 0:
+            w = np.ones_like(x)
+        centroids[i] = np.average(x, weights=w), np.average(y, weights=w)
+        bboxes[i] = x.min(), y.min(), x.max(), y.max()
+    return centroids, bboxes
+
+
+class MaskIndex:
+    """KD-tree over the mask centroids of one segmentation
+
+    Args:
+        centroids (np.ndarray): (masks x 2) x, y centroid of each mask
+        bboxes (np.ndarray): (masks x 4) x min, y min, x max, y max of each mask
+    """
+
+    def __init__(self, centroids, bboxes):
+        from scipy.spatial import cKDTree
+
+        self.centroids = np.asarray(centroids, dtype=float).reshape(-1, 2)
+        self.bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+        self._tree = cKDTree(self.centroids)
+        # distance from a centroid to the farthest corner of its bounding box, so
+        # that boxes near a point are among the centroids within this extra radius
+        corners = np.maximum(
+            np.abs(self.bboxes[:, :2] - self.centroids),
+            np.abs(self.bboxes[:, 2:] - self.centroids),
+        )
+        self._reach = float(np.hypot(*corners.T).max()) if len(corners) else 0.0
+
+    def __len__(self):
+        return len(self.centroids)
+
+    def query(self, x: float, y: float, radius: float = 0.0) -> np.ndarray:
+        """Masks whose bounding box is within `radius` of a point
+
+        Args:
+            x (float): (pixels) x coordinate
+            y (float): (pixels) y coordinate
+            radius (float, optional): (pixels) Defaults to 0, masks whose bounding
+                box contains the point.
+
+        Returns:
+            indices (np.ndarray): sorted indices of the masks
+        """
+        candidates = np.array(
+            self._tree.query_ball_point([x, y], radius + self._reach), dtype=int
+        )
+        bboxes = self.bboxes[candidates]
+        dx = np.maximum(np.maximum(bboxes[:, 0] - x, x - bboxes[:, 2]), 0)
+        dy = np.maximum(np.maximum(bboxes[:, 1] - y, y - bboxes[:, 3]), 0)
+        return np.sort(candidates[np.hypot(dx, dy) <= radius])
+
+    def query_neighbours(self, points: np.ndarray, max_distance: float) -> list:
+        """Masks whose centroid is within `max_distance` of each point
+
+        Args:
+            points (np.ndarray): (points x 2) x, y coordinates
+            max_distance (float): (pixels) maximum centroid distance
+
+        Returns:
+            neighbours (list): indices of the masks near each point
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if not len(points) or not len(self):
+            return [[] for _ in points]
+        return self._tree.query_ball_point(points, max_distance)
+
+
+def estimate_shift(reference_image: np.ndarray, image: np.ndarray) -> tuple:
+    """Translation between two images, by phase correlation
+
+    The images are cropped to their common size.
+
+    Args:
+        reference_image (np.ndarray): (height x width) image of the reference session
+        image (np.ndarray): (height x width) image of the other session
+
+    Returns:
+        shift (tuple): (pixels) x, y offsets to add to coordinates of `image` to get
+            coordinates of `reference_image`
+    """
+    height = min(reference_image.shape[0], image.shape[0])
+    width = min(reference_image.shape[1], image.shape[1])
+    reference_image, image = (
+        np.asarray(im[:height, :width], dtype=float) for im in (reference_image, image)
+    )
+    cross_power = np.fft.fft2(reference_image - reference_image.mean()) * np.conj(
+        np.fft.fft2(image - image.mean())
+    )
+    cross_power /= np.maximum(np.abs(cross_power), np.finfo(float).eps)
+    correlation = np.fft.ifft2(cross_power).real
+    dy, dx = np.unravel_index(np.argmax(correlation), correlation.shape)
+    # peaks past the middle are negative shifts
+    dy = dy - height if dy > height // 2 else dy
+    dx = dx - width if dx > width // 2 else dx
+    return int(dx), int(dy)
+
+
+def _pixel_keys(x, y, shift=(0, 0)) -> np.ndarray:
+    """Sorted unique integer keys of the pixels of a mask"""
+    x = np.round(np.asarray(x, dtype=float) + shift[0]).astype(np.int64)
+    y = np.round(np.asarray(y, dtype=float) + shift[1]).astype(np.int64)
+    return np.unique(y * PIXEL_KEY_STRIDE + x)
+
+
+def match_masks(
+    reference_index: MaskIndex,
+    reference_pixels: list,
+    target_centroids: np.ndarray,
+    target_pixels: list,
+    shift: tuple = (0, 0),
+    max_distance: float = 10.0,
+    min_overlap: float = 0.2,
+) -> tuple:
+    """One-to-one matches between the masks of two sessions
+
+    Candidate pairs are the masks whose centroids are within `max_distance` once the
+    target masks are shifted into the reference coordinates. Each candidate pair is
+    scored by the intersection over union of its pixels, and pairs are matched in
+    order of decreasing overlap, each mask at most once.
+
+    Args:
+        reference_index (MaskIndex): index of the reference masks
+        reference_pixels (list): (xpix, ypix) of each reference mask
+        target_centroids (np.ndarray): (masks x 2) x, y centroid of each target mask
+        target_pixels (list): (xpix, ypix) of each target mask
+        shift (tuple, optional): (pixels) x, y offsets from target to reference
+            coordinates, see `estimate_shift`. Defaults to no shift.
+        max_distance (float, optional): (pixels) maximum centroid distance.
+            Defaults to 10.
+        min_overlap (float, optional): minimum intersection over union. Defaults
+            to 0.2.
+
+    Returns:
+        reference (np.ndarray): index of the reference mask of each match
+        target (np.ndarray): index of the target mask of each match
+        distance (np.ndarray): (pixels) distance between the shifted centroids
+        overlap (np.ndarray): intersection over union of the pixels
+    """
+    shifted = np.asarray(target_centroids, dtype=float).reshape(-1, 2) + shift
+    neighbours = reference_index.query_neighbours(shifted, max_distance)
+
+    reference_keys = {}
+    pairs = []
+    for j, candidates in enumerate(neighbours):
+        if not candidates:
+            continue
+        target_keys = _pixel_keys(*target_pixels[j], shift=shift)
+        for i in candidates:
+            if i not in reference_keys:
+                reference_keys[i] = _pixel_keys(*reference_pixels[i])
+            intersection = len(
+                np.intersect1d(reference_keys[i], target_keys, assume_unique=True)
+            )
+            union = len(reference_keys[i]) + len(target_keys) - intersection
+            overlap = intersection / union if union else 0.0
+            if overlap >= min_overlap:
+                distance = np.hypot(*(reference_index.centroids[i] - shifted[j]))
+                pairs.append((overlap, -distance, i, j))
+
+    matches = []
+    matched_reference, matched_target = set(), set()
+    for overlap, distance, i, j in sorted(pairs, reverse=True):
+        if i in matched_reference or j in matched_target:
+            continue
+        matched_reference.add(i)
+        matched_target.add(j)
+        matches.append((i, j, -distance, overlap))
+
+    if not matches:
+        return np.empty(0, int), np.empty(0, int), np.empty(0), np.empty(0)
+    reference, target, distance, overlap = map(np.array, zip(*matches))
+    return reference, target, distance, overlap
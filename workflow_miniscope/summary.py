@@ -0,0 +1,222 @@
+"""Single-pass summary images of raw Miniscope movies
+
+The mean, maximum, standard-deviation, local-correlation and peak-to-noise images of a
+movie are all computed from a handful of per-pixel running sums, so the movie is read
+once, in blocks of frames, with memory bounded by the block size. A contiguous range
+of frames is summarized into a partial result by `summarize_frames`; partial results
+of consecutive ranges are combined by `merge_summaries`, which lets
+`summarize_movie` split the movie across worker processes.
+
+The sums of uint8 frames are integers below 2**53 for any practical movie length, so
+they are exact in float64 and the merged result does not depend on how the movie was
+split.
+
+These functions do not touch the database.
+"""
+import multiprocessing
+import os
+from concurrent import futures
+
+import numpy as np
+
+from .movie import MiniscopeMovie
+
+# Bytes of frame data, as float64, held by one worker at a time
+DEFAULT_BLOCK_BYTES = 2**27
+
+# Offsets (rows, columns) of the neighbouring pixels of the local-correlation image,
+# one per pair of neighbours: right, down, down-right and down-left
+NEIGHBOUR_OFFSETS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+
+def summarize_frames(frames: np.ndarray) -> dict:
+    """Running sums of a contiguous block of frames
+
+    Args:
+        frames (np.ndarray): (frames, height, width) movie frames
+
+    Returns:
+        summary (dict): partial result for `merge_summaries` and `get_summary_images`
+    """
+    if not len(frames):
+        raise ValueError("Cannot summarize an empty block of frames")
+    data = np.asarray(frames, dtype=np.float64)
+    return {
+        "nframes": len(data),
+        "sum": data.sum(axis=0),
+        "sum_squares": np.einsum("tij,tij->ij", data, data),
+        "neighbour_products": [
+            np.einsum("tij,tij->ij", *_neighbour_views(data, offset))
+            for offset in NEIGHBOUR_OFFSETS
+        ],
+        "diff_squares": np.einsum("tij,tij->ij", *[np.diff(data, axis=0)] * 2),
+        "max": np.max(frames, axis=0),
+        "first": np.array(frames[0]),
+        "last": np.array(frames[-1]),
+    }
+
+
+def merge_summaries(summaries: list) -> dict:
+    """Combine the partial results of consecutive blocks of frames
+
+    Args:
+        summaries (list): outputs of `summarize_frames`, in frame order
+
+    Returns:
+        summary (dict): partial result of the concatenated blocks
+    """
+    if not summaries:
+        raise ValueError("No summaries to merge")
+    merged = dict(summaries[0])
+    merged["neighbour_products"] = list(merged["neighbour_products"])
+    for summary in summaries[1:]:
+        boundary = summary["first"].astype(np.float64) - merged["last"]
+        merged["nframes"] += summary["nframes"]
+        merged["sum"] = merged["sum"] + summary["sum"]
+        merged["sum_squares"] = merged["sum_squares"] + summary["sum_squares"]
+        merged["neighbour_products"] = [
+            merged_products + products
+            for merged_products, products in zip(
+                merged["neighbour_products"], summary["neighbour_products"]
+            )
+        ]
+        merged["diff_squares"] = (
+            merged["diff_squares"] + summary["diff_squares"] + boundary**2
+        )
+        merged["max"] = np.maximum(merged["max"], summary["max"])
+        merged["last"] = summary["last"]
+    return merged
+
+
+def get_summary_images(summary: dict) -> dict:
+    """Summary images from the running sums of a whole movie
+
+    The local-correlation image is the mean Pearson correlation of each pixel with
+    its 8 neighbours, as in CaImAn's `local_correlations`. The peak-to-noise image is
+    the peak of each pixel above its mean, divided by its noise level. The noise is
+    estimated from frame-to-frame differences, std(x[t + 1] - x[t]) / sqrt(2), which
+    needs no second pass over the movie, rather than from the power spectrum as in
+    CaImAn's `correlation_pnr`.
+
+    Args:
+        summary (dict): output of `summarize_frames` or `merge_summaries`
+
+    Returns:
+        images (dict): (height, width) "mean_image", "max_image", "std_image",
+            "correlation_image" and "pnr_image"
+    """
+    nframes = summary["nframes"]
+    mean = summary["sum"] / nframes
+    std = np.sqrt(np.maximum(summary["sum_squares"] / nframes - mean**2, 0))
+
+    correlation_sum = np.zeros_like(mean)
+    neighbour_count = np.zeros_like(mean)
+    for offset, products in zip(NEIGHBOUR_OFFSETS, summary["neighbour_products"]):
+        mean_a, mean_b = _neighbour_views(mean, offset)
+        std_a, std_b = _neighbour_views(std, offset)
+        scale = std_a * std_b
+        correlation = np.divide(
+            products / nframes - mean_a * mean_b,
+            scale,
+            out=np.zeros_like(scale),
+            where=scale > 0,
+        )
+        for view_sum, view_count in zip(
+            _neighbour_views(correlation_sum, offset),
+            _neighbour_views(neighbour_count, offset),
+        ):
+            view_sum += correlation
+            view_count += 1
+
+    noise = np.sqrt(summary["diff_squares"] / (2 * max(nframes - 1, 1)))
+    return {
+        "mean_image": mean,
+        "max_image": summary["max"],
+        "std_image": std,
+        "correlation_image": correlation_sum / neighbour_count,
+        "pnr_image": np.divide(
+            summary["max"] - mean, noise, out=np.zeros_like(noise), where=noise > 0
+        ),
+    }
+
+
+def summarize_movie(
+    movie: MiniscopeMovie, processes: int = None, block_bytes: int = None
+) -> dict:
+    """Summary images of a movie, from one read split across worker processes
+
+    The movie is split into contiguous frame ranges, several per process. Each
+    worker reads its range in blocks of at most `block_bytes` of float64 data and
+    returns the running sums, which are merged in frame order.
+
+    Args:
+        movie (MiniscopeMovie): movie to summarize; workers reopen its files, or its
+            cache file if it is cached
+        processes (int, optional): worker processes. Defaults to `os.cpu_count()`.
+            With 1, the movie is read in the current process.
+        block_bytes (int, optional): frame data held by one worker at a time.
+            Defaults to `DEFAULT_BLOCK_BYTES`.
+
+    Returns:
+        images (dict): output of `get_summary_images`, with "nframes"
+    """
+    processes = processes or os.cpu_count()
+    frame_bytes = 8 * int(np.prod(movie.shape[1:]))
+    block_size = max(1, (block_bytes or DEFAULT_BLOCK_BYTES) // frame_bytes)
+
+    nframes = len(movie)
+    if not nframes:
+        raise ValueError("Cannot summarize a movie without frames")
+    nranges = min(nframes, 4 * processes) if processes > 1 else 1
+    bounds = np.linspace(0, nframes, nranges + 1).astype(int)
+    ranges = [(int(start), int(stop)) for start, stop in zip(bounds, bounds[1:])]
+    cache_dir = movie.cache_path.parent if movie.cache_path is not None else None
+
+    if processes <= 1:
+        summaries = [
+            _summarize_range(movie, start, stop, block_size) for start, stop in ranges
+        ]
+    else:
+        with futures.ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            summaries = list(
+                executor.map(
+                    _summarize_file_range,
+                    *zip(
+                        *[
+                            (movie.file_paths, cache_dir, start, stop, block_size)
+                            for start, stop in ranges
+                        ]
+                    ),
+                )
+            )
+    summary = merge_summaries(summaries)
+    return {"nframes": summary["nframes"], **get_summary_images(summary)}
+
+
+def _summarize_range(movie, start: int, stop: int, block_size: int) -> dict:
+    return merge_summaries(
+        [
+            summarize_frames(frames)
+            for _, frames in movie.iter_chunks(block_size, start, stop)
+        ]
+    )
+
+
+def _summarize_file_range(file_paths, cache_dir, start, stop, block_size) -> dict:
+    """Summarize a frame range in a worker process, decoding with a single thread"""
+    movie = MiniscopeMovie(file_paths, max_workers=1, cache_dir=cache_dir)
+    return _summarize_range(movie, start, stop, block_size)
+
+
+def _neighbour_views(image: np.ndarray, offset: tuple) -> tuple:
+    """Views of the last two axes pairing each pixel with its neighbour at offset"""
+    rows, columns = offset
+    height, width = image.shape[-2:]
+    row_a, row_b = slice(0, height - rows), slice(rows, height)
+    if columns >= 0:
+        column_a, column_b = slice(0, width - columns), slice(columns, width)
+    else:
+        column_a, column_b = slice(-columns, width), slice(0, width + columns)
+    return image[..., row_a, column_a], image[..., row_b, column_b]
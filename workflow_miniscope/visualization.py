@@ -0,0 +1,206 @@
+import datajoint as dj
+import numpy as np
+
+from workflow_miniscope import pyramid
+from workflow_miniscope.cache import fetch_traces
+from workflow_miniscope.pipeline import db_prefix, miniscope  # noqa: F401
+
+schema = dj.schema(db_prefix + "visualization")
+
+DEFAULT_INSERT_BYTES = 2**25  # array bytes per insert of pyramid blocks
+
+
+@schema
+class ActivityPyramid(dj.Computed):
+    """Min/max/mean decimation pyramid of the activity traces, for interactive plots
+
+    Built by `pyramid.iter_pyramid` until a level has at most
+    `dj.config["custom"]["activity_pyramid.min_bins"]` bins, and stored in blocks of
+    `activity_pyramid.block_size` bins, so that `fetch_trace_range` transfers only
+    the blocks of one level overlapping the plotted range. Level 0 stores the traces
+    once, as the means of single frames.
+
+    Attributes:
+        miniscope.Activity (foreign key): Primary key from Activity.
+        nframes (int): Number of frames of the traces.
+        nlevels (int): Number of levels, level k holding bins of 2**k frames.
+        block_size (int): Number of bins per Block.
+    """
+
+    definition = """
+    -> miniscope.Activity
+    ---
+    nframes: int  # number of frames of the traces
+    nlevels: tinyint unsigned  # level k holds bins of 2**k frames
+    block_size: int  # number of bins per Block
+    """
+
+    class Block(dj.Part):
+        """Consecutive bins of one level of the pyramid of one trace
+
+        Attributes:
+            miniscope.Activity.Trace (foreign key): Activity trace primary key.
+            level (int): Bins of 2**level frames.
+            block (int): Index of the block along the bins of the level.
+            trace_min (longblob): Minimum of the trace in each bin. Null at level
+                0, where it equals trace_mean.
+            trace_max (longblob): Maximum of the trace in each bin. Null at level
+                0, where it equals trace_mean.
+            trace_mean (longblob): Mean of the trace in each bin, the trace itself
+                at level 0.
+        """
+
+        definition = """
+        -> master
+        -> miniscope.Activity.Trace
+        level: tinyint unsigned  # bins of 2**level frames
+        block: int unsigned  # index of the block along the bins of the level
+        ---
+        trace_min=null: longblob  # minimum of the trace in each bin, null at level 0
+        trace_max=null: longblob  # maximum of the trace in each bin, null at level 0
+        trace_mean: longblob  # mean of the trace in each bin, the trace at level 0
+        """
+
+    def make(self, key):
+        """Build the pyramid of all traces at once, inserting batches of blocks
+
+        Blocks are inserted in batches of at most `DEFAULT_INSERT_BYTES` of arrays,
+        or `dj.config["custom"]["activity_pyramid.insert_bytes"]`, to stay within
+        the packet size limit of the server.
+        """
+        trace_keys, traces = fetch_traces(
+            miniscope.Activity.Trace & key,
+            "activity_trace",
+            order_by="fluorescence_channel, mask",
+        )
+        traces = np.vstack(traces)
+        config = dj.config.get("custom", {})
+        block_size = int(
+            config.get("activity_pyramid.block_size", pyramid.DEFAULT_BLOCK_SIZE)
+        )
+        min_bins = config.get("activity_pyramid.min_bins")
+        insert_bytes = int(
+            config.get("activity_pyramid.insert_bytes", DEFAULT_INSERT_BYTES)
+        )
+
+        self.insert1(
+            {
+                **key,
+                "nframes": traces.shape[1],
+                "nlevels": pyramid.get_pyramid_nlevels(traces.shape[1], min_bins),
+                "block_size": block_size,
+            }
+        )
+        batch, batch_bytes = [], 0
+        for level, block, *stats in pyramid.iter_blocks(traces, block_size, min_bins):
+            for i, trace_key in enumerate(trace_keys):
+                trace_min, trace_max, trace_mean = (
+                    data[i] if data is not None else None for data in stats
+                )
+                batch.append(
+                    {
+                        **trace_key,
+                        "level": level,
+                        "block": block,
+                        "trace_min": trace_min,
+                        "trace_max": trace_max,
+                        "trace_mean": trace_mean,
+                    }
+                )
+                batch_bytes += sum(data.nbytes for data in stats if data is not None)
+            if batch_bytes >= insert_bytes:
+                self.Block.insert(batch)
+                batch, batch_bytes = [], 0
+        if batch:
+            self.Block.insert(batch)
+
+    def fetch_trace_range(
+        self,
+        key: dict,
+        start: float = None,
+        stop: float = None,
+        width: int = 1000,
+        rois: list = None,
+        channel: int = None,
+    ) -> tuple:
+        """Fetch the decimated traces of a time range for a plot of a given width
+
+        Picks the coarsest level with at least one bin per pixel over the range, and
+        fetches only its blocks overlapping the range, so at most about 2 x `width`
+        bins are returned per ROI whatever the range. Frame i is at i / fps seconds.
+
+        Args:
+            key (dict): key of ActivityPyramid
+            start (float, optional): (s) start of the range. Defaults to the first
+                frame.
+            stop (float, optional): (s) end of the range. Defaults to the last frame.
+            width (int, optional): plot width in pixels. Defaults to 1000.
+            rois (list, optional): masks to fetch. Defaults to all masks.
+            channel (int, optional): fluorescence_channel of the traces. Defaults to
+                the only channel of the traces.
+
+        Returns:
+            bin_times (np.ndarray): (bins,) (s) center of each bin
+            mask_ids (np.ndarray): (rois,) mask along the first axis
+            trace_min (np.ndarray): (rois x bins) minimum of each bin
+            trace_max (np.ndarray): (rois x bins) maximum of each bin
+            trace_mean (np.ndarray): (rois x bins) mean of each bin
+
+        Raises:
+            ValueError: if `channel` is not set and the traces have several channels
+        """
+        key = (self & key).fetch1("KEY")
+        if channel is None:
+            channels = np.unique(
+                (miniscope.Activity.Trace & key).fetch("fluorescence_channel")
+            )
+            if len(channels) > 1:
+                raise ValueError(
+                    f"Traces of {key} have channels {channels.tolist()}: set `channel`"
+                )
+            channel = int(channels[0]) if len(channels) else 0
+        nframes, nlevels, block_size = (self & key).fetch1(
+            "nframes", "nlevels", "block_size"
+        )
+        frame_rate = (miniscope.RecordingInfo & key).fetch1("fps")
+
+        start_frame = 0 if start is None else int(np.floor(start * frame_rate))
+        start_frame = min(max(start_frame, 0), nframes)
+        stop_frame = nframes if stop is None else int(np.ceil(stop * frame_rate))
+        stop_frame = min(max(stop_frame, start_frame), nframes)
+
+        level = pyramid.get_pyramid_level(stop_frame - start_frame, width, nlevels)
+        start_bin, stop_bin = pyramid.get_bin_range(level, start_frame, stop_frame)
+        first_block = start_bin // block_size
+        query = (
+            self.Block
+            & key
+            & {"level": level, "fluorescence_channel": channel}
+            & f"block BETWEEN {first_block} AND {max(stop_bin - 1, 0) // block_size}"
+        )
+        if rois is not None:
+            query &= [{"mask": roi} for roi in rois]
+
+        masks, *blocks = query.fetch(
+            "mask", "trace_min", "trace_max", "trace_mean", order_by="mask, block"
+        )
+        if level == 0:  # minimum and maximum of single frames are the traces
+            blocks = [blocks[2]] * 3
+        mask_ids = np.unique(masks)
+        offset = first_block * block_size
+        stats = [
+            np.array(
+                [
+                    np.concatenate(list(data[masks == mask]))[
+                        start_bin - offset : stop_bin - offset
+                    ]
+                    for mask in mask_ids
+                ]
+            ).reshape(len(mask_ids), stop_bin - start_bin)
+            for data in blocks
+        ]
+
+        bin_starts = np.arange(start_bin, stop_bin) << level
+        bin_stops = np.minimum(bin_starts + 2**level, nframes)
+        bin_times = (bin_starts + bin_stops - 1) / 2 / frame_rate
+        return (bin_times, mask_ids, *stats)